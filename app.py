@@ -1,32 +1,241 @@
-from flask import Flask, render_template, redirect, request, Response, abort
+from flask import Flask, render_template, redirect, request, Response, abort, g, send_file
+import click
 from functools import wraps
+from assets import Assets
+from audio import FORMATS, INSTRUMENTS, PLAYBACK_TRANSPOSE, Audio_Busy, Audio_Renderer, arpeggio_events, scale_events
+from converters import Chord_Converter, Scale_Type_Converter, Tonic_Converter
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+import hashlib
 import json
+import os
+import re
+import time
+from metrics import Metrics
 from music_theory import Music_Theory
+from page_cache import Page_Cache
+from profiling import Sampling_Profiler, report
+from response_cache import Response_Cache
+from static_export import export_site
+from theory_atlas import build_atlas
 
 # Configure application
 app = Flask(__name__)
 
+# The only request bodies are the JSON documents of /transpose, even a large lesson library is well below this
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
+
+# Invalid tonics, scale types and chords are rejected (with a 404) by the router itself,
+# and the aliases of the scale types reach the views already normalized
+app.url_map.converters["tonic"] = Tonic_Converter
+app.url_map.converters["scale_type"] = Scale_Type_Converter
+app.url_map.converters["chord"] = Chord_Converter
+
+# How long browsers and proxies may keep the responses of the theory endpoints (in seconds).
+# They only depend on the URL and the version of the code building them.
+THEORY_MAX_AGE = 86400
+
+# Version of the code building the responses of the theory endpoints, part of their ETags: a digest of the
+# sources of the views, the converters and the Music_Theory class, so that any change to them gives new ETags,
+# even without a bump of Music_Theory.VERSION.
+RESPONSE_SOURCES = ["app.py", "converters.py", "music_theory.py"]
+sources_digest = hashlib.sha1()
+for name in RESPONSE_SOURCES:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as source:
+        sources_digest.update(source.read())
+RESPONSE_VERSION = f"{Music_Theory.VERSION}-{sources_digest.hexdigest()[:12]}"
+
+# Cache of the encoded JSON responses, shared by all the AJAX routes.
+# Set RESPONSE_CACHE=0 in the environment to switch it off, while debugging.
+response_cache = Response_Cache(
+    max_entries=int(os.environ.get("RESPONSE_CACHE_ENTRIES", 4096)),
+    max_bytes=int(os.environ.get("RESPONSE_CACHE_BYTES", 8 * 1024 * 1024)),
+    enabled=os.environ.get("RESPONSE_CACHE", "1") != "0",
+)
+
+# Cache of the rendered pages, with their compressed variants. The pages only depend on the templates.
+# Set PAGE_CACHE=0 in the environment to switch it off, while editing the templates.
+page_cache = Page_Cache(enabled=os.environ.get("PAGE_CACHE", "1") != "0")
+
+# Fingerprinted, minified and precompressed copies of the static files, served under /assets/ and
+# cached forever by the browsers. The templates get their URLs with asset_url().
+ASSETS_MAX_AGE = 365 * 86400
+assets = Assets(app.static_folder)
+app.jinja_env.globals["asset_url"] = assets.url
+
+# Audio files of the scales and chords (see audio.py), for the networks where WebAudioFont can't be loaded from
+# its CDN. They are rendered by AUDIO_WORKERS processes (0 renders them in the request thread), at most
+# AUDIO_QUEUE at a time (beyond that, requests get a 503), and kept in AUDIO_CACHE_DIR, up to AUDIO_CACHE_BYTES.
+audio_renderer = Audio_Renderer(
+    os.environ.get("AUDIO_CACHE_DIR", os.path.join(app.instance_path, "audio")),
+    workers=int(os.environ.get("AUDIO_WORKERS", 2)),
+    max_pending=int(os.environ.get("AUDIO_QUEUE", 8)),
+    max_bytes=int(os.environ.get("AUDIO_CACHE_BYTES", 256 * 1024 * 1024)),
+)
+
+# Tempo of the audio files, in beats per minute (quarter notes, like the playback of the pages)
+AUDIO_TEMPO = 80
+AUDIO_TEMPO_RANGE = range(30, 301)
+
+# Per-route request counts and latencies, time spent in the Music_Theory methods and cache stats,
+# exposed on /metrics. Set METRICS=1 in the environment to enable them, and METRICS_DIR to a
+# directory shared by the gunicorn workers, so /metrics adds up the metrics of every worker.
+# The Music_Theory methods are instrumented at the end of this file, once the startup work is done.
+metrics = Metrics(directory=os.environ.get("METRICS_DIR"), enabled=os.environ.get("METRICS", "0") == "1")
+
+# Profile a random fraction of the live requests with cProfile, to investigate latency spikes.
+# Set PROFILE to the fraction of requests to profile (eg: 0.01), and PROFILE_DIR to the directory of the
+# .pstats files. The oldest files are deleted beyond PROFILE_MAX_BYTES. See "flask --app app profile-report".
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+if float(os.environ.get("PROFILE", 0)) > 0:
+    app.wsgi_app = Sampling_Profiler(
+        app, PROFILE_DIR, rate=float(os.environ["PROFILE"]),
+        max_bytes=int(os.environ.get("PROFILE_MAX_BYTES", 50 * 1024 * 1024)),
+    )
+
+# Precompute every scale, diatonic chord and chord, so the AJAX calls below are simple lookups.
+# The tables are loaded from a snapshot file, computed and saved on the first start after any change of
+# the Music_Theory class. Set THEORY_SNAPSHOT to another path, or to an empty string to always compute them.
+# The pages are rendered upfront too (at the end of this file), so with gunicorn's preload_app (see
+# gunicorn.conf.py) all this work is done once, in the master process, and shared by the forked workers.
+# Set THEORY_ATLAS to the path of a theory atlas (see theory_atlas.py) to use it instead of the tables: the
+# file is mapped in memory by every worker, so its pages are shared, even by workers that are not forked
+# from the master process. It is built when missing or stale.
+THEORY_SNAPSHOT = os.environ.get("THEORY_SNAPSHOT", os.path.join(app.instance_path, "music_theory.snapshot"))
+THEORY_ATLAS = os.environ.get("THEORY_ATLAS", "")
+start = time.perf_counter()
+for path in [THEORY_SNAPSHOT, THEORY_ATLAS]:
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+if THEORY_ATLAS:
+    TABLES_SOURCE = "mapped from atlas" if Music_Theory.use_atlas(THEORY_ATLAS) else "written to atlas"
+else:
+    TABLES_SOURCE = "loaded from snapshot" if Music_Theory.build_tables(snapshot=THEORY_SNAPSHOT) else "computed"
+
 
 def returns_json(f):
-    """ Create our own decorator, to change content-type for JSON responses """
+    """ Create our own decorator, to change content-type for JSON responses.
+    The encoded bodies (and the 404 errors) are kept in the response cache, keyed by endpoint and arguments """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = (f.__name__, args, tuple(sorted(kwargs.items())))
+        found, body = response_cache.get(key)
+        if not found:
+            try:
+                body = f(*args, **kwargs).encode("utf-8")
+            except NotFound:
+                body = None
+            response_cache.put(key, body)
+        if body is None:
+            abort(404)
+        return Response(body, content_type='application/json')
+    return decorated_function
+
+
+def cacheable(f):
+    """ Create our own decorator, to let browsers and proxies cache deterministic responses.
+    The strong ETag is derived from RESPONSE_VERSION and the URL, so a matching If-None-Match
+    is answered with a 304 without computing anything """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        r = f(*args, **kwargs)
-        return Response(r, content_type='application/json')
+        etag = hashlib.sha1(f"{RESPONSE_VERSION}:{request.path}".encode("utf-8")).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = f(*args, **kwargs)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = THEORY_MAX_AGE
+        return response
+    return decorated_function
+
+
+def variant_response(variants, content_type):
+    """ Return the best variant accepted by the client (see encoded_variants() in page_cache.py),
+    or an empty 304 if the client already has it """
+    encoding = request.accept_encodings.best_match(list(variants), default="identity")
+    body, etag = variants[encoding]
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, content_type=content_type)
+    if encoding != "identity":
+        response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def cached_page(f):
+    """ Create our own decorator, to serve a rendered page from the page cache.
+    The client gets the best compressed variant it accepts, and a matching If-None-Match is answered
+    with a 304. Requests other than GET (eg: the POST of the "Reset" links) are not cached """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method not in ["GET", "HEAD"]:
+            return f(*args, **kwargs)
+
+        variants = page_cache.get(request.path, lambda: f(*args, **kwargs))
+        response = variant_response(variants, "text/html; charset=utf-8")
+        response.cache_control.no_cache = True
+        return response
     return decorated_function
 
 
+@app.cli.command("export")
+@click.argument("directory", default="build")
+def export_command(directory):
+    """ Freeze every page and JSON response to DIRECTORY, to be served without Python """
+    count = export_site(app, directory, assets)
+    click.echo(f"Exported {count} files to {directory}")
+
+
+@app.cli.command("build-atlas")
+@click.argument("path", default=os.path.join(app.instance_path, "theory.atlas"))
+def build_atlas_command(path):
+    """ Write the theory atlas to PATH, to be mapped by every worker (see THEORY_ATLAS) """
+    click.echo(f"Wrote {build_atlas(path)} bytes to {path}")
+
+
+@app.cli.command("profile-report")
+@click.argument("directory", default=PROFILE_DIR)
+@click.option("--top", default=30, help="Number of functions to show.")
+@click.option("--sort", default="cumulative", help="Sort key, as understood by pstats (eg: tottime).")
+@click.option("--endpoint", help="Only merge the profiles of this endpoint (eg: key).")
+def profile_report_command(directory, top, sort, endpoint):
+    """ Merge the profiles of DIRECTORY into a single report of the top functions """
+    click.echo(report(directory, top=top, sort=sort, endpoint=endpoint), nl=False)
+
+
+@app.before_request
+def start_timer():
+    """ Remember when the request started, for the metrics """
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_metrics(response):
+    """ Record the status and latency of every request, by route (not by URL, to keep the number of series low) """
+    if metrics.enabled and "start_time" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.record_request(route, request.method, response.status_code, time.perf_counter() - g.start_time)
+    return response
+
+
 @app.after_request
 def after_request(response):
-    """ Ensure responses are not cached """
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+    """ Ensure responses without their own caching policy are revalidated, and never store POST responses """
+    if request.method == "POST":
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+    elif "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache"
     return response
 
 
 # Main page, with circle of fifths and scales
 @app.route("/", methods=["GET", "POST"])
+@cached_page
 def index():
     if request.method == "POST":
         # We are called with POST when the user clicked on the "Reset" link.
@@ -37,18 +246,43 @@ def index():
 
 # Page with chord selection
 @app.route("/chords", methods=["GET", "POST"])
+@cached_page
 def chords_page():
     return render_template("chords.html")
 
 
 # About page
 @app.route("/about")
+@cached_page
 def about_page():
     return render_template("about.html")
 
 
+# Fingerprinted static files: the URL changes with the content, so browsers never need to revalidate them
+@app.route("/assets/<path:name>")
+def asset(name=None):
+    found = assets.get(name)
+    if found is None:
+        abort(404)
+    content_type, variants = found
+    response = variant_response(variants, content_type)
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSETS_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+# Metrics in the Prometheus text format
+@app.route("/metrics")
+def metrics_page():
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
 # Get the notes of a specific scale (AJAX)
-@app.route("/scale/<s>/<t>")
+@app.route("/scale/<tonic:s>/<scale_type:t>")
+@cacheable
 @returns_json
 def scale(s=None, t=None):
     try:
@@ -58,7 +292,8 @@ def scale(s=None, t=None):
 
 
 # Get the diatonic chords of a specific scale (AJAX)
-@app.route("/diatonic_chords/<s>/<t>")
+@app.route("/diatonic_chords/<tonic:s>/<scale_type:t>")
+@cacheable
 @returns_json
 def diatonic_chords(s=None, t=None):
     try:
@@ -68,10 +303,182 @@ def diatonic_chords(s=None, t=None):
 
 
 # Get the notes of a specific chord (AJAX)
-@app.route("/chord/<chord>")
+@app.route("/chord/<chord:chord>")
+@cacheable
 @returns_json
 def chord(chord=None):
     try:
         return json.dumps(Music_Theory.get_chord_notes(chord))
     except ValueError:
         abort(404)
+
+
+# Get everything needed to display and play a key in a single call: the scale, the diatonic chords
+# with their roman numerals, the notes of every diatonic chord, and the voiced notes (AJAX)
+@app.route("/key/<tonic:s>/<scale_type:t>")
+@cacheable
+@returns_json
+def key(s=None, t=None):
+    try:
+        scale = Music_Theory.get_scale(s, t)
+        chords = Music_Theory.get_diatonic_chords(s, t)
+        return json.dumps({
+            "scale": scale,
+            "chords": chords,
+            "numerals": Music_Theory.get_roman_numerals(t),
+            "chord_notes": {c: Music_Theory.get_chord_notes(c) for c in chords},
+            "scale_voicing": Music_Theory.get_voiced_notes(scale),
+            # The first chord is repeated at the end, one octave higher, like the tonic of the scale
+            "chord_voicings": Music_Theory.get_voiced_chords(chords + chords[:1]),
+        })
+    except ValueError:
+        abort(404)
+
+
+# Get the notes of a specific chord, and the voiced notes with one extra root note (one octave
+# higher) at the end, for the staff and the playback (AJAX)
+@app.route("/voicing/<chord:chord>")
+@cacheable
+@returns_json
+def voicing(chord=None):
+    try:
+        notes = Music_Theory.get_chord_notes(chord)
+        return json.dumps({"notes": notes, "voicing": Music_Theory.get_voiced_notes(notes + notes[:1])})
+    except ValueError:
+        abort(404)
+
+
+# Find every scale containing a comma separated list of notes, eg: "C,E,F#" (AJAX)
+@app.route("/scales_containing/<notes>")
+@cacheable
+@returns_json
+def scales_containing(notes=None):
+    try:
+        return json.dumps([
+            {"tonic": tonic, "scale": scale, "exact": exact}
+            for tonic, scale, exact in Music_Theory.get_scales_containing(notes.split(","))
+        ])
+    except ValueError:
+        abort(404)
+
+
+# Name the chord formed by a comma separated list of notes, starting with the bass, eg: "E,G,C" (AJAX)
+@app.route("/identify/<notes>")
+@cacheable
+@returns_json
+def identify(notes=None):
+    try:
+        chord, inversion = Music_Theory.identify_chord(notes.split(","))
+        return json.dumps({"chord": chord, "inversion": inversion})
+    except ValueError:
+        abort(404)
+
+
+# Expand a progression of roman numerals separated by dashes, eg: "I-vi-IV-V", in a specific key.
+# The response is streamed as NDJSON, one line per chord, so the first bar arrives immediately and
+# memory stays flat whatever the length of the progression. An invalid numeral ends the stream
+# with an error line.
+@app.route("/progression/<tonic:s>/<scale_type:t>/<progression>")
+@cacheable
+def progression(s=None, t=None, progression=None):
+    try:
+        Music_Theory.get_diatonic_chords(s, t)
+    except ValueError:
+        abort(404)
+
+    def generate():
+        numerals = (match.group(0) for match in re.finditer(r"[^-]+", progression))
+        bar = 0
+        try:
+            for numeral, chord, notes in Music_Theory.get_progression(s, t, numerals):
+                bar += 1
+                yield json.dumps({"bar": bar, "numeral": numeral, "chord": chord, "notes": notes}) + "\n"
+        except ValueError as e:
+            yield json.dumps({"bar": bar + 1, "error": str(e)}) + "\n"
+
+    return Response(generate(), content_type="application/x-ndjson")
+
+
+# Voice a comma separated list of chords, eg: "C,G/B,Am,F", so the voices move as little as possible.
+# Returns a JSON object with the chords and the voiced notes of each chord, from the bottom up (AJAX)
+@app.route("/voice_progression/<path:chords>")
+@cacheable
+@returns_json
+def voice_progression(chords=None):
+    try:
+        chords = chords.split(",")
+        return json.dumps({"chords": chords, "voicings": Music_Theory.voice_progression(chords)})
+    except ValueError:
+        abort(404)
+
+
+# Transpose notes, chord symbols or progressions (lists of chord symbols) by an interval, in a single call,
+# eg: {"interval": "-P4", "items": ["C", "Am7", ["F", "G7/B"]]}. The response is the list of transposed
+# items, in the same order and shape. Invalid inputs get a 400 error (AJAX)
+@app.route("/transpose", methods=["POST"])
+def transpose():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list) or not isinstance(data.get("interval"), str):
+        abort(400)
+    try:
+        return Response(json.dumps(Music_Theory.transpose(data["items"], data["interval"])), content_type="application/json")
+    except ValueError:
+        abort(400)
+
+
+# Render the notes of a scale (one octave, going up) to a WAV or a MIDI file, eg: "/audio/scale/C/major.wav"
+@app.route("/audio/scale/<tonic:s>/<scale_type:t>.<any(wav, mid):audio_format>")
+def scale_audio(s=None, t=None, audio_format=None):
+    try:
+        voiced_notes = Music_Theory.get_voiced_notes(Music_Theory.get_scale(s, t))
+    except ValueError:
+        abort(404)
+    return audio_response(audio_format, scale_events([n["midi"] + PLAYBACK_TRANSPOSE for n in voiced_notes]))
+
+
+# Render a chord to a WAV or a MIDI file: its notes one by one, with one extra root note (one octave higher),
+# then all together, like the chords page, eg: "/audio/chord/Am7.mid"
+@app.route("/audio/chord/<chord:chord>.<any(wav, mid):audio_format>")
+def chord_audio(chord=None, audio_format=None):
+    try:
+        notes = Music_Theory.get_chord_notes(chord)
+    except ValueError:
+        abort(404)
+    voiced_notes = Music_Theory.get_voiced_notes(notes + notes[:1])
+    return audio_response(audio_format, arpeggio_events([n["midi"] + PLAYBACK_TRANSPOSE for n in voiced_notes]))
+
+
+def audio_response(audio_format, events):
+    """ Send an audio file, rendered with the tempo and the instrument of the query string (eg: "?tempo=120&instrument=organ").
+    The file is streamed from the cache, with support for conditional and range requests """
+    tempo = request.args.get("tempo", str(AUDIO_TEMPO))
+    instrument = request.args.get("instrument", "piano")
+    if not re.fullmatch(r"[0-9]{1,3}", tempo) or int(tempo) not in AUDIO_TEMPO_RANGE or instrument not in INSTRUMENTS:
+        abort(400)
+    tempo = int(tempo)
+    try:
+        path = audio_renderer.render(audio_format, events, tempo, instrument)
+    except Audio_Busy:
+        raise ServiceUnavailable(retry_after=5)
+
+    # The name of the file is a digest of its content: a strong ETag
+    return send_file(path, mimetype=FORMATS[audio_format], conditional=True,
+                     etag=os.path.splitext(os.path.basename(path))[0], max_age=THEORY_MAX_AGE)
+
+
+# Render the pages when starting, and report the startup time (see gunicorn.conf.py)
+for url in ["/", "/chords", "/about"]:
+    with app.test_request_context(url):
+        app.dispatch_request()
+STARTUP_SECONDS = time.perf_counter() - start
+app.logger.info("Tables %s and pages rendered in %.1f ms", TABLES_SOURCE, STARTUP_SECONDS * 1000)
+
+# Only now, so the calls made while building the tables and rendering the pages are not counted. Otherwise,
+# with preload_app, every forked worker would start with those counts, and /metrics would add them up.
+if metrics.enabled:
+    metrics.instrument(Music_Theory, [
+        "get_scale", "get_diatonic_chords", "get_roman_numerals", "get_chord_notes", "get_scales_containing",
+        "identify_chord", "get_voiced_notes", "get_voiced_chords", "transpose", "voice_progression",
+    ])
+    metrics.add_gauges(lambda: {f"response_cache_{name}": value for name, value in response_cache.stats().items()})
+    metrics.add_gauges(lambda: {f"audio_{name}": value for name, value in audio_renderer.stats().items()})
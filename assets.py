@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, Tuple
+
+from page_cache import encoded_variants
+
+# Only text files are worth precompressing
+COMPRESSED_EXTENSIONS = [".html", ".js", ".css", ".svg"]
+
+# URL prefix of the fingerprinted assets
+ASSETS_URL = "/assets/"
+
+
+def minify(path: str, data: bytes) -> bytes:
+    # Conservative minification of the JavaScript and CSS files: drop the indentation, the blank lines
+    # and the comments on their own lines, but keep the line breaks, since some JavaScript statements
+    # rely on automatic semicolon insertion. Other files are left untouched.
+    extension = os.path.splitext(path)[1]
+    if extension not in [".js", ".css"]:
+        return data
+
+    text = data.decode("utf-8")
+    if extension == ".css":
+        text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or (extension == ".js" and line.startswith("//")):
+            continue
+        lines.append(line)
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def fingerprinted_name(path: str, data: bytes) -> str:
+    # eg: "js/project.js" becomes "js/project.0123456789ab.js"
+    root, extension = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+class Assets:
+    """
+    Fingerprinted, minified and precompressed copies of the static files, kept in memory.
+
+    Every file under the static folder is read once. Its name gets a hash of its (minified) content,
+    so its URL changes whenever its content changes, and browsers can keep it forever. The templates
+    get these URLs with asset_url(), for example: {{ asset_url("js/project.js") }}.
+    """
+
+    def __init__(self, static_folder: str):
+        # URL of every static file (by path, relative to the static folder), and content type and
+        # variants (see encoded_variants()) of every fingerprinted file (by fingerprinted name)
+        self._urls: Dict[str, str] = {}
+        self._files: Dict[str, Tuple[str, Dict[str, Tuple[bytes, str]]]] = {}
+
+        for root, _, files in os.walk(static_folder):
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, static_folder).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    data = minify(path, f.read())
+
+                fingerprinted = fingerprinted_name(path, data)
+                content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                if content_type.startswith("text/") or content_type in ["application/javascript", "image/svg+xml"]:
+                    content_type += "; charset=utf-8"
+                compress = os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+                self._urls[path] = ASSETS_URL + fingerprinted
+                self._files[fingerprinted] = (content_type, encoded_variants(data, compress=compress))
+
+    def url(self, path: str) -> str:
+        # Files that are not known (eg: added after starting) are still served from the static folder
+        return self._urls.get(path, "/static/" + path)
+
+    def get(self, fingerprinted: str) -> Tuple[str, Dict[str, Tuple[bytes, str]]] | None:
+        return self._files.get(fingerprinted)
+
+    def urls(self) -> Dict[str, str]:
+        return dict(self._urls)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import struct
+import wave
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import RLock
+from typing import Dict, List, Tuple
+
+# Bump whenever the rendered files change, so the files already in the cache are not served anymore
+AUDIO_VERSION = "1"
+
+# Mono, 16 bits
+SAMPLE_RATE = 22050
+
+# An event is a tuple (step, length, MIDI numbers): the notes start together at a step and last for a number
+# of steps. A step is an eighth note, like the playback of the pages (see static/js/project.js).
+Event = Tuple[int, int, Tuple[int, ...]]
+
+# The playback has always been one octave below the staff (see playback_pitch() in static/js/project.js)
+PLAYBACK_TRANSPOSE = -12
+
+# Instruments: relative amplitudes of the harmonics, decay of the notes (per second), and the General MIDI
+# program of the MIDI files (zero-based). Nothing is as good as the samples of WebAudioFont, but a few
+# harmonics and a decaying envelope are enough to hear the notes.
+INSTRUMENTS = {
+    "piano": ((1.0, 0.5, 0.3, 0.15, 0.08, 0.04), 3.0, 0),
+    "organ": ((1.0, 0.8, 0.0, 0.5, 0.0, 0.0, 0.0, 0.3), 0.0, 19),
+    "sine": ((1.0,), 0.5, 79),
+}
+
+FORMATS = {"wav": "audio/wav", "mid": "audio/midi"}
+
+# Attack and release of every note, in seconds, to avoid clicks
+ATTACK = 0.005
+RELEASE = 0.03
+
+# Resolution of the MIDI files, in ticks per quarter note
+TICKS_PER_QUARTER = 480
+VELOCITY = 80
+
+
+def scale_events(pitches: List[int]) -> List[Event]:
+    # Play the notes one after the other, one step each
+    return [(step, 1, (pitch,)) for step, pitch in enumerate(pitches)]
+
+
+def arpeggio_events(pitches: List[int]) -> List[Event]:
+    # Play the notes one after the other, then all together for 4 steps (see arpeggiate_single_chord_to_notes())
+    return scale_events(pitches) + [(len(pitches), 4, tuple(pitches))]
+
+
+def synthesize(events: List[Event], tempo: int, instrument: str) -> "numpy.ndarray":
+    # The samples of a sequence of events, as 16 bits integers. Each event is computed at once, as the sum of
+    # the harmonics of all its notes: a matrix product of the amplitudes by the sines of all the harmonics.
+    import numpy as np
+
+    harmonics, decay, _ = INSTRUMENTS[instrument]
+    step = 30 / tempo
+    amplitudes = np.array(harmonics)
+    ranks = np.arange(1, len(harmonics) + 1)
+
+    # One more step at the end, so the last notes are not cut off
+    end = max(start + length for start, length, _ in events) + 1
+    samples = np.zeros(int(end * step * SAMPLE_RATE) + 1)
+    for start, length, notes in events:
+        count = int(length * step * SAMPLE_RATE)
+        t = np.arange(count) / SAMPLE_RATE
+        frequencies = 440.0 * 2.0 ** ((np.array(notes, dtype=float) - 69) / 12)
+        partials = (frequencies[:, None] * ranks).ravel()
+        # The harmonics above the Nyquist frequency would come back as aliases: drop them
+        weights = np.where(partials < SAMPLE_RATE / 2, np.tile(amplitudes, len(notes)), 0.0)
+        sound = weights @ np.sin(2 * np.pi * partials[:, None] * t)
+        envelope = np.exp(-decay * t) * np.minimum(1.0, t / ATTACK) * np.minimum(1.0, (count - 1 - np.arange(count)) / (RELEASE * SAMPLE_RATE))
+        offset = int(start * step * SAMPLE_RATE)
+        samples[offset:offset + count] += sound * envelope
+
+    peak = np.abs(samples).max()
+    if peak > 0:
+        samples *= 0.8 / peak
+    return np.round(samples * 32767).astype("<i2")
+
+
+def wav_file(events: List[Event], tempo: int, instrument: str) -> bytes:
+    output = io.BytesIO()
+    with wave.open(output, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(synthesize(events, tempo, instrument).tobytes())
+    return output.getvalue()
+
+
+def _variable_length(value: int) -> bytes:
+    # MIDI variable-length quantity: 7 bits per byte, most significant first, the high bit set on all but the last
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def midi_file(events: List[Event], tempo: int, instrument: str) -> bytes:
+    # A Standard MIDI File (format 0: a single track) with the tempo, the program of the instrument, then the notes
+    step = TICKS_PER_QUARTER // 2
+    messages = []
+    for start, length, notes in events:
+        for note in notes:
+            # At the same tick, the notes are released (0) before the next ones are played (1)
+            messages.append((start * step, 1, bytes([0x90, note, VELOCITY])))
+            messages.append(((start + length) * step, 0, bytes([0x80, note, 0])))
+    messages.sort(key=lambda message: message[:2])
+
+    track = bytearray(b"\x00\xff\x51\x03" + (60000000 // tempo).to_bytes(3, "big"))
+    track += bytes([0x00, 0xC0, INSTRUMENTS[instrument][2]])
+    tick = 0
+    for time, _, message in messages:
+        track += _variable_length(time - tick) + message
+        tick = time
+    track += b"\x00\xff\x2f\x00"
+
+    return b"MThd" + struct.pack(">IHHH", 6, 0, 1, TICKS_PER_QUARTER) + b"MTrk" + struct.pack(">I", len(track)) + track
+
+
+def render(audio_format: str, events: List[Event], tempo: int, instrument: str) -> bytes:
+    if audio_format == "wav":
+        return wav_file(events, tempo, instrument)
+    return midi_file(events, tempo, instrument)
+
+
+def render_file(path: str, audio_format: str, events: List[Event], tempo: int, instrument: str) -> int:
+    # Render to path, and return the size of the file. Runs in the worker processes: the file is written there,
+    # so the samples never go through the pipe, and atomically, so it is never served half written.
+    data = render(audio_format, events, tempo, instrument)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return len(data)
+
+
+class Audio_Busy(Exception):
+    """ The file could not be rendered right now (too many files are already being rendered, the render took
+    too long, or a worker process died), the request should be retried later """
+
+
+class Audio_Renderer:
+    """
+    Renders sequences of notes to WAV or MIDI files, and keeps them in a content-addressed cache on disk.
+
+    Each file is named after a digest of everything it depends on (the events, the tempo, the instrument, the
+    format and AUDIO_VERSION), so a file in the cache is always valid, and shared by every process using the
+    same directory. Files are rendered in a pool of worker processes, started on the first render (never in
+    gunicorn's master process): the synthesis never holds the GIL of the request workers. Requests for a file
+    already being rendered wait for the same render, and beyond max_pending renders, render() raises Audio_Busy
+    instead of queueing more work. Renders taking longer than timeout also raise Audio_Busy (the file is still
+    rendered, for the next request), and so does a pool broken by the death of a worker process: the pool is
+    dropped, and a new one is started by the next render.
+
+    When the directory exceeds max_bytes, the least recently used files are deleted. The directory is only scanned
+    on the first render, then whenever the running total of the sizes goes over max_bytes.
+
+    With workers=0, the files are rendered in the calling thread (eg: for the tests).
+    """
+
+    def __init__(self, directory: str, workers=2, max_pending=8, max_bytes=256 * 1024 * 1024, timeout=30.0):
+        self.directory = directory
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._executor: ProcessPoolExecutor | None = None
+        self._executor_pid = None
+        self._pending: Dict[str, Future] = {}
+        # Reentrant: the callback of a render may run at once, in the thread which submitted it
+        self._lock = RLock()
+        # Size of the directory at the last scan, plus the files rendered by this process since then. The files
+        # rendered by other processes sharing the directory are only counted by their own scans.
+        self._total_bytes: int | None = None
+        self._stats = {"renders": 0, "hits": 0, "rejected": 0, "timeouts": 0, "failures": 0}
+
+    def path(self, audio_format: str, events: List[Event], tempo: int, instrument: str) -> str:
+        key = json.dumps([AUDIO_VERSION, audio_format, events, tempo, instrument])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.{audio_format}")
+
+    def render(self, audio_format: str, events: List[Event], tempo: int, instrument: str) -> str:
+        # Return the path of the rendered file, rendering it first if needed
+        if audio_format not in FORMATS or instrument not in INSTRUMENTS or not events:
+            raise ValueError("Invalid audio format, instrument or events")
+        path = self.path(audio_format, events, tempo, instrument)
+        try:
+            # Mark the file as recently used
+            os.utime(path)
+            self._stats["hits"] += 1
+            return path
+        except OSError:
+            pass
+
+        if self.workers == 0:
+            size = render_file(path, audio_format, events, tempo, instrument)
+            self._stats["renders"] += 1
+            self._add_bytes(size)
+            return path
+
+        with self._lock:
+            future = self._pending.get(path)
+            if future is None:
+                if len(self._pending) >= self.max_pending:
+                    self._stats["rejected"] += 1
+                    raise Audio_Busy("Too many files are being rendered")
+                executor = self._get_executor()
+                try:
+                    future = executor.submit(render_file, path, audio_format, events, tempo, instrument)
+                except BrokenProcessPool:
+                    self._drop_executor(executor)
+                    self._stats["failures"] += 1
+                    raise Audio_Busy("The pool of worker processes is broken")
+                self._pending[path] = future
+                self._stats["renders"] += 1
+                future.add_done_callback(lambda done: self._done(path, done, executor))
+
+        try:
+            future.result(timeout=self.timeout)
+        except TimeoutError:
+            # The render goes on, its file will be in the cache for the next request
+            self._stats["timeouts"] += 1
+            raise Audio_Busy("The render took too long")
+        except BrokenProcessPool:
+            self._stats["failures"] += 1
+            raise Audio_Busy("A worker process died")
+        return path
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # The worker processes are spawned, not forked: a forked copy of a threaded request worker could inherit
+        # locks held by other threads. They only import this module (and NumPy). After a fork (eg: gunicorn's
+        # master and workers), the pool of the parent process belongs to the parent.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self._executor_pid = os.getpid()
+            self._pending = {}
+        return self._executor
+
+    def _drop_executor(self, executor: ProcessPoolExecutor) -> None:
+        # Forget a broken pool (and its renders, which all failed with it), so the next render starts a new one.
+        # Called with the lock held.
+        if self._executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pending = {}
+
+    def _done(self, path: str, future: Future, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._pending.get(path) is future:
+                del self._pending[path]
+            if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                self._drop_executor(executor)
+                return
+        if not future.cancelled() and future.exception() is None:
+            self._add_bytes(future.result())
+
+    def _add_bytes(self, size: int) -> None:
+        # Count a new file, and only scan the directory when the total goes over max_bytes (or on the first render)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+                if self._total_bytes <= self.max_bytes:
+                    return
+        self.enforce_size_limit()
+
+    def enforce_size_limit(self) -> None:
+        # Delete the least recently used files until the directory fits in max_bytes
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._total_bytes = total
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats, pending=len(self._pending))
+
+    def close(self) -> None:
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the Music_Theory class and the AJAX routes of the Flask application.
+
+Every public Music_Theory method is timed across the full matrix of tonics and scale types
+(or chords), and the AJAX routes are timed through the Flask test client, twice: once served
+from the response cache, and once with the response cache switched off, for the real cost of
+each route. Each call is timed individually, to report the number of operations per second and
+the latency percentiles.
+The cold start of the application is also timed, by importing it in a new process.
+
+Usage:
+    python benchmark.py                                 # Run everything and print a report
+    python benchmark.py --output results.json           # Also save the results
+    python benchmark.py --baseline baseline.json        # Compare against previous results
+    python benchmark.py --baseline baseline.json --threshold 5 --only get_scale
+    python benchmark.py --only startup --repeat 5        # Cold start of the application
+    python benchmark.py --atlas instance/theory.atlas    # Lookups in the theory atlas
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import quote
+
+from music_theory import Music_Theory
+
+# Tonics used for the benchmarks: every natural note, with a single sharp or flat
+TONICS = [letter + accidental for letter in "CDEFGAB" for accidental in ["", "#", "b"]]
+
+# Scale types, without the aliases (eg: "minor")
+SCALE_TYPES = [scale for scale in Music_Theory.SUPPORTED_SCALES if scale not in Music_Theory.SCALE_ALIASES]
+
+# Every chord quality understood by get_chord_notes(), and a few slash chords
+CHORDS = [tonic + suffix for tonic in TONICS for suffix in ["", "m", "o", "+", "7", "maj7", "m7", "ø7", "dim7"]]
+CHORDS += [tonic + "/" + bass for tonic in TONICS for bass in ["E", "G"]]
+
+# Progressions voiced by voice_progression(), by number of bars, to show how it scales with their length:
+# the diatonic chords of a few keys, with seventh chords and slash chords
+PROGRESSION = (Music_Theory.get_diatonic_chords("C") + ["Dm7", "G7", "Cmaj7", "C/E"]
+               + Music_Theory.get_diatonic_chords("Eb", "harmonic minor") + ["Fm7", "Bb7", "Ebmaj7", "Ab/C"])
+PROGRESSION_BARS = [8, 16, 32, 64]
+
+# Notes identified by identify_chord(): every chord without a slash, in root position and in first inversion
+IDENTIFIED_NOTES = [notes[inversion:] + notes[:inversion]
+                    for notes in (Music_Theory.get_chord_notes(c) for c in CHORDS if "/" not in c) for inversion in [0, 1]]
+
+# A benchmark is a name and a list of calls, each call being timed individually
+Benchmark = Tuple[str, List[Callable[[], object]]]
+
+
+def progressions(bars: int) -> List[List[str]]:
+    # A few progressions of that many bars, each one starting on another chord of PROGRESSION
+    repeated = PROGRESSION * (bars // len(PROGRESSION) + 2)
+    return [repeated[start:start + bars] for start in range(0, len(PROGRESSION), 3)]
+
+
+def theory_benchmarks() -> List[Benchmark]:
+    keys = [(tonic, scale) for tonic in TONICS for scale in SCALE_TYPES]
+    all_tonics = [tonic for tonic, _ in keys]
+    all_types = [scale for _, scale in keys]
+    scales = [Music_Theory.get_scale(t, s) for t, s in keys]
+    diatonic_chords = [Music_Theory.get_diatonic_chords(t, s) for t, s in keys]
+
+    return [
+        ("get_scale", [lambda t=t, s=s: Music_Theory.get_scale(t, s) for t, s in keys]),
+        ("get_diatonic_chords", [lambda t=t, s=s: Music_Theory.get_diatonic_chords(t, s) for t, s in keys]),
+        ("get_roman_numerals", [lambda s=s: Music_Theory.get_roman_numerals(s) for s in SCALE_TYPES]),
+        ("get_progression", [lambda t=t, s=s: list(Music_Theory.get_progression(t, s, Music_Theory.get_roman_numerals(s)))
+                             for t, s in keys]),
+        ("get_scales_containing", [lambda n=n: Music_Theory.get_scales_containing(n) for n in
+                                   [scale[:3] for scale in scales] + [scale[2:6] for scale in scales]]),
+        ("get_chord_notes", [lambda c=c: Music_Theory.get_chord_notes(c) for c in CHORDS]),
+        ("identify_chord", [lambda n=n: Music_Theory.identify_chord(n) for n in IDENTIFIED_NOTES]),
+        ("get_voiced_notes", [lambda n=n: Music_Theory.get_voiced_notes(n) for n in scales]),
+        ("get_voiced_chords", [lambda c=c: Music_Theory.get_voiced_chords(c) for c in diatonic_chords]),
+        ("pretty_display", [lambda c=c: Music_Theory.pretty_display(c, verbose=True) for c in CHORDS]),
+        ("get_scales_bulk", [lambda: Music_Theory.get_scales_bulk(all_tonics, all_types)]),
+        ("get_chords_bulk", [lambda: Music_Theory.get_chords_bulk(CHORDS)]),
+        ("transpose", [lambda i=i: Music_Theory.transpose(CHORDS, i) for i in ["m2", "M3", "-P4", "A4"]]),
+    ] + [
+        (f"voice_progression ({bars} bars)", [lambda p=p: Music_Theory.voice_progression(p) for p in progressions(bars)])
+        for bars in PROGRESSION_BARS
+    ]
+
+
+def route_benchmarks() -> List[Benchmark]:
+    from app import app, response_cache
+
+    client = app.test_client()
+
+    def get(url: str, cached: bool) -> Callable[[], object]:
+        # After the warmup, cached calls only measure the hits of the response cache. Uncached calls switch
+        # it off, so they go through the view, the Music_Theory calls and the JSON serialization every time.
+        def call():
+            enabled = response_cache.enabled
+            response_cache.enabled = enabled and cached
+            try:
+                response = client.get(url)
+            finally:
+                response_cache.enabled = enabled
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+        return call
+
+    keys = [(quote(tonic), quote(scale)) for tonic in TONICS for scale in SCALE_TYPES]
+    chords = [quote(c, safe="/") for c in CHORDS]
+    notes = [quote(",".join(n)) for n in IDENTIFIED_NOTES]
+    routes = [
+        ("/scale", [f"/scale/{t}/{s}" for t, s in keys]),
+        ("/diatonic_chords", [f"/diatonic_chords/{t}/{s}" for t, s in keys]),
+        ("/chord", [f"/chord/{c}" for c in chords]),
+        ("/key", [f"/key/{t}/{s}" for t, s in keys]),
+        ("/voicing", [f"/voicing/{c}" for c in chords]),
+        ("/scales_containing", [f"/scales_containing/{n}" for n in notes]),
+        ("/identify", [f"/identify/{n}" for n in notes]),
+    ]
+    return [(f"route {route}", [get(url, True) for url in urls]) for route, urls in routes] + [
+        (f"route {route} (uncached)", [get(url, False) for url in urls]) for route, urls in routes
+    ]
+
+
+def startup_benchmarks() -> List[Benchmark]:
+    # Cold start of a new process importing the application, as a new gunicorn worker would without
+    # preload_app: with the tables loaded from the snapshot file, and with the tables computed
+    def start(snapshot: bool) -> Callable[[], object]:
+        env = dict(os.environ)
+        if not snapshot:
+            env["THEORY_SNAPSHOT"] = ""
+
+        def call():
+            subprocess.run([sys.executable, "-c", "import app"], env=env, check=True)
+        return call
+
+    return [
+        ("startup (snapshot)", [start(True)]),
+        ("startup (no snapshot)", [start(False)]),
+    ]
+
+
+def percentile(sorted_values: List[int], p: float) -> int:
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_benchmark(calls: List[Callable[[], object]], repeat: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        for call in calls:
+            call()
+
+    timings: List[int] = []
+    for _ in range(repeat):
+        for call in calls:
+            start = time.perf_counter_ns()
+            call()
+            timings.append(time.perf_counter_ns() - start)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        "calls": len(timings),
+        "ops_per_sec": len(timings) / (total / 1e9) if total else 0.0,
+        "mean_us": total / len(timings) / 1000,
+        "p50_us": percentile(timings, 50) / 1000,
+        "p95_us": percentile(timings, 95) / 1000,
+        "p99_us": percentile(timings, 99) / 1000,
+        "max_us": timings[-1] / 1000,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    # Return a description of every benchmark slower than the baseline by more than threshold percent
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["ops_per_sec"]
+        after = result["ops_per_sec"]
+        if before and (before - after) / before * 100 > threshold:
+            regressions.append(f"{name}: {after:,.0f} ops/sec, baseline {before:,.0f} ops/sec "
+                               f"({(after - before) / before * 100:+.1f}%)")
+    return regressions
+
+
+def print_report(results: Dict[str, Dict], baseline: Dict[str, Dict] | None) -> None:
+    print(f"{'benchmark':<36}{'ops/sec':>14}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'change':>10}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline and baseline[name]["ops_per_sec"]:
+            before = baseline[name]["ops_per_sec"]
+            change = f"{(result['ops_per_sec'] - before) / before * 100:+.1f}%"
+        print(f"{name:<36}{result['ops_per_sec']:>14,.0f}{result['p50_us']:>10.1f}"
+              f"{result['p95_us']:>10.1f}{result['p99_us']:>10.1f}{change:>10}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Music_Theory class and the AJAX routes")
+    parser.add_argument("--repeat", type=int, default=20, help="number of timed passes over each benchmark")
+    parser.add_argument("--warmup", type=int, default=2, help="number of untimed passes before timing")
+    parser.add_argument("--only", action="append", default=[], help="only run benchmarks containing this text")
+    parser.add_argument("--no-tables", action="store_true", help="compute every answer, without the precomputed tables")
+    parser.add_argument("--atlas", help="answer from the theory atlas at this path, instead of the precomputed tables")
+    parser.add_argument("--no-routes", action="store_true", help="skip the benchmarks of the Flask routes")
+    parser.add_argument("--no-startup", action="store_true", help="skip the benchmarks of the application startup")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results saved in this JSON file")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percentage of ops/sec lost, compared to the baseline, considered a regression")
+    args = parser.parse_args()
+
+    benchmarks = theory_benchmarks()
+    if not args.no_routes:
+        benchmarks += route_benchmarks()
+    if not args.no_startup:
+        benchmarks += startup_benchmarks()
+
+    # Importing the app builds the tables, so decide about them afterwards
+    if args.no_tables:
+        Music_Theory.clear_tables()
+    elif args.atlas:
+        Music_Theory.use_atlas(args.atlas)
+    else:
+        Music_Theory.build_tables()
+
+    results: Dict[str, Dict] = {}
+    for name, calls in benchmarks:
+        if args.only and not any(text in name for text in args.only):
+            continue
+        results[name] = run_benchmark(calls, args.repeat, args.warmup)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "version": Music_Theory.VERSION,
+                "tables": not args.no_tables,
+                "atlas": bool(args.atlas) and not args.no_tables,
+                "results": results,
+            }, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressions (more than {args.threshold}% slower than the baseline):")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
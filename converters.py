@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import re
+from typing import Iterable
+
+from werkzeug.routing import BaseConverter
+
+from music_theory import Music_Theory
+
+
+def alternatives(values: Iterable[str]) -> str:
+    # A regex matching any of the values, longest first, so "C#" is never read as "C" followed by garbage
+    return "|".join(re.escape(value) for value in sorted(values, key=len, reverse=True))
+
+
+# Every tonic (or chord root) covered by the precomputed tables, eg: "C", "F#" or "Bbb"
+TONICS = alternatives(Music_Theory.get_table_tonics())
+
+
+class Tonic_Converter(BaseConverter):
+    """ A tonic covered by the precomputed tables, eg: <tonic:s> """
+    regex = TONICS
+
+
+class Scale_Type_Converter(BaseConverter):
+    """ A supported scale type, eg: <scale_type:t>. Aliases reach the view already normalized
+    (eg: "minor" becomes "natural minor") """
+    regex = alternatives(Music_Theory.SUPPORTED_SCALES)
+
+    def to_python(self, value: str) -> str:
+        return Music_Theory.SCALE_ALIASES.get(value, value)
+
+
+class Chord_Converter(BaseConverter):
+    """ A chord symbol understood by Music_Theory.get_chord_notes(), eg: <chord:chord>. The root is a
+    tonic covered by the precomputed tables, and slash chords have a bass note after a single slash """
+    regex = f"(?:{TONICS})(?:{alternatives(Music_Theory.CHORD_SUFFIXES)})(?:/(?:{TONICS}))?"
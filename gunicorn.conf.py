@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Recommended gunicorn configuration, read automatically by "gunicorn app:app" from this directory.
+
+The application is imported once, in the master process (preload_app), before the workers are forked.
+The precomputed tables and the compiled templates are then shared copy-on-write by every worker, and a
+new worker (eg: when autoscaling, or after max_requests) is ready to answer as soon as it is forked.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:" + os.environ.get("PORT", "8000"))
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+# Recycle the workers from time to time, spread out so they don't all restart at once
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def when_ready(server):
+    # Called in the master process, once the application has been loaded and before any worker is forked
+    import app
+
+    server.log.info("Tables %s and pages rendered in %.1f ms", app.TABLES_SOURCE, app.STARTUP_SECONDS * 1000)
+
+    # Move every object created so far out of the garbage collector's reach. Otherwise, the first
+    # collection in each worker writes to all of them (reference counts aside), which copies the
+    # memory pages shared with the master process.
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    # Called in the master process when a worker has exited: its counters are kept, and its gauges dropped
+    import app
+    from metrics import retire_process
+
+    if app.metrics.enabled and app.metrics.directory:
+        retire_process(app.metrics.directory, worker.pid)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load test of the application, replaying the requests of real users flipping through the pages.
+
+Each simulated user runs sessions in a loop, with its own keep-alive connection, like a browser tab:
+- a scales session loads the scales page and its assets, then asks for the default key (C major) and
+  for a few more keys, picked at random like clicks on the circle of fifths or the selects;
+- a chords session loads the chords page and its assets, then asks for a few chords.
+
+With --legacy, the sessions issue the chain of requests of the previous versions of the JavaScript code,
+instead of a single /key call for each key: /diatonic_chords, /scale, then the diatonic chords with the first
+one repeated at the end, each fetched twice (once for the staff, once for the playback), one after the other.
+On the chords page, each chord is fetched 4 times with /chord (the arpeggio and the chord, for the staff and for
+the playback), instead of a single /voicing call. None of those responses could be cached by the browser.
+
+By default, a local gunicorn server is started with gunicorn.conf.py, and stopped at the end.
+
+Usage:
+    python loadtest.py                                  # 50 users for 30 seconds, on a local server
+    python loadtest.py --users 500 --workers 8 --duration 60
+    python loadtest.py --legacy --output legacy.json
+    python loadtest.py --url http://127.0.0.1:5000     # Against a server that is already running
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import quote, urlsplit
+
+from benchmark import percentile
+
+# The values of the selects of the scales and chords pages
+TONICS = ["C", "C#", "Db", "D", "D#", "Eb", "E", "F", "F#", "Gb", "G", "G#", "Ab", "A", "A#", "Bb", "B", "Cb"]
+SCALE_TYPES = [
+    "major", "minor", "harmonic minor", "melodic minor", "dorian", "phrygian", "lydian", "mixolydian", "locrian",
+    "major pentatonic", "minor pentatonic", "blues", "whole tone", "whole-half diminished", "half-whole diminished",
+]
+CHORD_SUFFIXES = ["", "m", "o", "+"]
+
+# Assets of the pages served by the application itself (the libraries come from CDNs)
+ASSET = re.compile(r'(?:src|href)="/?((?:static|assets)/[^"]+)"')
+
+# A result is the kind of request (eg: "/key"), the latency in seconds, and whether it failed
+Result = Tuple[str, float, bool]
+
+
+class User(threading.Thread):
+    """ A simulated user, running sessions until the deadline """
+
+    def __init__(self, host: str, port: int, deadline: float, args: argparse.Namespace, seed: int):
+        super().__init__(daemon=True)
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.deadline = deadline
+        self.args = args
+        self.random = random.Random(seed)
+        self.results: List[Result] = []
+        self.sessions = 0
+
+    def get(self, kind: str, url: str) -> bytes:
+        start = time.perf_counter()
+        try:
+            self.connection.request("GET", url)
+            response = self.connection.getresponse()
+            body = response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            # Start again with a new connection
+            self.connection.close()
+            body = b""
+            failed = True
+        self.results.append((kind, time.perf_counter() - start, failed))
+        return body
+
+    def load_page(self, url: str) -> None:
+        page = self.get("page", url)
+        # Like a browser, fetch each asset once (eg: the play button is shown twice on the scales page)
+        for asset in dict.fromkeys(ASSET.findall(page.decode("utf-8", "replace"))):
+            self.get("asset", "/" + asset)
+
+    def select_key(self, tonic: str, scale: str) -> None:
+        tonic, scale = quote(tonic, safe=""), quote(scale, safe="")
+        if not self.args.legacy:
+            self.get("/key", f"/key/{tonic}/{scale}")
+            return
+
+        body = self.get("/diatonic_chords", f"/diatonic_chords/{tonic}/{scale}")
+        self.get("/scale", f"/scale/{tonic}/{scale}")
+        try:
+            chords = json.loads(body)
+        except ValueError:
+            return
+        # get_chords() added the tonic chord back, then convert_chords_to_vexnotes() and prepare_chords_notes()
+        # each fetched every chord
+        chords = chords + chords[:1]
+        for chord in chords + chords:
+            self.get("/chord", "/chord/" + quote(chord, safe=""))
+
+    def select_chord(self, chord: str) -> None:
+        if self.args.legacy:
+            # arpeggiate_single_chord_to_vexnotes() and arpeggiate_single_chord_to_notes() each fetched the
+            # chord twice: for the arpeggio, and for the chord played at the end
+            for _ in range(4):
+                self.get("/chord", "/chord/" + quote(chord, safe=""))
+        else:
+            self.get("/voicing", "/voicing/" + quote(chord, safe=""))
+
+    def think(self) -> None:
+        if self.args.think:
+            time.sleep(self.random.uniform(0, self.args.think / 1000))
+
+    def run(self) -> None:
+        while time.monotonic() < self.deadline:
+            if self.random.random() < self.args.chords_ratio:
+                self.load_page("/chords")
+                self.select_chord("C")
+                for _ in range(self.args.clicks):
+                    self.think()
+                    self.select_chord(self.random.choice(TONICS) + self.random.choice(CHORD_SUFFIXES))
+            else:
+                self.load_page("/")
+                self.select_key("C", "major")
+                for _ in range(self.args.clicks):
+                    self.think()
+                    self.select_key(self.random.choice(TONICS), self.random.choice(SCALE_TYPES))
+            self.sessions += 1
+        self.connection.close()
+
+
+def start_server(port: int, workers: int, threads: int) -> subprocess.Popen:
+    # Start gunicorn (with gunicorn.conf.py) from the directory of this file, and wait until it listens
+    env = dict(os.environ, GUNICORN_BIND=f"127.0.0.1:{port}", WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "--threads", str(threads), "app:app"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited, is it installed? (pip install -r requirements.txt)")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"gunicorn is not listening on port {port}")
+
+
+def summarize(results: List[Result], seconds: float) -> Dict[str, Dict[str, float]]:
+    # Statistics for every kind of request, and for all of them ("total")
+    by_kind: Dict[str, List[Result]] = {"total": results}
+    for result in results:
+        by_kind.setdefault(result[0], []).append(result)
+
+    summary = {}
+    for kind, kind_results in by_kind.items():
+        latencies = sorted(latency for _, latency, _ in kind_results)
+        errors = sum(1 for _, _, failed in kind_results if failed)
+        summary[kind] = {
+            "requests": len(kind_results),
+            "requests_per_sec": len(kind_results) / seconds,
+            "error_rate": errors / len(kind_results),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+    return summary
+
+
+def print_report(summary: Dict[str, Dict[str, float]], sessions: int, seconds: float) -> None:
+    print(f"{sessions} sessions in {seconds:.1f} s ({sessions / seconds:,.1f} sessions/sec)")
+    print(f"{'requests':<18}{'count':>10}{'req/sec':>10}{'errors':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for kind, stats in sorted(summary.items(), key=lambda item: item[0] == "total"):
+        print(f"{kind:<18}{stats['requests']:>10}{stats['requests_per_sec']:>10,.1f}{stats['error_rate']:>9.2%}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the application, replaying real page sessions")
+    parser.add_argument("--users", type=int, default=50, help="number of concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30, help="duration of the test, in seconds")
+    parser.add_argument("--clicks", type=int, default=5, help="number of keys or chords selected in each session")
+    parser.add_argument("--think", type=float, default=0, help="maximum pause between two clicks, in milliseconds")
+    parser.add_argument("--chords-ratio", type=float, default=0.25, help="fraction of sessions on the chords page")
+    parser.add_argument("--legacy", action="store_true", help="issue the requests of the previous JavaScript code")
+    parser.add_argument("--url", help="test this server, instead of starting a local gunicorn")
+    parser.add_argument("--port", type=int, default=8765, help="port of the local gunicorn")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=1, help="threads of each gunicorn worker")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices of the users")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        server = start_server(port, args.workers, args.threads)
+
+    try:
+        start = time.monotonic()
+        users = [User(host, port, start + args.duration, args, args.seed + i) for i in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        seconds = time.monotonic() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = [result for user in users for result in user.results]
+    if not results:
+        print("No requests were sent")
+        return 1
+    sessions = sum(user.sessions for user in users)
+    summary = summarize(results, seconds)
+    print_report(summary, sessions, seconds)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "users": args.users,
+                "legacy": args.legacy,
+                "sessions": sessions,
+                "seconds": seconds,
+                "results": summary,
+            }, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
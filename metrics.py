@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import fcntl
+import glob
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, get_ident
+from typing import Callable, Dict, List
+
+
+class Metrics:
+    """
+    Low overhead instrumentation, exposed in the Prometheus text format.
+
+    For each route, the class records the number of requests (by method and status code) and a
+    latency histogram. It can also record the number of calls and the time spent inside methods
+    of another class (see instrument()), and gauges provided by callbacks (see add_gauges()).
+
+    When running with several worker processes (eg: gunicorn), each worker periodically writes a
+    snapshot of its own metrics to a shared directory, and render() adds up the snapshots of every
+    worker. When a worker exits, its counters are merged into the total of the exited workers (see
+    retire_process()), so the counters never go backwards, and its gauges are dropped: the gauges of
+    processes that are no longer alive are never added up. Without a directory, only the metrics of
+    the current process are rendered.
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds (the last bucket is +Inf)
+    BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+    def __init__(self, directory: str | None = None, enabled=True, flush_interval=1.0):
+        self.directory = directory
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self._requests: Dict[str, int] = {}
+        self._latency: Dict[str, List[float]] = {}
+        self._calls: Dict[str, List[float]] = {}
+        self._gauges: List[Callable[[], Dict[str, int]]] = []
+        self._last_flush = time.monotonic()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        # The process which wrote the last snapshot (the instance is created before gunicorn forks the workers)
+        self._flushed_pid = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        # The latency of each route is a list: one counter per bucket, then the sum and the count
+        with self._lock:
+            key = json.dumps([route, method, status])
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = [0] * (len(self.BUCKETS) + 3)
+            latency[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            latency[-2] += seconds
+            latency[-1] += 1
+
+        if self.directory and time.monotonic() - self._last_flush > self.flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                # The metrics never fail a request: the snapshot is written again after the next interval
+                pass
+
+    def record_call(self, name: str, seconds: float) -> None:
+        with self._lock:
+            calls = self._calls.get(name)
+            if calls is None:
+                calls = self._calls[name] = [0, 0.0]
+            calls[0] += 1
+            calls[1] += seconds
+
+    def instrument(self, cls, names: List[str]) -> None:
+        # Replace some class methods of a class by timed versions
+        for name in names:
+            setattr(cls, name, classmethod(self._timed(name, getattr(cls, name).__func__)))
+
+    def _timed(self, name: str, function: Callable) -> Callable:
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record_call(name, time.perf_counter() - start)
+        return timed_function
+
+    def add_gauges(self, callback: Callable[[], Dict[str, int]]) -> None:
+        # The callback returns a dict of gauge names and values, read every time a snapshot is taken
+        self._gauges.append(callback)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            gauges: Dict[str, int] = {}
+            for callback in self._gauges:
+                gauges.update(callback())
+            return {
+                "requests": dict(self._requests),
+                "latency": {route: list(latency) for route, latency in self._latency.items()},
+                "calls": {name: list(calls) for name, calls in self._calls.items()},
+                "gauges": gauges,
+            }
+
+    def flush(self) -> None:
+        # Write the snapshot of this process, atomically, so other workers never read half a file.
+        # One thread at a time, each with its own temporary file.
+        with self._flush_lock:
+            self._last_flush = time.monotonic()
+            pid = os.getpid()
+            if self._flushed_pid != pid:
+                # A snapshot with the same pid can only be left by a process that has exited
+                retire_process(self.directory, pid)
+                self._flushed_pid = pid
+            path = os.path.join(self.directory, f"metrics-{pid}.json")
+            temporary = f"{path}.{get_ident()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temporary, path)
+
+    def collect(self) -> Dict:
+        # Add up the snapshots of every worker (or just this process, without a directory)
+        if not self.directory:
+            return self.snapshot()
+
+        try:
+            self.flush()
+        except OSError:
+            pass
+        total: Dict = {"requests": {}, "latency": {}, "calls": {}, "gauges": {}}
+        with _locked(self.directory, fcntl.LOCK_SH):
+            _add_snapshot(total, _read_snapshot(os.path.join(self.directory, EXITED_SNAPSHOT)))
+            for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+                pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+                _add_snapshot(total, _read_snapshot(path), gauges=_alive(pid))
+        return total
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        metrics = self.collect()
+        lines = [
+            "# HELP http_requests_total Number of HTTP requests, by route, method and status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        for key, count in sorted(metrics["requests"].items()):
+            route, method, status = json.loads(key)
+            lines.append(f'http_requests_total{{route="{_escape(route)}",method="{method}",status="{status}"}} {count}')
+
+        lines.append("# HELP http_request_duration_seconds Latency of the HTTP requests, by route.")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for route, latency in sorted(metrics["latency"].items()):
+            label = f'route="{_escape(route)}"'
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ["+Inf"], latency):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"http_request_duration_seconds_sum{{{label}}} {latency[-2]}")
+            lines.append(f"http_request_duration_seconds_count{{{label}}} {latency[-1]}")
+
+        lines.append("# HELP music_theory_calls_total Number of calls to each Music_Theory method.")
+        lines.append("# TYPE music_theory_calls_total counter")
+        for name, (count, _) in sorted(metrics["calls"].items()):
+            lines.append(f'music_theory_calls_total{{method="{name}"}} {count}')
+        lines.append("# HELP music_theory_call_seconds_total Time spent inside each Music_Theory method.")
+        lines.append("# TYPE music_theory_call_seconds_total counter")
+        for name, (_, seconds) in sorted(metrics["calls"].items()):
+            lines.append(f'music_theory_call_seconds_total{{method="{name}"}} {seconds}')
+
+        for name, value in sorted(metrics["gauges"].items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Snapshot of the counters of every exited process, in the directory of the snapshots
+EXITED_SNAPSHOT = "exited.json"
+
+
+def retire_process(directory: str, pid: int) -> None:
+    # Merge the counters of an exited process into the snapshot of the exited processes, and delete its own
+    # snapshot. Called by gunicorn's master process when a worker exits (see gunicorn.conf.py), and by a
+    # process about to reuse the pid of an exited one.
+    path = os.path.join(directory, f"metrics-{pid}.json")
+    if not os.path.exists(path):
+        return
+    with _locked(directory, fcntl.LOCK_EX):
+        snapshot = _read_snapshot(path)
+        if snapshot is not None:
+            exited_path = os.path.join(directory, EXITED_SNAPSHOT)
+            exited = _read_snapshot(exited_path) or {"requests": {}, "latency": {}, "calls": {}, "gauges": {}}
+            _add_snapshot(exited, snapshot, gauges=False)
+            with open(f"{exited_path}.{os.getpid()}.tmp", "w") as f:
+                json.dump(exited, f)
+            os.replace(f"{exited_path}.{os.getpid()}.tmp", exited_path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def _locked(directory: str, operation: int):
+    # Readers of the snapshots share the lock, so they never see the counters of an exited process twice
+    # (or not at all) while they are being merged
+    with open(os.path.join(directory, "metrics.lock"), "a") as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_snapshot(path: str) -> Dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _add_snapshot(total: Dict, snapshot: Dict | None, gauges=True) -> None:
+    if snapshot is None:
+        return
+    for key, count in snapshot["requests"].items():
+        total["requests"][key] = total["requests"].get(key, 0) + count
+    for section in ["latency", "calls"]:
+        for name, values in snapshot[section].items():
+            if name in total[section]:
+                total[section][name] = [a + b for a, b in zip(total[section][name], values)]
+            else:
+                total[section][name] = values
+    if gauges:
+        for name, value in snapshot["gauges"].items():
+            total["gauges"][name] = total["gauges"].get(name, 0) + value
+
+
+def _alive(pid: int) -> bool:
+    # Signal 0 only checks that the process exists
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value: str) -> str:
+    # Escape a label value for the Prometheus text format
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
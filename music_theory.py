@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import marshal
+import os
 import re
-from typing import List
+import sys
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
 
 
 class Music_Theory:
@@ -22,228 +27,486 @@ class Music_Theory:
     The interesting methods are:
 
         get_scale:           Used to compute the notes of the scales in any key.
-                             The supported scales are Major, (Natural) Minor, Harmonic Minor and Melodic Minor
+                             The supported scales (see SCALE_DEFINITIONS) are Major, (Natural) Minor,
+                             Harmonic Minor, Melodic Minor, the other church modes, the pentatonic and
+                             blues scales, the whole tone scale and the diminished scales.
 
         get_diatonic_chords: Used to compute the list of diatonic chords in any of the supported scales.
                              Diatonic chords are chords that use notes exclusively from the scale.
 
-        get_chord_notes:     Used to compute the notes that form a specific triad.
+        get_scales_containing: Used to find every scale that contains a set of notes.
+
+        identify_chord:      Used to name the chord (with inversion) formed by some notes, in any order.
+
+        get_progression:     Used to expand a progression of roman numerals into chords and notes.
+
+        get_roman_numerals:  Used to get the roman numerals (with qualities) of each degree of a scale type.
+
+        get_chord_notes:     Used to compute the notes that form a specific chord.
                              The supported triads are:  Major, Minor, Diminished and Augmented
+                             The supported seventh chords are: 7, maj7, m7, ø7 (half-diminished) and dim7
+                             Slash chords (eg: "C/E") start with the bass note, for inversions.
+
+        get_scales_bulk:     Used to compute many scales at once, with NumPy array arithmetic.
+        get_chords_bulk:     Used to compute the notes of many chords at once, with NumPy array arithmetic.
+
+        transpose:           Used to transpose many notes, chord symbols or progressions by an interval.
+
+        get_voiced_notes:    Used to assign octaves and MIDI numbers to notes, for the staff and the playback.
+        get_voiced_chords:   Used to assign octaves and MIDI numbers to the notes of a list of chords.
+        voice_progression:   Used to voice a progression so the voices move as little as possible.
 
         pretty_display:      Used to display nice UTF-8 characters for diminished and augmented chords.
                              Also add a shorthand for the quality in brackets, if verbose==True.
+
+        build_tables:        Opt-in. Precompute every valid answer of get_scale, get_diatonic_chords and
+                             get_chord_notes, so later calls become simple dictionary lookups.
+                             The tables can be saved to, and loaded from, a snapshot file.
+
+        use_atlas:           Opt-in. Answer the same lookups from a binary atlas file, mapped in memory and
+                             shared by every process, instead of building the tables in each process.
     """
 
-    # This dict is used to find alternate names for enharmonic notes. This is used in scales
-    # to make sure each note starts with a consecutive letter, with no duplicates.
-    # This means in some cases, we need to introduce double-sharps or double-flats.
-    ENHARMONIC_NOTES = {
-        "C": ["B#", "Dbb"],
-        "C#": ["Db", "B##"],
-        "Db": ["C#"],
-        "C##": ["D"],
-        "D": ["C##", "Ebb"],
-        "E": ["Fb", "D##"],
-        "E#": ["F"],
-        "Fb": ["E"],
-        "F": ["E#"],
-        "F#": ["Gb", "E##"],
-        "Gb": ["F#"],
-        "F##": ["G"],
-        "G": ["F##", "Abb"],
-        "G#": ["Ab", "F###"],
-        "G##": ["A"],
-        "A": ["G##", "Bbb"],
-        "B": ["Cb", "A##"],
-        "B#": ["C"],
-        "Cb": ["B"],
-        "Abb": ["G"],
-        "Bbb": ["A"],
-        "Ebb": ["D"],
+    # Version of the answers computed by this class. Bump it whenever the output of any public method
+    # changes, since it is used to validate responses that have been cached by browsers and proxies.
+    VERSION = "1.4"
+
+    # Notes are represented internally as small integers, packing the letter index (0 for "C" up to
+    # 6 for "B") in the 3 lowest bits and the accidental offset (+1 per sharp, -1 per flat) in the
+    # remaining bits. The pitch class of a note is then derived arithmetically from the letter and
+    # the accidental, and sharpening or flattening a note is simply adding or subtracting ACCIDENTAL.
+    # Notes are only converted back to strings when returned by the public methods.
+    LETTERS = "CDEFGAB"
+    ACCIDENTAL = 8
+
+    # Pitch class (number of half steps above "C") of each natural note, by letter index
+    NATURAL_PITCH_CLASSES = [0, 2, 4, 5, 7, 9, 11]
+
+    # Roman numerals of the degrees, by number of letters above the tonic
+    ROMAN_NUMERALS = ["I", "II", "III", "IV", "V", "VI", "VII"]
+
+    # Intervals of the supported chords, by quality. Each interval is a tuple with the number of
+    # letters and the number of half steps above the root.
+    CHORD_INTERVALS = {
+        "M": ((0, 0), (2, 4), (4, 7)),
+        "m": ((0, 0), (2, 3), (4, 7)),
+        "o": ((0, 0), (2, 3), (4, 6)),
+        "+": ((0, 0), (2, 4), (4, 8)),
+        "7": ((0, 0), (2, 4), (4, 7), (6, 10)),
+        "maj7": ((0, 0), (2, 4), (4, 7), (6, 11)),
+        "m7": ((0, 0), (2, 3), (4, 7), (6, 10)),
+        "ø7": ((0, 0), (2, 3), (4, 6), (6, 10)),
+        "dim7": ((0, 0), (2, 3), (4, 6), (6, 9)),
     }
 
-    # Notes of the chromatic scales (starting at C), using sharps or flats
-    CHROMATIC_SCALE = {
-        "sharps": ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"],
-        "flats": ["C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"],
+    # Suffixes understood in chord symbols, and the quality (key in CHORD_INTERVALS) they stand for.
+    # Any chord without any suffix is implicitly a Major chord.
+    CHORD_SUFFIXES = {
+        "": "M",
+        "m": "m",
+        "o": "o",
+        "-": "o",
+        "+": "+",
+        "7": "7",
+        "maj7": "maj7",
+        "M7": "maj7",
+        "m7": "m7",
+        "ø7": "ø7",
+        "m7b5": "ø7",
+        "dim7": "dim7",
+        "o7": "dim7",
     }
 
-    # List of major key signatures, grouped by whether they use sharps or flats
-    MAJOR_SCALES = {
-        # "C" is included here just to have a default value, even if it has no sharps nor flats
-        "sharps": ["C", "G", "D", "A", "E", "B", "F#", "C#"],
-        "flats": ["F", "Bb", "Eb", "Ab", "Db", "Gb", "Cb"],
+    # Chord symbols: root note, optional suffix, then an optional bass note after a slash (eg: "Cm7/Bb").
+    # The longest suffixes are tried first, so "m7" is never read as "m" followed by garbage.
+    CHORD_SYMBOL = re.compile(
+        r"(?P<root>[A-G](?:#+|b+)?)(?P<suffix>"
+        + "|".join(re.escape(suffix) for suffix in sorted(CHORD_SUFFIXES, key=len, reverse=True))
+        + r")(?:/(?P<bass>[A-G](?:#+|b+)?))?"
+    )
+
+    # Intervals understood by transpose(): an optional direction, the quality (P == perfect, M == major,
+    # m == minor, A == augmented, d == diminished, repeated up to 3 times for doubly or triply augmented or
+    # diminished intervals) and the number, eg: "M3", "-P4", "A4" or "m10"
+    INTERVAL = re.compile(r"(?P<direction>[+-]?)(?P<quality>P|M|m|A{1,3}|d{1,3})(?P<number>[1-9][0-9]*)")
+
+    # Most accidentals on a note of the precomputed tables (eg: "Fbbbb"). The conversions between note names
+    # and integers are only cached up to it, and transpose() refuses notes or results with more, so each
+    # accidental of an unusual input can't add one to every note of a large response.
+    MAX_ACCIDENTALS = 4
+
+    # Maximum number of entries in each of the internal caches below, so unusual inputs
+    # can't make them grow forever
+    CACHE_LIMIT = 4096
+
+    # Scale definitions, by scale type. Each degree is written as an interval above the tonic, the
+    # usual way: the degree number (1 to 7) with the accidentals that alter it from the major scale,
+    # eg: "b3" is a minor third and "#4" an augmented fourth. The degree number chooses the letter of
+    # the note, so the spelling of every scale, its diatonic chords and its roman numerals are all
+    # derived from these definitions (see _get_scale_type()).
+    # Melodic minor should in theory use different intervals when going down the scale, this has not
+    # been implemented.
+    SCALE_DEFINITIONS = {
+        "major": ("1", "2", "3", "4", "5", "6", "7"),
+        "natural minor": ("1", "2", "b3", "4", "5", "b6", "b7"),
+        "harmonic minor": ("1", "2", "b3", "4", "5", "b6", "7"),
+        "melodic minor": ("1", "2", "b3", "4", "5", "6", "7"),
+        "dorian": ("1", "2", "b3", "4", "5", "6", "b7"),
+        "phrygian": ("1", "b2", "b3", "4", "5", "b6", "b7"),
+        "lydian": ("1", "2", "3", "#4", "5", "6", "7"),
+        "mixolydian": ("1", "2", "3", "4", "5", "6", "b7"),
+        "locrian": ("1", "b2", "b3", "4", "b5", "b6", "b7"),
+        "major pentatonic": ("1", "2", "3", "5", "6"),
+        "minor pentatonic": ("1", "b3", "4", "5", "b7"),
+        "blues": ("1", "b3", "4", "b5", "5", "b7"),
+        "whole tone": ("1", "2", "3", "#4", "#5", "#6"),
+        # Symmetric scales with eight notes, so one letter is used twice
+        "whole-half diminished": ("1", "2", "b3", "4", "b5", "b6", "6", "7"),
+        "half-whole diminished": ("1", "b2", "#2", "3", "#4", "5", "6", "b7"),
     }
 
-    # List of minor key signatures, grouped by whether they use sharps or flats.
-    # Note: harmonic minor and melodic minor have some exceptions.
-    MINOR_SCALES = {
-        # "A" is included here just to have a default value, even if it has no sharps not flats
-        "sharps": ["A", "E", "B", "F#", "C#", "G#", "D#", "A#"],
-        "flats": ["D", "G", "C", "F", "Bb", "Eb", "Ab"],
+    # Scale types that are only other names of another scale type
+    SCALE_ALIASES = {
+        "minor": "natural minor",
+        "ionian": "major",
+        "aeolian": "natural minor",
+        "diminished": "whole-half diminished",
     }
 
-    # Chord qualities for each degree, by scale type.
+    # The list of supported scales, aliases included
+    SUPPORTED_SCALES = list(SCALE_DEFINITIONS) + list(SCALE_ALIASES)
+
+    # Diatonic triads, by order of preference when a degree could support more than one of them.
     # "M" == major chord, "m" == minor chord, "o" == diminished chord, "+" == augmented chord
-    #
-    # For each element, the first list contains our internal symbols and the second
-    # list contains the human readable version, ready to display
-    SCALE_CHORD_QUALITIES = {
-        "major": [
-            ["M", "m", "m", "M", "M", "m", "o"],
-            ["I", "ii", "iii", "IV", "V", "vi", "viio"],
-        ],
-        "natural minor": [
-            ["m", "o", "M", "m", "m", "M", "M"],
-            ["i", "iio", "III", "iv", "v", "VI", "VII"],
-        ],
-        "harmonic minor": [
-            ["m", "o", "+", "m", "M", "M", "o"],
-            ["i", "iio", "III+", "iv", "V", "VI", "viio"],
-        ],
-        "melodic minor": [
-            ["m", "m", "+", "M", "M", "o", "o"],
-            ["i", "ii", "III+", "IV", "V", "vio", "viio"],
-        ],
-    }
+    TRIAD_QUALITIES = ["M", "m", "o", "+"]
 
-    # The list of supported scales
-    SUPPORTED_SCALES = [
-        "major",
-        "minor",  # Alias for natural minor
-        "natural minor",
-        "harmonic minor",
-        "melodic minor",
-    ]
-
-    # Intervals for all the supported scales, in number of half steps (1 == half-step, 2 == whole step)
-    # Harmonic minor has a 3 half-steps interval, this is not a typo. Melodic minor should in theory
-    # use different intervals when going down the scale, this has not been implemented.
-    INTERVALS = {
-        "major": [2, 2, 1, 2, 2, 2, 1],
-        "natural minor": [2, 1, 2, 2, 1, 2, 2],
-        "harmonic minor": [2, 1, 2, 2, 1, 3, 1],
-        "melodic minor": [2, 1, 2, 2, 2, 2, 1],
-    }
+    # Degrees in the scale definitions, eg: "b3" or "#4"
+    DEGREE = re.compile(r"(?P<accidentals>#*|b*)(?P<number>[1-7])")
+
+    # Accidentals and chord suffixes tried when enumerating every valid input in build_tables()
+    TABLE_ACCIDENTALS = ["", "#", "b", "##", "bb"]
+    TABLE_CHORD_SUFFIXES = list(CHORD_SUFFIXES)
+
+    # Precomputed answers, keyed by the arguments of the public methods. This stays None until
+    # build_tables() is called, in which case every call computes its answer from scratch.
+    _tables: Dict[str, MappingProxyType] | None = None
+
+    # Theory atlas answering the same lookups as the tables, from a file mapped in memory (see use_atlas())
+    _atlas = None
 
     @classmethod
-    def _get_enharmonic_note(cls, note: str, expected_note: str | None) -> str:
-        if note in cls.ENHARMONIC_NOTES:
-            if expected_note:
-                for n in cls.ENHARMONIC_NOTES[note]:
-                    if n[0] == expected_note:
-                        return n
-            else:
-                return cls.ENHARMONIC_NOTES[note][0]
+    def get_table_tonics(cls) -> List[str]:
+        # Every tonic (or chord root) covered by the precomputed tables
+        return [letter + accidental for letter in cls.LETTERS for accidental in cls.TABLE_ACCIDENTALS]
 
-        if expected_note:
-            raise ValueError(
-                f"Unable to find enharmonic equivalent for {note} (trying to find {expected_note}"
-            )
-        else:
-            raise ValueError(f"Unable to find enharmonic equivalent for {note}")
+    @classmethod
+    def get_table_chords(cls) -> List[str]:
+        # Every chord name covered by the precomputed tables
+        return [tonic + suffix for tonic in cls.get_table_tonics() for suffix in cls.TABLE_CHORD_SUFFIXES]
 
     @classmethod
-    def _get_next_expected_note(cls, note: str) -> str:
-        # Find the next expected note name, looping back to "A" after "G"
-        original_note = note
+    def build_tables(cls, snapshot: str | None = None) -> bool:
+        # The domain is small and closed: a few dozen tonics, the supported scales and the chord
+        # suffixes. Compute every valid answer once and store it in immutable dicts of tuples.
+        # Inputs that are not in the tables (including invalid ones) still go through the regular
+        # code path, so they raise the exact same ValueErrors as before.
+        # The indexes of get_scales_containing() and identify_chord() are built at the same time.
+        #
+        # With a snapshot path, the tables are loaded from that file when it was saved by the same
+        # version of this file (and of Python), which is much faster than computing them. Otherwise
+        # they are computed and saved to that file, for the next time. Return True if loaded.
+        if snapshot and cls._load_snapshot(snapshot):
+            return True
+
+        cls._tables = None
+
+        scales: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+        diatonic_chords: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+        chord_notes: Dict[str, Tuple[str, ...]] = {}
 
-        if not 65 <= ord(original_note[0].upper()) <= 71:
-            raise ValueError("Invalid note")
+        for tonic in cls.get_table_tonics():
+            for scale in cls.SUPPORTED_SCALES:
+                try:
+                    scales[(tonic, scale)] = tuple(cls.get_scale(tonic, scale))
+                    diatonic_chords[(tonic, scale)] = tuple(cls.get_diatonic_chords(tonic, scale))
+                except ValueError:
+                    continue
 
-        note = chr(ord(original_note[0].upper()) + 1)
-        if note == "H":
-            note = "A"
+        for chord in cls.get_table_chords():
+            try:
+                chord_notes[chord] = tuple(cls.get_chord_notes(chord))
+            except ValueError:
+                continue
 
-        return note
+        cls._set_tables({
+            "scales": scales,
+            "diatonic_chords": diatonic_chords,
+            "chord_notes": chord_notes,
+            "scales_index": cls._build_scales_index(),
+            "chords_index": cls._build_chords_index(),
+        })
+
+        if snapshot:
+            cls._save_snapshot(snapshot)
+        return False
 
     @classmethod
-    def _get_intervals(cls, type: str) -> List[int]:
-        if type not in cls.SUPPORTED_SCALES:
-            raise ValueError("Unsupported scale type")
+    def _set_tables(cls, tables: Dict[str, Dict]) -> None:
+        cls._tables = {
+            "scales": MappingProxyType(tables["scales"]),
+            "diatonic_chords": MappingProxyType(tables["diatonic_chords"]),
+            "chord_notes": MappingProxyType(tables["chord_notes"]),
+        }
+        cls._scales_index = tables["scales_index"]
+        cls._chords_index = tables["chords_index"]
 
-        if type == "minor":
-            # "minor" is an alias for "natural minor"
-            type = "natural minor"
+    @classmethod
+    def _snapshot_key(cls) -> Tuple:
+        # A snapshot is only valid for the exact source code that computed it, and the marshal
+        # format depends on the version of Python
+        with open(__file__, "rb") as f:
+            source_hash = hashlib.sha256(f.read()).hexdigest()
+        return (cls.VERSION, source_hash, tuple(sys.version_info[:2]))
 
-        return cls.INTERVALS[type]
+    @classmethod
+    def _save_snapshot(cls, path: str) -> None:
+        # Written atomically, since several processes may start at the same time. The snapshot is
+        # an optimization only: failing to write it (eg: read-only file system) is not an error.
+        data = {name: dict(table) for name, table in cls._tables.items()}
+        data["scales_index"] = cls._scales_index
+        data["chords_index"] = cls._chords_index
+        try:
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                marshal.dump((cls._snapshot_key(), data), f)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        except OSError:
+            pass
 
     @classmethod
-    def _get_note_position(cls, note: str, scale: List[str]) -> int:
-        for i in range(len(scale)):
-            if scale[i] == note:
-                return i
-        return -1
+    def _load_snapshot(cls, path: str) -> bool:
+        # Return False if the snapshot is missing, unreadable or stale
+        try:
+            with open(path, "rb") as f:
+                key, data = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if key != cls._snapshot_key():
+            return False
+        cls._set_tables(data)
+        return True
 
     @classmethod
-    def get_scale(cls, tonic: str, scale="major") -> List[str]:
-        if scale not in cls.SUPPORTED_SCALES:
-            raise ValueError("Unsupported scale")
+    def use_atlas(cls, path: str) -> bool:
+        # Answer get_scale, get_diatonic_chords and get_chord_notes from a theory atlas (see theory_atlas.py):
+        # a binary file mapped in memory, shared by every process using it, instead of tables in each
+        # process. The atlas is built first when it is missing, or was written by another version of this
+        # file. Return True if an existing atlas was used. The precomputed tables, if any, are discarded.
+        from theory_atlas import Theory_Atlas, build_atlas  # Only needed with an atlas
 
-        if scale == "minor":
-            # "minor" is an alias for "natural minor"
-            scale = "natural minor"
+        cls.clear_tables()
+        atlas = Theory_Atlas.open(path)
+        if atlas is not None:
+            cls._atlas = atlas
+            return True
 
-        # Pick the correct chromatic scale, with flats or sharps
-        # Note: some scales (eg: "D") use sharps in major and flats in minor, so
-        # we have to make a distinction here
-        if scale == "major":
-            if tonic in cls.MAJOR_SCALES["sharps"] or tonic.endswith("#"):
-                chromatic_scale = cls.CHROMATIC_SCALE["sharps"]
-            else:
-                chromatic_scale = cls.CHROMATIC_SCALE["flats"]
+        build_atlas(path)
+        cls._atlas = Theory_Atlas.open(path)
+        return False
+
+    @classmethod
+    def clear_tables(cls) -> None:
+        # Go back to computing every answer from scratch
+        cls._tables = None
+        if cls._atlas is not None:
+            cls._atlas.close()
+            cls._atlas = None
+
+    @classmethod
+    def _lookup(cls, table: str, key) -> List[str] | None:
+        # Return a (mutable) copy of a precomputed answer, or None if there is none
+        if cls._tables is None:
+            if cls._atlas is not None:
+                return cls._atlas.lookup(table, key)
+            return None
+        found = cls._tables[table].get(key)
+        if found is None:
+            return None
+        return list(found)
+
+    # Caches for the conversions between note names and their integer representation
+    _encoded_notes: Dict[str, int] = {}
+    _decoded_notes: Dict[int, str] = {}
+
+    @classmethod
+    def _encode_note(cls, note: str) -> int:
+        encoded = cls._encoded_notes.get(note)
+        if encoded is not None:
+            return encoded
+
+        letter = cls.LETTERS.find(note[:1]) if note else -1
+        accidentals = note[1:]
+        if letter == -1:
+            raise ValueError(f"Invalid note {note}")
+        if accidentals == "#" * len(accidentals):
+            offset = len(accidentals)
+        elif accidentals == "b" * len(accidentals):
+            offset = -len(accidentals)
         else:
-            if tonic in cls.MINOR_SCALES["sharps"] or tonic.endswith("#"):
-                chromatic_scale = cls.CHROMATIC_SCALE["sharps"]
+            raise ValueError(f"Invalid note {note}")
+
+        encoded = offset * cls.ACCIDENTAL + letter
+        if len(cls._encoded_notes) < cls.CACHE_LIMIT and abs(offset) <= cls.MAX_ACCIDENTALS:
+            cls._encoded_notes[note] = encoded
+        return encoded
+
+    @classmethod
+    def _decode_note(cls, note: int) -> str:
+        decoded = cls._decoded_notes.get(note)
+        if decoded is not None:
+            return decoded
+
+        offset = note >> 3
+        decoded = cls.LETTERS[note & 7] + ("#" * offset if offset > 0 else "b" * -offset)
+        if len(cls._decoded_notes) < cls.CACHE_LIMIT and abs(offset) <= cls.MAX_ACCIDENTALS:
+            cls._decoded_notes[note] = decoded
+        return decoded
+
+    @classmethod
+    def _pitch_class(cls, note: int) -> int:
+        return (cls.NATURAL_PITCH_CLASSES[note & 7] + (note >> 3)) % 12
+
+    @classmethod
+    def _spell(cls, letter: int, pitch_class: int) -> int:
+        # Find the note using the requested letter, with the requested pitch class.
+        # The accidental offset is kept between -6 (flats) and +5 (sharps).
+        offset = (pitch_class - cls.NATURAL_PITCH_CLASSES[letter] + 6) % 12 - 6
+        return offset * cls.ACCIDENTAL + letter
+
+    @classmethod
+    def _add_interval(cls, note: int, letters: int, half_steps: int) -> int:
+        # Move a note up (or down, when negative) by a number of letters and half steps, keeping the correct
+        # spelling. The accidentals are the half steps left over once the letters have moved, counted without
+        # reducing them to a pitch class, so this works for any number of accidentals (eg: "B#####" up a
+        # minor second is "C######").
+        letter = (note & 7) + letters
+        natural_half_steps = cls.NATURAL_PITCH_CLASSES[letter % 7] + 12 * (letter // 7) - cls.NATURAL_PITCH_CLASSES[note & 7]
+        return ((note >> 3) + half_steps - natural_half_steps) * cls.ACCIDENTAL + letter % 7
+
+    @classmethod
+    def _get_enharmonic_note(cls, note: str, expected_note: str | None) -> str:
+        encoded = cls._encode_note(note)
+        pitch_class = cls._pitch_class(encoded)
+
+        if expected_note:
+            letter = cls.LETTERS.find(expected_note[:1])
+            if letter == -1 or len(expected_note) != 1:
+                raise ValueError(
+                    f"Unable to find enharmonic equivalent for {note} (trying to find {expected_note}"
+                )
+            return cls._decode_note(cls._spell(letter, pitch_class))
+
+        # Without an expected note, use the equivalent with the fewest accidentals (on another letter),
+        # preferring sharps over flats
+        candidates = [
+            cls._spell(letter, pitch_class) for letter in range(len(cls.LETTERS)) if letter != encoded & 7
+        ]
+        return cls._decode_note(min(candidates, key=lambda n: (abs(n >> 3), n >> 3 < 0)))
+
+    # Everything derived from the definition of each scale type, computed on first use (see below)
+    _scale_types: Dict[str, Tuple[Tuple[Tuple[int, int], ...], Tuple[Tuple[int, str], ...], Tuple[str, ...]]] = {}
+
+    @classmethod
+    def _get_scale_type(cls, scale: str) -> Tuple[Tuple[Tuple[int, int], ...], Tuple[Tuple[int, str], ...], Tuple[str, ...]]:
+        # Derive everything about a scale type from its definition in SCALE_DEFINITIONS, only once:
+        #   - the steps of each degree, as tuples (number of letters, number of half steps) above the
+        #     tonic, ending with the octave
+        #   - the diatonic triads, as tuples (position of the degree, quality). A triad is diatonic when
+        #     its third and its fifth are in the scale, possibly spelled differently (eg: "C" for "B#").
+        #     Degrees without any diatonic triad (eg: in the pentatonic scales) are skipped.
+        #   - the roman numeral of each diatonic triad. When two degrees share the same number (in the
+        #     scales with eight notes), their numerals keep the accidentals, eg: "bvio" and "vio".
+        # Adding more scale types therefore costs nothing once each of them has been used.
+        derived = cls._scale_types.get(scale)
+        if derived is not None:
+            return derived
+
+        definition = cls.SCALE_DEFINITIONS.get(cls.SCALE_ALIASES.get(scale, scale))
+        if definition is None:
+            raise ValueError("Unsupported scale")
+
+        steps = []
+        for degree in definition:
+            match = cls.DEGREE.fullmatch(degree)
+            letters = int(match.group("number")) - 1
+            accidentals = match.group("accidentals")
+            offset = len(accidentals) if accidentals.startswith("#") else -len(accidentals)
+            steps.append((letters, cls.NATURAL_PITCH_CLASSES[letters] + offset))
+
+        pitch_classes = {half_steps % 12 for _, half_steps in steps}
+        numbers = [letters for letters, _ in steps]
+
+        chords = []
+        numerals = []
+        for position, (letters, half_steps) in enumerate(steps):
+            for quality in cls.TRIAD_QUALITIES:
+                if all((half_steps + h) % 12 in pitch_classes for _, h in cls.CHORD_INTERVALS[quality][1:]):
+                    break
             else:
-                chromatic_scale = cls.CHROMATIC_SCALE["flats"]
+                continue
 
-        note_position = cls._get_note_position(tonic, chromatic_scale)
-        if note_position == -1:
-            # For the tonic, use the first enharmonic note (regular note, not double-flat nor double-sharp)
-            # as we are using this to find a starting in the chromatic scale
-            temp_tonic = cls._get_enharmonic_note(tonic, None)
-            note_position = cls._get_note_position(temp_tonic, chromatic_scale)
-            if note_position == -1:
-                raise ValueError("Unable to find enharmonic note")
+            numeral = cls.ROMAN_NUMERALS[letters]
+            if quality in ["m", "o"]:
+                numeral = numeral.lower()
+            if quality in ["o", "+"]:
+                numeral += quality
+            if numbers.count(letters) > 1:
+                numeral = cls.DEGREE.fullmatch(definition[position]).group("accidentals") + numeral
 
-        intervals = cls._get_intervals(scale)
+            chords.append((position, quality))
+            numerals.append(numeral)
 
-        # The scale always begins with the tonic
-        notes = [tonic]
+        derived = (tuple(steps) + ((7, 12),), tuple(chords), tuple(numerals))
+        cls._scale_types[scale] = derived
+        return derived
 
-        # Start the loop with previous_note already set to the tonic
-        previous_note = tonic
+    @classmethod
+    def _get_intervals(cls, type: str) -> List[int]:
+        # Number of half steps between each note of a scale type (1 == half-step, 2 == whole step).
+        # eg: "minor" is an alias for "natural minor"
+        steps = cls._get_scale_type(type)[0]
+        return [after - before for (_, before), (_, after) in zip(steps, steps[1:])]
 
-        for interval in intervals:
-            # Move forward by the number of specified half-steps
-            expected_note_name = cls._get_next_expected_note(previous_note)
+    @classmethod
+    def get_scale(cls, tonic: str, scale="major") -> List[str]:
+        found = cls._lookup("scales", (tonic, scale))
+        if found is not None:
+            return found
+
+        # Validate the scale type, then the tonic
+        steps = cls._get_scale_type(scale)[0]
+        tonic_note = cls._encode_note(tonic)
 
-            # Calculate what the next note is supposed to be
-            note_position = (note_position + interval) % len(chromatic_scale)
-            current_note = chromatic_scale[note_position]
+        # The scale always begins with the tonic
+        notes = [tonic_note]
 
-            # Since a scale must contain notes with (non-repeating) consecutive note names,
-            # find the correct enharmonic if the note name doesn't match what we expect.
-            if current_note[0] != expected_note_name:
-                current_note = cls._get_enharmonic_note(current_note, expected_note_name)
-            notes.append(current_note)
-            previous_note = current_note
+        # Each degree uses the letter given by its number in the definition (so the note names of a
+        # seven-note scale never repeat), spelled with the number of half steps of its interval.
+        # This works for any number of accidentals.
+        for letters, half_steps in steps[1:]:
+            notes.append(cls._add_interval(tonic_note, letters, half_steps))
 
-        return notes
+        return [cls._decode_note(n) for n in notes]
 
     @classmethod
     def get_diatonic_chords(cls, tonic: str, variant="major") -> List[str]:
         # Diatonic chords are chords that only use the specific notes from a scale.
-        # For each degree in a scale, use the quality found in the SCALE_CHORD_QUALITIES
-        # dict, based on the scale type. Use the first list, with our internal symbols
+        # The degrees and their qualities are derived from the definition of the scale type.
 
-        if variant not in cls.SUPPORTED_SCALES:
-            raise ValueError("Unsupported scale")
+        found = cls._lookup("diatonic_chords", (tonic, variant))
+        if found is not None:
+            return found
 
-        if variant == "minor":
-            # "minor" is an alias for "natural minor"
-            variant = "natural minor"
+        triads = cls._get_scale_type(variant)[1]
 
         # Empty list to receive the chords (one per degree) as they get prepared
         chords = []
@@ -251,75 +514,586 @@ class Music_Theory:
         # Find all the notes for the requested scale
         notes = cls.get_scale(tonic, variant)
 
-        # For each degree, find the correct chord (with quality) based on the scale type
-        for i in range(len(cls.SCALE_CHORD_QUALITIES[variant][0])):
-            quality = cls.SCALE_CHORD_QUALITIES[variant][0][i]
-
+        # For each degree with a diatonic triad, find the correct chord (with quality)
+        for position, quality in triads:
             if quality == "M":
                 # For Major chords, the "M" should be implicit, so don't include it
-                chord = notes[i]
+                chord = notes[position]
             else:
                 # For every other type of chord, append the quality
-                chord = notes[i] + quality
+                chord = notes[position] + quality
 
             chords.append(chord)
 
         return chords
 
+    # Reverse index used by get_scales_containing(), built on first use. It maps every pitch-class
+    # bitmask (bit N set for pitch class N) to the scales containing at least those pitch classes.
+    # Each scale is a tuple (tonic, scale type, set of its spelled notes, number of accidentals).
+    _scales_index: Dict[int, List[Tuple[str, str, frozenset, int]]] | None = None
+
     @classmethod
-    def get_chord_notes(cls, chord: str) -> List[str]:
-        # Get the *major* scale whose tonic is equal to the root note of the requested chord.
-        # This will be used to identify the third and fifth notes
-
-        # Get the root note from the chord name (ie: remove any quality)
-        root = re.sub(r"(m|o|\+|\-)$", "", chord)
-        major_scale = cls.get_scale(root, "major")
-
-        # Empty list to receive the notes as they get prepared
-        notes = []
-
-        # All chords start with the root note (inversions are not implemented yet)
-        notes.append(root)
-
-        if chord.endswith("m"):
-            # Minor chords have a minor third and perfect fifth
-            notes.append(cls._flatten(major_scale[2]))
-            notes.append(major_scale[4])
-        elif chord.endswith("o") or chord.endswith("-"):
-            # Diminished chords have a minor third and a diminished fifth
-            notes.append(cls._flatten(major_scale[2]))
-            notes.append(cls._flatten(major_scale[4]))
-        elif chord.endswith("+"):
-            # Augmented chords have a major third and augmented fifth
-            notes.append(major_scale[2])
-            notes.append(cls._sharpen(major_scale[4]))
-        else:
-            # Any chord without any suffix is implicitly a Major chord.
-            # Major chords have a major third and perfect fifth
-            notes.append(major_scale[2])
-            notes.append(major_scale[4])
+    def _pitch_class_mask(cls, notes) -> int:
+        mask = 0
+        for note in notes:
+            mask |= 1 << cls._pitch_class(note)
+        return mask
+
+    @classmethod
+    def _build_scales_index(cls) -> Dict[int, List[Tuple[str, str, frozenset, int]]]:
+        # Index every scale for all the usual tonics (no double-sharps nor double-flats), under the
+        # bitmask of its pitch classes and under every subset of that bitmask, so a query is a
+        # single dictionary lookup instead of recomputing every scale.
+        index: Dict[int, List[Tuple[str, str, frozenset, int]]] = {}
+        for scale in cls.SUPPORTED_SCALES:
+            if scale in cls.SCALE_ALIASES:
+                # Don't list the same scale twice
+                continue
+            for letter in cls.LETTERS:
+                for accidental in ["", "#", "b"]:
+                    tonic = letter + accidental
+                    notes = [cls._encode_note(n) for n in cls.get_scale(tonic, scale)]
+                    entry = (tonic, scale, frozenset(notes), sum(abs(n >> 3) for n in notes[:-1]))
+
+                    # Walk through every subset of the bitmask
+                    mask = cls._pitch_class_mask(notes)
+                    subset = mask
+                    while True:
+                        index.setdefault(subset, []).append(entry)
+                        if subset == 0:
+                            break
+                        subset = (subset - 1) & mask
+
+        return index
+
+    @classmethod
+    def get_scales_containing(cls, notes: List[str]) -> List[Tuple[str, str, bool]]:
+        # Find every scale that contains all the requested notes ("what key am I in?").
+        # Returns a list of tuples (tonic, scale type, exact). Scales containing the notes with the
+        # exact same spelling (exact == True) come first, followed by scales that only contain
+        # enharmonic equivalents. Within each group, scales with fewer accidentals come first.
+        if not notes:
+            raise ValueError("No notes")
+
+        encoded = [cls._encode_note(note) for note in notes]
+
+        if cls._scales_index is None:
+            cls._scales_index = cls._build_scales_index()
+
+        matches = []
+        for tonic, scale, spelled, accidentals in cls._scales_index.get(cls._pitch_class_mask(encoded), []):
+            exact = spelled.issuperset(encoded)
+            matches.append((not exact, accidentals, tonic, scale))
+
+        matches.sort(key=lambda match: (match[0], match[1]))
+        return [(tonic, scale, not inexact) for inexact, _, tonic, scale in matches]
+
+    @classmethod
+    def get_roman_numerals(cls, variant="major") -> List[str]:
+        # Human readable roman numerals, one for each chord returned by get_diatonic_chords()
+        return list(cls._get_scale_type(variant)[2])
+
+    # Cache of the compiled chord symbols
+    _compiled_chords: Dict[str, Tuple[int, str, int | None]] = {}
+
+    @classmethod
+    def _parse_chord(cls, chord: str) -> Tuple[int, str, int | None]:
+        # Compile a chord symbol into its root note (integer representation), its quality (key in
+        # CHORD_INTERVALS) and its bass note (integer representation, or None without a slash).
+        # Each symbol is only parsed once.
+        compiled = cls._compiled_chords.get(chord)
+        if compiled is not None:
+            return compiled
+
+        match = cls.CHORD_SYMBOL.fullmatch(chord)
+        if not match:
+            raise ValueError(f"Unsupported chord {chord}")
+
+        bass = match.group("bass")
+        compiled = (
+            cls._encode_note(match.group("root")),
+            cls.CHORD_SUFFIXES[match.group("suffix")],
+            cls._encode_note(bass) if bass else None,
+        )
+        if len(cls._compiled_chords) < cls.CACHE_LIMIT:
+            cls._compiled_chords[chord] = compiled
+        return compiled
+
+    @classmethod
+    def _chord_tones(cls, root_note: int, quality: str, bass_note: int | None) -> List[int]:
+        # Stack the intervals of the chord quality on top of the root note
+        notes = [root_note] + [
+            cls._add_interval(root_note, letters, half_steps)
+            for letters, half_steps in cls.CHORD_INTERVALS[quality][1:]
+        ]
+
+        if bass_note is not None:
+            if bass_note in notes:
+                # Inversion: start with the bass note, keeping the order of the other notes
+                position = notes.index(bass_note)
+                notes = notes[position:] + notes[:position]
+            else:
+                # The bass note is not part of the chord, add it below
+                notes = [bass_note] + notes
 
         return notes
 
+    # Cache of the roman numerals already resolved by get_progression(), keyed by (tonic, variant, numeral)
+    _resolved_numerals: Dict[Tuple[str, str, str], Tuple[str, Tuple[str, ...]]] = {}
+
     @classmethod
-    def _sharpen(cls, note: str) -> str:
-        if note[-1] == "b":
-            # To sharpen a note that already has at least one flat symbol, remove one flat
-            return note[:-1]
+    def _resolve_numeral(cls, tonic: str, variant: str, numeral: str) -> Tuple[str, Tuple[str, ...]]:
+        # Find the diatonic chord (name and notes) for a roman numeral from get_roman_numerals().
+        # The numeral can also be written in uppercase without its quality, eg: "VII" for "viio".
+        key = (tonic, variant, numeral)
+        resolved = cls._resolved_numerals.get(key)
+        if resolved is not None:
+            return resolved
+
+        numerals = cls.get_roman_numerals(variant)
+        bare_numerals = [n.rstrip("o+").upper() for n in numerals]
+        if numeral in numerals:
+            degree = numerals.index(numeral)
+        elif numeral.rstrip("o+").upper() in bare_numerals:
+            degree = bare_numerals.index(numeral.rstrip("o+").upper())
         else:
-            # Add one sharp symbol
-            # Note: this may result in a note with double-sharp, this is expected in some cases
-            return note + "#"
+            raise ValueError(f"Unknown roman numeral {numeral}")
+
+        chord = cls.get_diatonic_chords(tonic, variant)[degree]
+        resolved = (chord, tuple(cls.get_chord_notes(chord)))
+        if len(cls._resolved_numerals) < cls.CACHE_LIMIT:
+            cls._resolved_numerals[key] = resolved
+        return resolved
+
+    @classmethod
+    def get_progression(cls, tonic: str, variant: str, numerals: Iterable[str]) -> Iterator[Tuple[str, str, List[str]]]:
+        # Expand a progression of roman numerals (eg: "I", "vi", "IV", "V") into chords, one at a time.
+        # This is a generator yielding tuples (numeral, chord name, chord notes), so a long progression
+        # never needs to be expanded in memory all at once.
+        for numeral in numerals:
+            chord, notes = cls._resolve_numeral(tonic, variant, numeral)
+            yield numeral, chord, list(notes)
+
+    @classmethod
+    def get_chord_notes(cls, chord: str) -> List[str]:
+        # Return the notes of a chord symbol (eg: "C", "F#m", "Bbmaj7", "Dm7/C"), starting with the bass note
+
+        found = cls._lookup("chord_notes", chord)
+        if found is not None:
+            return found
+
+        return [cls._decode_note(n) for n in cls._chord_tones(*cls._parse_chord(chord))]
+
+    # Index used by identify_chord(), built on first use. It maps the pitch-class bitmask of every
+    # chord (any root, any quality) to the tuples (pitch class of the root, quality) producing it.
+    _chords_index: Dict[int, List[Tuple[int, str]]] | None = None
+
+    @classmethod
+    def _build_chords_index(cls) -> Dict[int, List[Tuple[int, str]]]:
+        index: Dict[int, List[Tuple[int, str]]] = {}
+        for quality, intervals in cls.CHORD_INTERVALS.items():
+            for root in range(12):
+                mask = 0
+                for _, half_steps in intervals:
+                    mask |= 1 << ((root + half_steps) % 12)
+                index.setdefault(mask, []).append((root, quality))
+        return index
+
+    @classmethod
+    def identify_chord(cls, notes: List[str]) -> Tuple[str, int]:
+        # Name the chord formed by some notes, in any order. The first note is the bass note.
+        # Returns a tuple (chord symbol, inversion), where inversion is 0 for root position,
+        # 1 for the first inversion, etc. Inversions use slash chords, eg: "C/E".
+        if not notes:
+            raise ValueError("No notes")
+
+        encoded = [cls._encode_note(note) for note in notes]
+
+        if cls._chords_index is None:
+            cls._chords_index = cls._build_chords_index()
+
+        templates = cls._chords_index.get(cls._pitch_class_mask(encoded))
+        if not templates:
+            raise ValueError("Unable to identify chord")
+
+        # Some chords (eg: augmented or diminished seventh) are symmetric, and match several roots.
+        # Prefer the chord whose notes are spelled exactly like the requested notes, then the chord
+        # whose root is the bass note.
+        bass_note = encoded[0]
+        candidates = []
+        for root_pitch_class, quality in templates:
+            root_note = next(n for n in encoded if cls._pitch_class(n) == root_pitch_class)
+            chord_notes = cls._chord_tones(root_note, quality, None)
+            exact = set(encoded) <= set(chord_notes)
+            candidates.append((not exact, root_note != bass_note, root_note, quality, chord_notes))
+
+        _, _, root_note, quality, chord_notes = min(candidates, key=lambda c: (c[0], c[1]))
+
+        suffix = next(suffix for suffix, q in cls.CHORD_SUFFIXES.items() if q == quality)
+        chord = cls._decode_note(root_note) + suffix
+        inversion = [cls._pitch_class(n) for n in chord_notes].index(cls._pitch_class(bass_note))
+        if inversion:
+            chord += "/" + cls._decode_note(bass_note)
+        return chord, inversion
+
+    # Cache of the notes already voiced by get_voiced_notes(), keyed by (notes, octave)
+    _voiced_notes: Dict[Tuple[Tuple[str, ...], int], Tuple[Dict, ...]] = {}
+
+    @classmethod
+    def get_voiced_notes(cls, notes: List[str], octave=4) -> List[Dict]:
+        # Assign an octave to each note, for the staff and for the playback. The notes go up: the
+        # octave number increases whenever a note letter is lower than the previous one (eg: "B" to "C").
+        # Each note is a dict with the note name, its letter, its accidental, its octave, its key
+        # for VexFlow (eg: "C#/4") and its MIDI number (60 for "C/4").
+        key = (tuple(notes), octave)
+        voiced = cls._voiced_notes.get(key)
+        if voiced is None:
+            voiced_list = []
+            previous_letter = -1
+            for note in notes:
+                encoded = cls._encode_note(note)
+                letter = encoded & 7
+                if letter < previous_letter:
+                    octave += 1
+                voiced_list.append({
+                    "note": note,
+                    "letter": cls.LETTERS[letter],
+                    "accidental": note[1:],
+                    "octave": octave,
+                    "key": f"{note}/{octave}",
+                    "midi": (octave + 1) * 12 + cls.NATURAL_PITCH_CLASSES[letter] + (encoded >> 3),
+                })
+                previous_letter = letter
+            voiced = tuple(voiced_list)
+            if len(cls._voiced_notes) < cls.CACHE_LIMIT:
+                cls._voiced_notes[key] = voiced
+
+        # Callers get their own copy, the cache can't be modified by accident
+        return [dict(n) for n in voiced]
+
+    @classmethod
+    def get_voiced_chords(cls, chords: List[str], octave=4) -> List[List[Dict]]:
+        # Voice a list of chords (see get_voiced_notes). The root notes go up from one chord to the
+        # next, the same way as the notes of a scale, and each chord is voiced from its root note.
+        voiced = []
+        previous_letter = -1
+        for chord in chords:
+            notes = cls.get_chord_notes(chord)
+            letter = cls._encode_note(notes[0]) & 7
+            if letter < previous_letter:
+                octave += 1
+            voiced.append(cls.get_voiced_notes(notes, octave))
+            previous_letter = letter
+        return voiced
+
+    # Caches of voice_progression(): the candidate voicings of each chord, keyed by (chord, low, high), and
+    # the movement between two voicings. A long progression only has a few distinct chords, but each pair
+    # of chords has many pairs of voicings, so the second cache is allowed to grow larger.
+    _chord_voicings: Dict[Tuple[str, int, int], Tuple[Tuple[Tuple[int, ...], Tuple[str, ...]], ...]] = {}
+    _voicing_movements: Dict[Tuple[Tuple[int, ...], Tuple[int, ...]], int] = {}
+    MOVEMENT_CACHE_LIMIT = 65536
+
+    @classmethod
+    def _candidate_voicings(cls, chord: str, low: int, high: int) -> Tuple[Tuple[Tuple[int, ...], Tuple[str, ...]], ...]:
+        # Every close-position voicing of a chord (root position and each inversion, in every octave) with
+        # all its notes between the MIDI numbers low and high, as tuples (MIDI numbers, note names), from
+        # the bottom up. Root positions come first, then the lowest voicings. Slash chords keep their bass
+        # note at the bottom.
+        key = (chord, low, high)
+        candidates = cls._chord_voicings.get(key)
+        if candidates is not None:
+            return candidates
+
+        notes = cls.get_chord_notes(chord)
+        pitch_classes = [cls._pitch_class(cls._encode_note(note)) for note in notes]
+        inversions = [0] if cls._parse_chord(chord)[2] is not None else range(len(notes))
+
+        found = []
+        for inversion in inversions:
+            names = tuple(notes[inversion:] + notes[:inversion])
+            order = pitch_classes[inversion:] + pitch_classes[:inversion]
+            for bottom in range(low + (order[0] - low) % 12, high + 1, 12):
+                # Stack each note on the closest pitch above the previous one
+                midi = [bottom]
+                for pitch_class in order[1:]:
+                    midi.append(midi[-1] + ((pitch_class - midi[-1]) % 12 or 12))
+                if midi[-1] <= high:
+                    found.append((tuple(midi), names))
+
+        if not found:
+            raise ValueError(f"No voicing of {chord} between {low} and {high}")
+        candidates = tuple(found)
+        if len(cls._chord_voicings) < cls.CACHE_LIMIT:
+            cls._chord_voicings[key] = candidates
+        return candidates
+
+    @classmethod
+    def _movement(cls, before: Tuple[int, ...], after: Tuple[int, ...]) -> int:
+        # Number of half steps moved by all the voices, from one voicing to the next. The voices are paired
+        # from the bottom up; when one voicing has more notes, the top voice of the other one is doubled.
+        key = (before, after)
+        movement = cls._voicing_movements.get(key)
+        if movement is None:
+            movement = sum(
+                abs(before[min(i, len(before) - 1)] - after[min(i, len(after) - 1)])
+                for i in range(max(len(before), len(after)))
+            )
+            if len(cls._voicing_movements) < cls.MOVEMENT_CACHE_LIMIT:
+                cls._voicing_movements[key] = movement
+        return movement
+
+    @classmethod
+    def voice_progression(cls, chords: Sequence[str], low=55, high=79) -> List[List[Dict]]:
+        # Voice a progression (eg: the output of get_diatonic_chords) so the voices move as little as
+        # possible: every chord has a few candidate voicings (see _candidate_voicings), and dynamic
+        # programming finds the sequence of voicings with the smallest total movement, in
+        # O(chords * candidates^2). Ties are broken in favour of root positions and lower voicings.
+        # Returns one list of voiced notes (see get_voiced_notes) per chord, from the bottom up.
+        if not chords:
+            return []
+
+        candidates = [cls._candidate_voicings(chord, low, high) for chord in chords]
+
+        # Smallest total movement ending on each candidate of the current chord, and for every chord after
+        # the first one, the best candidate of the previous chord leading to each of its candidates
+        totals = [0] * len(candidates[0])
+        previous_choices: List[List[int]] = []
+        for before, after in zip(candidates, candidates[1:]):
+            choices = []
+            new_totals = []
+            for midi, _ in after:
+                total, best = min((totals[i] + cls._movement(voicing, midi), i) for i, (voicing, _) in enumerate(before))
+                choices.append(best)
+                new_totals.append(total)
+            previous_choices.append(choices)
+            totals = new_totals
+
+        # Walk back from the best last voicing
+        choice = min(range(len(totals)), key=totals.__getitem__)
+        path = [choice]
+        for choices in reversed(previous_choices):
+            choice = choices[choice]
+            path.append(choice)
+        path.reverse()
+
+        voiced = []
+        for options, choice in zip(candidates, path):
+            midi, names = options[choice]
+            voiced.append([cls._voiced_note(name, number) for name, number in zip(names, midi)])
+        return voiced
+
+    @classmethod
+    def _voiced_note(cls, note: str, midi: int) -> Dict:
+        # The voiced note (see get_voiced_notes) for a note name and a MIDI number. The octave follows the
+        # letter, so "B#" is in the octave below "C" with the same MIDI number.
+        encoded = cls._encode_note(note)
+        octave = (midi - cls.NATURAL_PITCH_CLASSES[encoded & 7] - (encoded >> 3)) // 12 - 1
+        return {
+            "note": note,
+            "letter": cls.LETTERS[encoded & 7],
+            "accidental": note[1:],
+            "octave": octave,
+            "key": f"{note}/{octave}",
+            "midi": midi,
+        }
+
+    @classmethod
+    def get_scales_bulk(cls, tonics: Sequence[str], types: str | Sequence[str] = "major", encoded=False) -> List:
+        # Compute many scales at once, using NumPy array arithmetic on the letters and pitch classes
+        # of all the tonics of each scale type. The results are exactly the same as get_scale().
+        # Returns one list of note names per tonic, or one array of encoded notes if encoded==True.
+        import numpy as np  # Only needed by the bulk methods
+
+        tonics = list(tonics)
+        types = [types] * len(tonics) if isinstance(types, str) else list(types)
+        if len(types) != len(tonics):
+            raise ValueError("tonics and types must have the same length")
+
+        for scale in set(types):
+            cls._get_scale_type(scale)
+
+        encoded_tonics = np.array([cls._encode_note(tonic) for tonic in tonics], dtype=np.int64)
+
+        # Group the inputs by scale type, so each group is computed with a single array operation
+        groups: Dict[str, List[int]] = {}
+        for position, scale in enumerate(types):
+            groups.setdefault(cls.SCALE_ALIASES.get(scale, scale), []).append(position)
+
+        results: List = [None] * len(tonics)
+        for scale, positions in groups.items():
+            steps = cls._get_scale_type(scale)[0]
+            letter_steps = np.array([letters for letters, _ in steps])
+            half_steps = np.array([half_steps for _, half_steps in steps])
+
+            group_tonics = encoded_tonics[positions]
+            notes = cls._add_intervals_bulk(group_tonics, letter_steps, half_steps)
+
+            # The scale always begins with the tonic, as it was spelled
+            notes[:, 0] = group_tonics
+
+            cls._store_bulk_results(results, positions, notes, encoded)
+
+        return results
+
+    @classmethod
+    def get_chords_bulk(cls, chords: Sequence[str], encoded=False) -> List:
+        # Compute the notes of many chords at once, using NumPy array arithmetic for each chord quality.
+        # The results are exactly the same as get_chord_notes().
+        # Returns one list of note names per chord, or one array of encoded notes if encoded==True.
+        import numpy as np  # Only needed by the bulk methods
+
+        results: List = [None] * len(chords)
+        groups: Dict[str, Tuple[List[int], List[int]]] = {}
+        for position, chord in enumerate(chords):
+            root_note, quality, bass_note = cls._parse_chord(chord)
+            if bass_note is not None:
+                # Slash chords are rare, compute them one by one
+                notes = np.array(cls._chord_tones(root_note, quality, bass_note), dtype=np.int64)
+                cls._store_bulk_results(results, [position], notes[None, :], encoded)
+                continue
+            positions, roots = groups.setdefault(quality, ([], []))
+            positions.append(position)
+            roots.append(root_note)
+
+        for quality, (positions, roots) in groups.items():
+            letter_steps = np.array([letters for letters, _ in cls.CHORD_INTERVALS[quality]])
+            half_steps = np.array([half_steps for _, half_steps in cls.CHORD_INTERVALS[quality]])
+
+            root_notes = np.array(roots, dtype=np.int64)
+            notes = cls._add_intervals_bulk(root_notes, letter_steps, half_steps)
+
+            # The root note is kept as it was spelled
+            notes[:, 0] = root_notes
+
+            cls._store_bulk_results(results, positions, notes, encoded)
+
+        return results
+
+    @classmethod
+    def _add_intervals_bulk(cls, notes, letter_steps, half_steps):
+        # Same as _add_interval(), for an array of notes (one row per note) and arrays of intervals
+        # (one column per interval)
+        import numpy as np
+
+        natural = np.array(cls.NATURAL_PITCH_CLASSES, dtype=np.int64)
+        letters = (notes & 7)[:, None] + letter_steps
+        natural_half_steps = natural[letters % 7] + 12 * (letters // 7) - natural[notes & 7][:, None]
+        return ((notes >> 3)[:, None] + half_steps - natural_half_steps) * cls.ACCIDENTAL + letters % 7
+
+    @classmethod
+    def _store_bulk_results(cls, results: List, positions: List[int], notes, encoded: bool) -> None:
+        # Copy the rows of a bulk computation to their positions in the results, converting
+        # the notes to strings only once per distinct note
+        import numpy as np  # Only needed by the bulk methods
+
+        if encoded:
+            for position, row in zip(positions, notes):
+                results[position] = row
+            return
+
+        distinct, inverse = np.unique(notes, return_inverse=True)
+        names = np.array([cls._decode_note(int(n)) for n in distinct], dtype=object)
+        for position, row in zip(positions, names[inverse.reshape(notes.shape)].tolist()):
+            results[position] = row
+
+    # Cache of the parsed intervals
+    _compiled_intervals: Dict[str, Tuple[int, int]] = {}
+
+    @classmethod
+    def _parse_interval(cls, interval: str) -> Tuple[int, int]:
+        # Compile an interval (eg: "M3" or "-P4") into a number of letters and a number of half steps,
+        # both negative when going down. Each interval is only parsed once.
+        compiled = cls._compiled_intervals.get(interval)
+        if compiled is not None:
+            return compiled
+
+        match = cls.INTERVAL.fullmatch(interval)
+        if not match:
+            raise ValueError(f"Invalid interval {interval}")
+
+        # Start from the major or perfect interval, found in the major scale
+        letters = int(match.group("number")) - 1
+        half_steps = cls.NATURAL_PITCH_CLASSES[letters % 7] + 12 * (letters // 7)
+        perfect = letters % 7 in [0, 3, 4]
+
+        # Unisons, fourths, fifths and their octaves are perfect, the other intervals are major or minor
+        quality = match.group("quality")
+        if (quality == "P") != perfect and quality[0] not in "Ad":
+            raise ValueError(f"Invalid interval {interval}")
+        if quality == "m":
+            half_steps -= 1
+        elif quality[0] == "A":
+            half_steps += len(quality)
+        elif quality[0] == "d":
+            # Diminished is one half step below perfect, or below minor
+            half_steps -= len(quality) if perfect else len(quality) + 1
+
+        compiled = (-letters, -half_steps) if match.group("direction") == "-" else (letters, half_steps)
+        if len(cls._compiled_intervals) < cls.CACHE_LIMIT:
+            cls._compiled_intervals[interval] = compiled
+        return compiled
+
+    @classmethod
+    def _transpose_note(cls, note: str, letters: int, half_steps: int) -> str:
+        # Transpose a note name, with at most MAX_ACCIDENTALS accidentals before and after
+        if len(note) > cls.MAX_ACCIDENTALS + 1:
+            raise ValueError(f"Too many accidentals in {note}")
+        transposed = cls._add_interval(cls._encode_note(note), letters, half_steps)
+        if abs(transposed >> 3) > cls.MAX_ACCIDENTALS:
+            raise ValueError(f"Too many accidentals in {note} transposed")
+        return cls._decode_note(transposed)
+
+    @classmethod
+    def _transpose_symbol(cls, symbol: str, letters: int, half_steps: int) -> str:
+        # Transpose a note or a chord symbol: the root (and the bass note of a slash chord) moves,
+        # the suffix is kept as written
+        match = cls.CHORD_SYMBOL.fullmatch(symbol)
+        if not match:
+            raise ValueError(f"Unsupported note or chord {symbol}")
+
+        transposed = cls._transpose_note(match.group("root"), letters, half_steps) + match.group("suffix")
+        if match.group("bass"):
+            transposed += "/" + cls._transpose_note(match.group("bass"), letters, half_steps)
+        return transposed
+
+    @classmethod
+    def transpose(cls, items: Sequence[str | Sequence[str]], interval: str) -> List:
+        # Transpose notes or chord symbols (eg: "F#", "Bbm7/Ab") by an interval (eg: "M3" or "-P4"), using
+        # interval arithmetic on the letters and pitch classes, so the spelling stays correct (eg: "E#" up
+        # a major third is "G##"), without computing any scale. Items can also be lists of notes or chord
+        # symbols (eg: one progression per lesson), returned as lists of the same length.
+        # Each distinct note or chord symbol is only transposed once per call.
+        letters, half_steps = cls._parse_interval(interval)
+        transposed: Dict[str, str] = {}
+
+        results = []
+        for item in items:
+            symbols = [item] if isinstance(item, str) else item
+            if not isinstance(symbols, (list, tuple)):
+                raise ValueError("Items must be notes, chord symbols or lists of them")
+            row = []
+            for symbol in symbols:
+                if not isinstance(symbol, str):
+                    raise ValueError("Items must be notes, chord symbols or lists of them")
+                found = transposed.get(symbol)
+                if found is None:
+                    found = transposed[symbol] = cls._transpose_symbol(symbol, letters, half_steps)
+                row.append(found)
+            results.append(row[0] if isinstance(item, str) else row)
+
+        return results
+
+    @classmethod
+    def _sharpen(cls, note: str) -> str:
+        # Raise the accidental offset by one: removes one flat, or adds one sharp
+        # Note: this may result in a note with double-sharp, this is expected in some cases
+        return cls._decode_note(cls._encode_note(note) + cls.ACCIDENTAL)
 
     @classmethod
     def _flatten(cls, note: str) -> str:
-        if note[-1] == "#":
-            # To flatten a note that already has at least one shapr symbol, remove one sharp
-            return note[:-1]
-        else:
-            # Add one flat symbol
-            # Note: this may result in a note with double-flat, this is expected in some cases
-            return note + "b"
+        # Lower the accidental offset by one: removes one sharp, or adds one flat
+        # Note: this may result in a note with double-flat, this is expected in some cases
+        return cls._decode_note(cls._encode_note(note) - cls.ACCIDENTAL)
 
     @classmethod
     def pretty_display(cls, val: str, verbose=False) -> str:
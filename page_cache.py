@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional, only the gzip variants are produced without it
+    brotli = None
+
+
+def compressed_variants(data: bytes) -> Dict[str, bytes]:
+    # The compressed variants of some data, by content-coding, best first.
+    # mtime=0 keeps the gzip output reproducible, so is its hash.
+    variants = {}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data)
+    variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+    return variants
+
+
+def encoded_variants(data: bytes, compress=True) -> Dict[str, Tuple[bytes, str]]:
+    # Every variant of some data, by content-coding ("br", "gzip" and "identity"), best first. Each
+    # variant is a tuple with the body and a strong ETag, derived from the data and the content-coding.
+    digest = hashlib.sha1(data).hexdigest()
+    variants = {}
+    if compress:
+        variants = {encoding: (body, f"{digest}-{encoding}") for encoding, body in compressed_variants(data).items()}
+    variants["identity"] = (data, digest)
+    return variants
+
+
+class Page_Cache:
+    """
+    Cache of the rendered HTML pages, which only depend on the templates.
+
+    Each page is rendered once, then kept as encoded bytes, with its precompressed variants
+    (see encoded_variants()).
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._pages: Dict[str, Dict[str, Tuple[bytes, str]]] = {}
+        self._lock = Lock()
+
+    def get(self, key: str, render: Callable[[], str]) -> Dict[str, Tuple[bytes, str]]:
+        variants = self._pages.get(key)
+        if variants is not None:
+            return variants
+
+        if not self.enabled:
+            # Not worth compressing a page rendered for a single response
+            return encoded_variants(render().encode("utf-8"), compress=False)
+
+        variants = encoded_variants(render().encode("utf-8"))
+        with self._lock:
+            self._pages[key] = variants
+        return variants
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
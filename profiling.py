@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import random
+import time
+from threading import Lock
+from typing import Iterable, List
+
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+
+class Sampling_Profiler:
+    """
+    WSGI middleware profiling a random fraction of the live requests with cProfile.
+
+    The profile covers the whole request lifecycle inside Flask: routing, the view function (including
+    render_template() and the Music_Theory calls), the after_request hooks, and the iteration over the
+    body of streamed responses. Each profile is written to its own .pstats file, named by endpoint and
+    timestamp. When the total size of the directory exceeds max_bytes, the oldest profiles are deleted.
+
+    Only one request is profiled at a time: a sampled request arriving while another one is being
+    profiled (in another thread) is simply not profiled, as cProfile does not support concurrent profilers.
+    """
+
+    def __init__(self, app: Flask, directory: str, rate: float, max_bytes=50 * 1024 * 1024):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.directory = directory
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.rate or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                body = self.wsgi_app(environ, start_response)
+            finally:
+                profile.disable()
+        except BaseException:
+            self._lock.release()
+            raise
+        return _Profiled_Body(self, body, profile, self._endpoint(environ))
+
+    def _endpoint(self, environ) -> str:
+        # The endpoint (eg: "chord") names the file, rather than the URL, which can be anything
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+            return endpoint
+        except HTTPException:
+            return "unmatched"
+
+    def write(self, profile: cProfile.Profile, endpoint: str) -> str:
+        now = time.time()
+        name = f"{endpoint}-{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}" \
+               f"-{int(now * 1e6) % 1000000:06d}-{os.getpid()}.pstats"
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        self.enforce_size_limit()
+        return path
+
+    def enforce_size_limit(self) -> None:
+        # Delete the oldest profiles until the directory fits in max_bytes
+        files = []
+        for path in profile_files(self.directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class _Profiled_Body:
+    """
+    Body of a profiled response. Profiling goes on while the server iterates over the body, which is
+    where streamed responses do their work, and the profile is written when the server closes the body.
+    """
+
+    def __init__(self, profiler: Sampling_Profiler, body: Iterable[bytes], profile: cProfile.Profile, endpoint: str):
+        self.profiler = profiler
+        self.body = body
+        self.profile = profile
+        self.endpoint = endpoint
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self._iterator is None:
+            self._iterator = iter(self.body)
+        self.profile.enable()
+        try:
+            return next(self._iterator)
+        finally:
+            self.profile.disable()
+
+    def close(self) -> None:
+        self.profile.enable()
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.profile.disable()
+            self.profiler._lock.release()
+            self.profiler.write(self.profile, self.endpoint)
+
+
+def profile_files(directory: str, endpoint: str | None = None) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{endpoint or '*'}-*.pstats")))
+
+
+def report(directory: str, top=30, sort="cumulative", endpoint: str | None = None) -> str:
+    # Merge every profile of the directory (or of a single endpoint) into a single report
+    files = profile_files(directory, endpoint)
+    if not files:
+        return f"No profiles found in {directory}\n"
+
+    output = io.StringIO()
+    stats = pstats.Stats(files[0], stream=output)
+    for path in files[1:]:
+        stats.add(path)
+    output.write(f"{len(files)} profiles merged from {directory}\n")
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return output.getvalue()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Hashable, Tuple
+
+
+class Response_Cache:
+    """
+    Bounded in-process LRU cache, used to store the already-encoded bodies of the JSON responses.
+
+    Each entry is keyed by the endpoint and its arguments. The value is either the UTF-8 bytes of
+    the response, or None for inputs that returned a 404 (negative cache), so hot keys skip both
+    the computation and the serialization.
+
+    The cache is limited both by its number of entries and by the total size of the stored bodies.
+    When either limit is reached, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=8 * 1024 * 1024, enabled=True):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, bytes | None] = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, bytes | None]:
+        # Return a tuple (found, body). A body of None is a cached 404.
+        if not self.enabled:
+            return False, None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, body: bytes | None) -> None:
+        if not self.enabled:
+            return
+
+        size = len(body) if body is not None else 0
+        if size > self.max_bytes:
+            # Never cache a body that would flush the whole cache on its own
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._size(self._entries.pop(key))
+            self._entries[key] = body
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "enabled": int(self.enabled),
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    @staticmethod
+    def _size(body: bytes | None) -> int:
+        return len(body) if body is not None else 0
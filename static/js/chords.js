@@ -25,13 +25,14 @@ async function execute_form() {
         chord_name = chord_name + '+';
     }
 
+    // Fetch the voiced notes of the chord (a single call, cached for the next time)
+    let voiced_notes = await get_chord_voicing(chord_name, add_extra_root_note);
+
     // Draw the chord staff
-    let vexnotes_array = await arpeggiate_single_chord_to_vexnotes(chord_name, 4, 'q', add_extra_root_note);
-    draw_arpeggiated_chord_staff(vexnotes_array[0]);
+    draw_arpeggiated_chord_staff(arpeggiate_single_chord_to_vexnotes(chord_name, voiced_notes, 'q', add_extra_root_note));
 
-    // Prepare the notes for the scale and chords, ready for playback
-    let results_array = await arpeggiate_single_chord_to_notes(chord_name, 4, 1/8, add_extra_root_note);
-    playback_notes = results_array[0];
+    // Prepare the notes for the chord, ready for playback
+    playback_notes = arpeggiate_single_chord_to_notes(voiced_notes, 1/8);
 
     // Display the staff and play button
     document.getElementById('results').removeAttribute('hidden');
@@ -1,8 +1,5 @@
 const { Accidental, Annotation, ChordSymbol, Formatter, Renderer, Stave, StaveNote, SymbolModifiers, Voice } = Vex.Flow;
 
-var note_position = { 'C': 1, 'D': 2, 'E': 3, 'F': 4, 'G': 5, 'A': 6, 'B': 7};
-var base_note_values = { 'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11};
-
 var AudioContextFunc = window.AudioContext || window.webkitAudioContext;
 var audioContext = new AudioContextFunc();
 var player = new WebAudioFontPlayer();
@@ -14,7 +11,6 @@ gainPiano.gain.value=0.6;
 
 var bpm = 80;
 var N = 4 * 60 / bpm;
-var pieceDuration = N + 0.25;
 var beatLen = 1 / 8 * N;
 
 var started = false;
@@ -23,6 +19,12 @@ var intervalId;
 var playback_notes = [];
 var playback_chords = [];
 
+// Voicings of the chords we already know about, to avoid asking the backend twice for the same chord
+var chord_voicing_cache = {};
+
+// Accidentals that VexFlow can draw
+var vexflow_accidentals = ['#', '##', 'b', 'bb'];
+
 function piano(pitch, duration) {
     return {
         gain:gainPiano,
@@ -42,6 +44,20 @@ function playPiece(play_notes) {
     }
 }
 
+function piece_duration(play_notes) {
+    // The piece ends when its last note does (eg: the 4 beats of an arpeggiated chord, or the octave of a
+    // 9-note scale), plus a short tail
+    let duration = 0;
+    for (let n = 0; n < play_notes.length; n++) {
+        for (let note of play_notes[n]) {
+            if (note) {
+                duration = Math.max(duration, n * beatLen + note.duration);
+            }
+        }
+    }
+    return duration + 0.25;
+}
+
 function start_stop_playback(play_notes, button_id) {
     if (play_notes.length == 0) {
         console.log('not playing, play_notes list is empty');
@@ -59,10 +75,10 @@ function start_playback(play_notes, button_id) {
         console.log('started already');
     } else {
         started = true;
-        document.getElementById(button_id).src = '/static/images/stop.svg';
+        document.getElementById(button_id).src = stop_image_url;
         startTime = audioContext.currentTime + 0.1;
         playPiece(play_notes);
-        endTime = startTime + pieceDuration;
+        endTime = startTime + piece_duration(play_notes);
         intervalId = setInterval(function () {
             if (audioContext.currentTime > endTime) {
                 stop_playback();
@@ -84,66 +100,69 @@ function stop_playback() {
         for (button_id of ['scale_play_button', 'chords_play_button', 'chord_play_button']) {
             button = document.getElementById(button_id);
             if (button) {
-                button.src = '/static/images/play.svg';
+                button.src = play_image_url;
             }
         }
     }
 }
 
-async function get_chords(scale, type) {
-   let response = await fetch('/diatonic_chords/' + encodeURIComponent(scale) + '/' + encodeURIComponent(type));
-   let chords_json = await response.text();
-   let chords = JSON.parse(chords_json);
+// The backend returns voiced notes: objects with the note name, its letter, its accidental, its octave,
+// its VexFlow key (eg: 'C#/4') and its MIDI number. Nothing needs to be parsed here.
 
-   // Repeat 1st degree at the end, so we get 8 chords instead of 7
-   chords.push(chords[0]);
-   return chords;
-}
+async function get_key(scale, type) {
+    let response = await fetch('/key/' + encodeURIComponent(scale) + '/' + encodeURIComponent(type));
+    let key_json = await response.text();
+    let key = JSON.parse(key_json);
 
-async function get_scale(scale, type) {
-   let response = await fetch('/scale/' + encodeURIComponent(scale) + '/' + encodeURIComponent(type));
-   let notes_json = await response.text();
-   return JSON.parse(notes_json);
+    // Repeat 1st degree at the end, so we get 8 chords instead of 7 (the backend already
+    // returns 8 chord voicings)
+    key.chords.push(key.chords[0]);
+    return key;
 }
 
-async function get_chord(chord, add_extra_root_note) {
-    let response = await fetch('/chord/' + encodeURIComponent(chord));
-    let notes_json = await response.text();
-    let notes = JSON.parse(notes_json);
+async function get_chord_voicing(chord, add_extra_root_note) {
+    if (!(chord in chord_voicing_cache)) {
+        let response = await fetch('/voicing/' + encodeURIComponent(chord));
+        let voicing_json = await response.text();
+        chord_voicing_cache[chord] = JSON.parse(voicing_json).voicing;
+    }
 
+    // The voicing ends with an extra root note (one octave higher), only keep it if requested
+    let voicing = chord_voicing_cache[chord];
     if (add_extra_root_note) {
-        notes.push(notes[0]);
+        return voicing;
     }
-    return notes;
+    return voicing.slice(0, -1);
 }
 
-function convert_individual_notes_to_vexnotes(notes, octave, duration) {
-    let vexnotes = [];
-    let previous_note_position = 0;
+function playback_pitch(voiced_note) {
+    // WebAudioFont uses MIDI numbers. The playback has always been one octave below the staff.
+    return voiced_note.midi - 12;
+}
 
-    for (let note of notes) {
-        let note_first_char = note.charAt(0);
-        let current_note_position = note_position[note_first_char];
+function add_accidental(vexnote, voiced_note, index, measure_accidentals) {
+    // An accidental lasts until the end of the measure, so a natural note following an altered note on the
+    // same letter (eg: 'G' after 'Gb' in the blues scales) needs a natural sign
+    let previous_accidental = measure_accidentals[voiced_note.letter];
+    if (vexflow_accidentals.includes(voiced_note.accidental)) {
+        vexnote.addModifier(new Accidental(voiced_note.accidental), index);
+    } else if (voiced_note.accidental == '' && previous_accidental) {
+        vexnote.addModifier(new Accidental('n'), index);
+    }
+    measure_accidentals[voiced_note.letter] = voiced_note.accidental;
+}
 
-        if (current_note_position < previous_note_position) {
-            octave++;
-        }
+function convert_individual_notes_to_vexnotes(voiced_notes, duration) {
+    let vexnotes = [];
+    let measure_accidentals = {};
 
-        let vexnote = new StaveNote({ keys: [note + '/' + octave.toString()], duration: duration});
-        let modifier = new ChordSymbol().setFontSize(14).setVertical('bottom').addText(note_first_char);
-
-        if (note.endsWith('##')) {
-            vexnote.addModifier(new Accidental('##'));
-            modifier.addGlyph('#').addGlyph('#');
-        } else if (note.endsWith('#')) {
-            vexnote.addModifier(new Accidental('#'));
-            modifier.addGlyph('#');
-        } else if (note.endsWith('bb')) {
-            vexnote.addModifier(new Accidental('bb'));
-            modifier.addGlyph('b').addGlyph('b');
-        } else if (note.endsWith('b')) {
-            vexnote.addModifier(new Accidental('b'));
-            modifier.addGlyph('b');
+    for (let voiced_note of voiced_notes) {
+        let vexnote = new StaveNote({ keys: [voiced_note.key], duration: duration});
+        let modifier = new ChordSymbol().setFontSize(14).setVertical('bottom').addText(voiced_note.letter);
+
+        add_accidental(vexnote, voiced_note, 0, measure_accidentals);
+        for (let glyph of voiced_note.accidental) {
+            modifier.addGlyph(glyph);
         }
 
         // Center the modifier on the note
@@ -151,68 +170,29 @@ function convert_individual_notes_to_vexnotes(notes, octave, duration) {
 
         vexnote.addModifier(modifier);
         vexnotes.push(vexnote);
-        previous_note_position = current_note_position;
     }
 
-    // Return our notes and the final octave we reached
-    return [vexnotes, octave];
+    return vexnotes;
 }
 
-async function convert_chords_to_vexnotes(chords, octave, duration, add_extra_root_note) {
+function convert_chords_to_vexnotes(chords, chord_voicings, duration) {
     let vexchords = [];
-    let previous_root_note_position = 0;
+    let measure_accidentals = {};
 
-    for (single_chord of chords) {
-        let current_root_note_position = note_position[single_chord.charAt(0)];
-        if (current_root_note_position < previous_root_note_position) {
-            octave++;
-        }
-    
-        let results_array = await convert_single_chord_to_vexnotes(single_chord, octave, duration, add_extra_root_note);
-        octave = results_array[1];
-        
-        // Add the completed chord to our vexchords array
-        vexchords.push(results_array[0]);   
-        previous_root_note_position = current_root_note_position;
+    for (let i = 0; i < chords.length; i++) {
+        vexchords.push(convert_single_chord_to_vexnotes(chords[i], chord_voicings[i], duration, measure_accidentals));
     }
 
-    // Return our chords and the final (root note) octave we reached
-    return [vexchords, octave];
+    return vexchords;
 }
 
-async function convert_single_chord_to_vexnotes(chord, octave, duration, add_extra_root_note) {
-    let notes = await get_chord(chord, add_extra_root_note);
-    let previous_note_position = 0;
-    let this_chord_notes = [];
-    let note_octave = octave;
-
-    for (note of notes) {
-        let note_first_char = note.charAt(0);
-        let current_note_position = note_position[note_first_char];
-
-        if (current_note_position < previous_note_position) {
-            note_octave++;
-        }
-
-        let this_note_name = note + '/' + note_octave.toString();
-        this_chord_notes.push(this_note_name);
-        previous_note_position = current_note_position;
-    }
-    this_chord = new StaveNote({ keys: this_chord_notes, duration: duration});
+function convert_single_chord_to_vexnotes(chord, voiced_notes, duration, measure_accidentals = {}) {
+    let this_chord = new StaveNote({ keys: voiced_notes.map(n => n.key), duration: duration});
     let modifier = new ChordSymbol().setFontSize(14).setVertical('bottom').addText(chord.charAt(0));
 
     // Add accidentals using the note index
-    for (idx in notes) {
-        i = parseInt(idx);
-        if (notes[idx].endsWith('##')) {
-            this_chord.addModifier(new Accidental('##'), i);
-        } else if (notes[idx].endsWith('#')) {
-            this_chord.addModifier(new Accidental('#'), i);
-        } else if (notes[idx].endsWith('bb')) {
-            this_chord.addModifier(new Accidental('bb'), i);
-        } else if (notes[idx].endsWith('b')) {
-            this_chord.addModifier(new Accidental('b'), i);
-        }
+    for (let i = 0; i < voiced_notes.length; i++) {
+        add_accidental(this_chord, voiced_notes[i], i, measure_accidentals);
     }
 
     if (chord.includes('##')) {
@@ -240,130 +220,49 @@ async function convert_single_chord_to_vexnotes(chord, octave, duration, add_ext
     // Apply an annotation to this chord
     this_chord.addModifier(modifier);
 
-    return [this_chord, octave];
+    return this_chord;
 }
 
-async function arpeggiate_single_chord_to_vexnotes(chord, octave, duration, add_extra_root_note) {
+function arpeggiate_single_chord_to_vexnotes(chord, voiced_notes, duration, add_extra_root_note) {
     let vexnotes = [];
 
-    // Fetch the chord notes
-    let chord_notes = await get_chord(chord, add_extra_root_note);
-
     if (!add_extra_root_note) {
         // HACK: Start with a quarter rest, otherwise out results would only provide 7 beats instead of 8
         let qrest = new StaveNote({ keys: ['B/4'], duration: 'qr'});
         vexnotes.push(qrest);
     }
 
-    // Prepare three individual notes and add them to our array
-    let individual_vexnotes_array = convert_individual_notes_to_vexnotes(chord_notes, octave, duration);
-    for (vexnote of individual_vexnotes_array[0]) {
+    // Prepare the individual notes and add them to our array
+    for (let vexnote of convert_individual_notes_to_vexnotes(voiced_notes, duration)) {
         vexnotes.push(vexnote);
     }
 
     // Now prepare the complete chord and add it to our array
     // HACK: Hardcode a whole note duration for the chord (4 beats)
-    let chord_vexnotes_array = await convert_single_chord_to_vexnotes(chord, octave, 'w', add_extra_root_note);
-    vexnotes.push(chord_vexnotes_array[0]);
+    vexnotes.push(convert_single_chord_to_vexnotes(chord, voiced_notes, 'w'));
 
-    return [vexnotes, octave];
+    return vexnotes;
 }
 
-function prepare_individual_notes(scale) {
-    let octave = 4;
-    let new_notes = [];
-    let duration = 1/8;
-    let previous_note_position = 0;
-
-    for (idx in scale) {
-        note_first_char = scale[idx].charAt(0);
-        current_note_position = note_position[note_first_char];
-
-        if (current_note_position < previous_note_position) {
-            octave++;
-        }
-
-        let new_note_list = [piano(note_value(scale[idx], octave), duration)];
-        new_notes.push(new_note_list);
-        previous_note_position = current_note_position;
-    }
-    return new_notes;
+function prepare_individual_notes(voiced_notes, duration) {
+    return voiced_notes.map(n => [piano(playback_pitch(n), duration)]);
 }
 
-async function prepare_chords_notes(chords, add_extra_root_note) {
-    let octave = 4;
-    let new_notes = [];
-    let duration = 1/8;
-    let previous_root_note_position = 0;
-
-    for (chord of chords) {
-        let current_root_note_position = note_position[chord.charAt(0)];
-        if (current_root_note_position < previous_root_note_position) {
-            octave++;
-        }
-        let chord_notes_array = await prepare_single_chord_notes(chord, octave, duration, add_extra_root_note);
-        previous_root_note_position = current_root_note_position;
-        new_notes.push(chord_notes_array[0]);
-    }
-
-    return new_notes;
+function prepare_chords_notes(chord_voicings, duration) {
+    return chord_voicings.map(voiced_notes => prepare_single_chord_notes(voiced_notes, duration));
 }
 
-async function prepare_single_chord_notes(chord, octave, duration, add_extra_root_note) {
-    let notes = await get_chord(chord, add_extra_root_note);
-    let previous_note_position = 0;
-    let this_chord_notes = [];
-
-    for (note of notes) {
-        let note_first_char = note.charAt(0);
-        let current_note_position = note_position[note_first_char];
-
-        if (current_note_position < previous_note_position) {
-            octave++;
-        }
-
-        let this_note = piano(note_value(note, octave), duration);
-        this_chord_notes.push(this_note);
-        previous_note_position = current_note_position;
-    }
-
-    return [this_chord_notes, octave];
+function prepare_single_chord_notes(voiced_notes, duration) {
+    return voiced_notes.map(n => piano(playback_pitch(n), duration));
 }
 
-async function arpeggiate_single_chord_to_notes(chord, octave, duration, add_extra_root_note) {
-    let new_notes = [];
-
-    // Fetch the chord notes
-    let chord_notes = await get_chord(chord, add_extra_root_note);
-
-    // First prepare three individual notes and add them to our array
-    let individual_notes = prepare_individual_notes(chord_notes, octave, duration);
-    for (note of individual_notes) {
-        new_notes.push(note);
-    }
+function arpeggiate_single_chord_to_notes(voiced_notes, duration) {
+    // First prepare the individual notes
+    let new_notes = prepare_individual_notes(voiced_notes, duration);
 
     // Now prepare the complete chord and add it to our array
     // HACK: Make the chord 4 beats, to match what we will be displaying
-    let chord_notes_array = await prepare_single_chord_notes(chord, octave, duration * 4, add_extra_root_note);
-    new_notes.push(chord_notes_array[0]);
-
-    return [new_notes, octave];    
-}
+    new_notes.push(prepare_single_chord_notes(voiced_notes, duration * 4));
 
-function note_value(note, octave) {
-    note_name = note.charAt(0);
-    note_offset = 0;
-
-    if (note.endsWith('##')) {
-        note_offset = 2;
-    } else if (note.endsWith('#')) {
-        note_offset = 1;
-    } else if (note.endsWith('bb')) {
-        note_offset = -2;
-    } else if (note.endsWith('b')) {
-        note_offset = -1;
-    }
-
-    numeric_value = (octave * 12) + base_note_values[note_name] + note_offset;
-    return numeric_value;
+    return new_notes;
 }
@@ -93,22 +93,21 @@ async function execute_form() {
         return;
     }
 
+    // Fetch the scale, the chords and their voiced notes in a single call
+    let key = await get_key(scale_select.value, type_select.value);
+
     // Highlight the cells in the Circle of Fifths (do not process the tonic twice)
-    let chords = await get_chords(scale_select.value, type_select.value);
-    highlight_cells(chords.slice(0, -1));
+    highlight_cells(key.chords.slice(0, -1));
 
     // Draw the scale staff
-    let scale = await get_scale(scale_select.value, type_select.value);
-    let vexnotes_array = convert_individual_notes_to_vexnotes(scale, 4, 'q');
-    draw_scale_staff(vexnotes_array[0]);
+    draw_scale_staff(convert_individual_notes_to_vexnotes(key.scale_voicing, 'q'));
 
-    // Draw the chords staff (reuse the chords we got for the circle above)
-    let vexchords_array = await convert_chords_to_vexnotes(chords, 4, 'q', false);
-    draw_chords_staff(vexchords_array[0]);
+    // Draw the chords staff
+    draw_chords_staff(convert_chords_to_vexnotes(key.chords, key.chord_voicings, 'q'));
 
     // Prepare the notes for the scale and chords, ready for playback
-    playback_notes = prepare_individual_notes(scale);
-    playback_chords = await prepare_chords_notes(chords, false);
+    playback_notes = prepare_individual_notes(key.scale_voicing, 1/8);
+    playback_chords = prepare_chords_notes(key.chord_voicings, 1/8);
 
     // Display the scale and chords play buttons
     document.getElementById('results').removeAttribute('hidden');
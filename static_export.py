@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from typing import List
+from urllib.parse import quote
+
+from flask import Flask
+
+from assets import COMPRESSED_EXTENSIONS, Assets
+from music_theory import Music_Theory
+from page_cache import compressed_variants
+
+
+def export_urls() -> List[str]:
+    # Every page, and every URL of the AJAX routes for the tonics, scales and chords
+    # covered by the precomputed tables. The input space of those routes is finite.
+    urls = ["/", "/chords", "/about"]
+    for tonic in Music_Theory.get_table_tonics():
+        for scale in Music_Theory.SUPPORTED_SCALES:
+            urls.append(f"/scale/{tonic}/{scale}")
+            urls.append(f"/diatonic_chords/{tonic}/{scale}")
+            urls.append(f"/key/{tonic}/{scale}")
+    for chord in Music_Theory.get_table_chords():
+        urls.append(f"/chord/{chord}")
+        urls.append(f"/voicing/{chord}")
+    return urls
+
+
+def export_path(url: str, content_type: str) -> str:
+    # The directory tree mirrors the URL layout. Pages get a ".html" extension (so the web server
+    # can find them with "try_files $uri $uri.html") and the JSON responses are stored as-is.
+    if url == "/":
+        return "index.html"
+    if content_type.startswith("text/html"):
+        return url.lstrip("/") + ".html"
+    return url.lstrip("/")
+
+
+def write_file(directory: str, path: str, data: bytes) -> int:
+    # Write one file, with its precompressed variants. Return the number of files written.
+    full_path = os.path.join(directory, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as f:
+        f.write(data)
+    return 1 + write_compressed(full_path, data)
+
+
+def write_compressed(full_path: str, data: bytes) -> int:
+    # The JSON responses are stored without any extension
+    extension = os.path.splitext(full_path)[1]
+    if extension and extension not in COMPRESSED_EXTENSIONS:
+        return 0
+
+    variants = compressed_variants(data)
+    for encoding, body in variants.items():
+        with open(full_path + (".gz" if encoding == "gzip" else ".br"), "wb") as f:
+            f.write(body)
+    return len(variants)
+
+
+def export_site(app: Flask, directory: str, assets: Assets | None = None) -> int:
+    # Render every page, JSON response and fingerprinted asset through the test client, so the files are
+    # exactly what the application would have served, then copy the static files (still used by pages
+    # cached before the assets were fingerprinted). Return the number of files written.
+    count = 0
+    client = app.test_client()
+
+    urls = export_urls()
+    if assets is not None:
+        urls += list(assets.urls().values())
+    for url in urls:
+        response = client.get(quote(url, safe="/"))
+        if response.status_code != 200:
+            continue
+        count += write_file(directory, export_path(url, response.content_type), response.get_data())
+
+    static_directory = os.path.join(directory, "static")
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            source = os.path.join(root, name)
+            destination = os.path.join(static_directory, os.path.relpath(source, app.static_folder))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(source, destination)
+            with open(source, "rb") as f:
+                count += 1 + write_compressed(destination, f.read())
+
+    return count
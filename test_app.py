@@ -0,0 +1,387 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+from app import app
+import gzip
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+
+@pytest.fixture
+def client():
+    app.config["TESTING"] = True
+    with app.test_client() as client:
+        yield client
+
+
+def test_ajax_routes(client):
+    # The three original AJAX routes return JSON arrays, or a 404 for invalid inputs
+    response = client.get("/scale/G/major")
+    assert response.status_code == 200
+    assert response.content_type == "application/json"
+    assert json.loads(response.data) == ["G", "A", "B", "C", "D", "E", "F#", "G"]
+
+    response = client.get("/diatonic_chords/A/harmonic%20minor")
+    assert json.loads(response.data) == ["Am", "Bo", "C+", "Dm", "E", "F", "G#o"]
+
+    response = client.get("/chord/C%23m")
+    assert json.loads(response.data) == ["C#", "E", "G#"]
+
+    # Slash chords contain a slash, even when encoded
+    assert json.loads(client.get("/chord/C/E").data) == ["E", "G", "C"]
+    assert json.loads(client.get("/chord/Dm7%2FC").data) == ["C", "D", "F", "A"]
+
+    assert client.get("/scale/H/major").status_code == 404
+    assert client.get("/diatonic_chords/C/invalid").status_code == 404
+    assert client.get("/chord/Hm").status_code == 404
+
+
+def test_key(client):
+    # A single call returns everything the scales page needs
+    response = client.get("/key/D/minor")
+    assert response.status_code == 200
+    assert response.content_type == "application/json"
+    key = json.loads(response.data)
+    assert key["scale"] == ["D", "E", "F", "G", "A", "Bb", "C", "D"]
+    assert key["chords"] == ["Dm", "Eo", "F", "Gm", "Am", "Bb", "C"]
+    assert key["numerals"] == ["i", "iio", "III", "iv", "v", "VI", "VII"]
+    assert key["chord_notes"]["Eo"] == ["E", "G", "Bb"]
+    assert len(key["chord_notes"]) == 7
+
+    assert client.get("/key/H/major").status_code == 404
+    assert client.get("/key/C/invalid").status_code == 404
+
+
+def test_caching(client, monkeypatch):
+    # The theory endpoints are cacheable, with a strong ETag
+    response = client.get("/scale/G/major")
+    assert response.cache_control.public
+    assert response.cache_control.max_age > 0
+    etag, weak = response.get_etag()
+    assert etag and not weak
+
+    # Revalidating with the same ETag returns an empty 304
+    response = client.get("/scale/G/major", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.get_etag()[0] == etag
+
+    # Every URL has its own ETag
+    assert client.get("/chord/G").get_etag()[0] != etag
+    assert client.get("/key/G/major").get_etag()[0] != etag
+
+    # A new version of the code gives new ETags
+    import app as app_module
+    monkeypatch.setattr(app_module, "RESPONSE_VERSION", app_module.RESPONSE_VERSION + "-changed")
+    assert client.get("/scale/G/major").get_etag()[0] != etag
+
+    # Errors and pages must be revalidated, and the POST on "/" must never be stored
+    assert "max-age" not in client.get("/scale/H/major").headers["Cache-Control"]
+    assert client.get("/about").headers["Cache-Control"] == "no-cache"
+    response = client.post("/")
+    assert response.status_code == 302
+    assert "no-store" in response.headers["Cache-Control"]
+
+
+def test_response_cache(client):
+    from app import response_cache
+
+    response_cache.clear()
+    assert client.get("/chord/Dm").data == b'["D", "F", "A"]'
+    assert client.get("/chord/Dm").data == b'["D", "F", "A"]'
+    assert response_cache.stats()["hits"] == 1
+    assert response_cache.stats()["misses"] == 1
+
+    # Inputs without any answer are cached too (invalid chords don't even reach the view)
+    assert client.get("/identify/C,D,E").status_code == 404
+    assert client.get("/identify/C,D,E").status_code == 404
+    assert response_cache.stats()["hits"] == 2
+
+    # The routes share the cache, with separate keys
+    client.get("/scale/D/major")
+    client.get("/diatonic_chords/D/major")
+    assert response_cache.stats()["entries"] == 4
+
+    # When switched off, everything still works
+    response_cache.enabled = False
+    try:
+        assert client.get("/chord/Dm").data == b'["D", "F", "A"]'
+        assert client.get("/identify/C,D,E").status_code == 404
+        assert response_cache.stats()["hits"] == 2
+    finally:
+        response_cache.enabled = True
+
+
+def test_export(tmp_path):
+    from app import assets
+    from static_export import export_site
+
+    count = export_site(app, str(tmp_path), assets)
+    assert count > 1000
+
+    # Pages, JSON responses and static files mirror the URL layout, with gzip variants
+    assert b"Cell_CM" in (tmp_path / "index.html").read_bytes()
+    assert (tmp_path / "chords.html").exists()
+    assert (tmp_path / "about.html").exists()
+    data = (tmp_path / "scale" / "C#" / "harmonic minor").read_bytes()
+    assert json.loads(data) == ["C#", "D#", "E", "F#", "G#", "A", "B#", "C#"]
+    assert gzip.decompress((tmp_path / "scale" / "C#" / "harmonic minor.gz").read_bytes()) == data
+    assert json.loads((tmp_path / "chord" / "Ab+").read_bytes()) == ["Ab", "C", "E"]
+    # The chords page fetches the voicings
+    voicing = json.loads((tmp_path / "voicing" / "Ab+").read_bytes())
+    assert [n["key"] for n in voicing["voicing"]] == ["Ab/4", "C/5", "E/5", "Ab/5"]
+    assert json.loads((tmp_path / "key" / "G" / "major").read_bytes())["chords"][4] == "D"
+    assert (tmp_path / "static" / "js" / "project.js").exists()
+    assert (tmp_path / "static" / "js" / "project.js.gz").exists()
+    # The fingerprinted assets are exported too
+    path = assets.url("js/project.js").lstrip("/")
+    assert (tmp_path / path).exists()
+    assert gzip.decompress((tmp_path / (path + ".gz")).read_bytes()) == (tmp_path / path).read_bytes()
+
+
+def test_scales_containing(client):
+    response = client.get("/scales_containing/C,D,E,F,G,A,B")
+    assert response.status_code == 200
+    assert json.loads(response.data) == [
+        {"tonic": "C", "scale": "major", "exact": True},
+        {"tonic": "A", "scale": "natural minor", "exact": True},
+        {"tonic": "D", "scale": "dorian", "exact": True},
+        {"tonic": "E", "scale": "phrygian", "exact": True},
+        {"tonic": "F", "scale": "lydian", "exact": True},
+        {"tonic": "G", "scale": "mixolydian", "exact": True},
+        {"tonic": "B", "scale": "locrian", "exact": True},
+        {"tonic": "B#", "scale": "major", "exact": False},
+        {"tonic": "Fb", "scale": "phrygian", "exact": False},
+        {"tonic": "E#", "scale": "lydian", "exact": False},
+        {"tonic": "Cb", "scale": "locrian", "exact": False},
+    ]
+    assert client.get("/scales_containing/C,H").status_code == 404
+    assert client.get("/scales_containing/,").status_code == 404
+
+
+def test_identify(client):
+    response = client.get("/identify/E,G,C")
+    assert response.status_code == 200
+    assert json.loads(response.data) == {"chord": "C/E", "inversion": 1}
+    assert json.loads(client.get("/identify/B,D,F,A").data) == {"chord": "Bø7", "inversion": 0}
+    assert client.get("/identify/C,D,E").status_code == 404
+    assert client.get("/identify/C,H,G").status_code == 404
+
+
+def test_progression(client):
+    response = client.get("/progression/C/major/I-vi-IV-V-viio-VII")
+    assert response.status_code == 200
+    assert response.content_type == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode("utf-8").splitlines()]
+    assert [line["chord"] for line in lines] == ["C", "Am", "F", "G", "Bo", "Bo"]
+    assert lines[0] == {"bar": 1, "numeral": "I", "chord": "C", "notes": ["C", "E", "G"]}
+    assert lines[4]["notes"] == ["B", "D", "F"]
+
+    # Long progressions are streamed, one line per bar
+    response = client.get("/progression/A/harmonic%20minor/" + "-".join(["i", "iv", "V", "i"] * 100))
+    lines = response.data.decode("utf-8").splitlines()
+    assert len(lines) == 400
+    assert json.loads(lines[-2]) == {"bar": 399, "numeral": "V", "chord": "E", "notes": ["E", "G#", "B"]}
+
+    # An invalid numeral ends the stream with an error, an invalid key is a 404
+    lines = client.get("/progression/C/major/I-IX-V").data.decode("utf-8").splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])["bar"] == 2
+    assert "error" in json.loads(lines[1])
+    assert client.get("/progression/H/major/I").status_code == 404
+
+
+def test_voicings(client):
+    key = json.loads(client.get("/key/D/major").data)
+    assert [n["key"] for n in key["scale_voicing"]] == ["D/4", "E/4", "F#/4", "G/4", "A/4", "B/4", "C#/5", "D/5"]
+    assert [n["midi"] for n in key["scale_voicing"]][:3] == [62, 64, 66]
+    assert len(key["chord_voicings"]) == 8
+    assert [n["key"] for n in key["chord_voicings"][-1]] == ["D/5", "F#/5", "A/5"]
+
+    response = client.get("/voicing/F%23m")
+    assert response.status_code == 200
+    voicing = json.loads(response.data)
+    assert voicing["notes"] == ["F#", "A", "C#"]
+    assert [n["key"] for n in voicing["voicing"]] == ["F#/4", "A/4", "C#/5", "F#/5"]
+    assert [n["accidental"] for n in voicing["voicing"]] == ["#", "", "#", "#"]
+    assert client.get("/voicing/Hm").status_code == 404
+
+
+def test_metrics(client):
+    from app import metrics
+
+    # Disabled by default
+    assert client.get("/metrics").status_code == 404
+
+    metrics.enabled = True
+    try:
+        client.get("/scale/E/major")
+        client.get("/identify/C,D,E")
+        client.get("/scale/H/major")
+        text = client.get("/metrics").data.decode("utf-8")
+        assert 'http_requests_total{route="/scale/<tonic:s>/<scale_type:t>",method="GET",status="200"}' in text
+        assert 'http_requests_total{route="/identify/<notes>",method="GET",status="404"}' in text
+        assert 'http_requests_total{route="unmatched",method="GET",status="404"}' in text
+    finally:
+        metrics.enabled = False
+
+
+def test_metrics_startup():
+    # The calls made while building the tables and rendering the pages at startup are not counted
+    env = dict(os.environ, METRICS="1", THEORY_SNAPSHOT="")
+    output = subprocess.run([sys.executable, "-c", "import app, json; print(json.dumps(app.metrics.snapshot()))"],
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                            capture_output=True, text=True).stdout
+    snapshot = json.loads(output.splitlines()[-1])
+    assert snapshot["calls"] == {} and snapshot["requests"] == {} and snapshot["latency"] == {}
+    assert "response_cache_hits" in snapshot["gauges"]
+
+
+def test_page_cache(client):
+    # Without any Accept-Encoding, the page is not compressed
+    response = client.get("/")
+    assert response.status_code == 200
+    assert response.content_encoding is None
+    assert b"Cell_CM" in response.data
+    assert "Accept-Encoding" in response.vary
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.get_etag()[0]
+
+    response = client.get("/", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.content_encoding == "gzip"
+    assert gzip.decompress(response.data) == client.get("/").data
+    assert response.get_etag()[0] != etag
+
+    # Revalidating returns an empty 304, for the same variant only
+    response = client.get("/", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert "Accept-Encoding" in response.vary
+    response = client.get("/", headers={"If-None-Match": f'"{etag}"', "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+
+    # Every page has its own ETag, and the POST still redirects
+    assert client.get("/chords").get_etag()[0] != etag
+    assert client.get("/about").get_etag()[0] != etag
+    assert client.post("/").status_code == 302
+
+
+def test_assets(client):
+    from app import assets
+
+    # The pages reference the fingerprinted assets, served with an immutable, long-lived caching policy
+    page = client.get("/").data.decode("utf-8")
+    url = assets.url("js/project.js")
+    assert url.startswith("/assets/js/project.")
+    assert url in page
+    assert assets.url("images/play.svg") in page
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.content_encoding == "gzip"
+    assert "Accept-Encoding" in response.vary
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 86400
+    assert b"function start_playback" in gzip.decompress(response.data)
+
+    assert client.get("/assets/js/project.js").status_code == 404
+    # The original files are still available
+    assert client.get("/static/js/project.js").status_code == 200
+
+
+def test_converters(client):
+    from app import app
+
+    # Invalid tonics, scale types and chords are rejected by the router, before reaching any view
+    adapter = app.url_map.bind("localhost")
+    assert adapter.match("/scale/C#/minor") == ("scale", {"s": "C#", "t": "natural minor"})
+    assert adapter.match("/chord/Dbm7/Ab") == ("chord", {"chord": "Dbm7/Ab"})
+    for url in ["/scale/H/major", "/scale/C/hungarian", "/key/C#x/major", "/chord/Cm9", "/chord/C/E/G", "/voicing/Cm7b9"]:
+        assert client.get(url).status_code == 404
+
+    # Aliases are normalized, the responses are identical
+    assert client.get("/key/A/minor").data == client.get("/key/A/natural%20minor").data
+
+
+def test_transpose(client):
+    from music_theory import Music_Theory
+
+    response = client.post("/transpose", json={"interval": "-P4", "items": ["C", "Am7", ["F", "G7/B"]]})
+    assert response.status_code == 200
+    assert response.content_type == "application/json"
+    assert json.loads(response.data) == ["G", "Em7", ["C", "D7/F#"]]
+    assert "no-store" in response.headers["Cache-Control"]
+
+    # Thousands of items in a single call
+    items = Music_Theory.get_table_chords() * 4
+    assert len(json.loads(client.post("/transpose", json={"interval": "M3", "items": items}).data)) == len(items)
+
+    for body in [{"interval": "M4", "items": ["C"]}, {"interval": "M3", "items": ["H"]}, {"items": ["C"]},
+                 {"interval": "M3", "items": "C"}, ["C"]]:
+        assert client.post("/transpose", json=body).status_code == 400
+    assert client.post("/transpose", data="garbage").status_code == 400
+
+    # Long runs of augmented qualities or of accidentals are refused, they would add accidentals to every note
+    for body in [{"interval": "A" * 100000 + "4", "items": items}, {"interval": "M3", "items": ["C" + "#" * 100000]}]:
+        assert client.post("/transpose", json=body).status_code == 400
+    assert client.get("/transpose").status_code == 405
+
+
+def test_voice_progression(client):
+    response = client.get("/voice_progression/C,G/B,Am,F")
+    assert response.status_code == 200
+    assert response.content_type == "application/json"
+    data = json.loads(response.data)
+    assert data["chords"] == ["C", "G/B", "Am", "F"]
+    assert [n["note"] for n in data["voicings"][1]] == ["B", "D", "G"]
+    assert len(data["voicings"]) == 4
+    assert response.cache_control.max_age > 0
+
+    assert client.get("/voice_progression/C,Hm").status_code == 404
+    assert client.get("/voice_progression/C,,F").status_code == 404
+
+
+def test_audio(client, tmp_path, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module.audio_renderer, "directory", str(tmp_path))
+    monkeypatch.setattr(app_module.audio_renderer, "workers", 0)
+
+    response = client.get("/audio/scale/C/major.wav")
+    assert response.status_code == 200
+    assert response.content_type == "audio/wav"
+    assert response.data[:4] == b"RIFF"
+    assert response.cache_control.max_age > 0
+    size = len(response.data)
+    etag = response.headers["ETag"]
+
+    # Range and conditional requests
+    response = client.get("/audio/scale/C/major.wav", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 0-99/{size}"
+    assert len(response.data) == 100
+    assert client.get("/audio/scale/C/major.wav", headers={"If-None-Match": etag}).status_code == 304
+
+    # Aliases, slash chords, other tempos and instruments get their own files
+    response = client.get("/audio/chord/G7/B.mid")
+    assert response.status_code == 200
+    assert response.content_type == "audio/midi"
+    assert response.data[:4] == b"MThd"
+    assert client.get("/audio/scale/C/minor.wav").headers["ETag"] == \
+        client.get("/audio/scale/C/natural minor.wav").headers["ETag"]
+    assert client.get("/audio/scale/C/major.wav?tempo=120&instrument=organ").headers["ETag"] != etag
+
+    for url in ["/audio/scale/C/major.mp3", "/audio/scale/H/major.wav", "/audio/chord/Hm.wav"]:
+        assert client.get(url).status_code == 404
+    for query in ["tempo=0", "tempo=abc", "tempo=1000", "instrument=kazoo"]:
+        assert client.get(f"/audio/chord/C.wav?{query}").status_code == 400
+
+    # When too many files are being rendered, the client is asked to come back later
+    def busy(*args):
+        raise app_module.Audio_Busy()
+    monkeypatch.setattr(app_module.audio_renderer, "render", busy)
+    response = client.get("/audio/chord/D.wav")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
@@ -0,0 +1,37 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+import gzip
+from assets import Assets, fingerprinted_name, minify
+
+
+def test_minify():
+    js = b"// Comment\nfunction f() {\n    let a = 'http://x' // not a comment line\n\n    return a\n}\n"
+    assert minify("js/a.js", js) == b"function f() {\nlet a = 'http://x' // not a comment line\nreturn a\n}\n"
+    css = b"/* Comment */\nbody {\n    margin: 0 auto;\n}\n"
+    assert minify("css/a.css", css) == b"body {\nmargin: 0 auto;\n}\n"
+    # Other files are untouched
+    assert minify("images/a.svg", b"<svg>\n    <g/>\n</svg>") == b"<svg>\n    <g/>\n</svg>"
+
+
+def test_assets(tmp_path):
+    (tmp_path / "js").mkdir()
+    (tmp_path / "js" / "a.js").write_bytes(b"    var a = 1;\n")
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG")
+    assets = Assets(str(tmp_path))
+
+    # The URL changes with the content
+    url = assets.url("js/a.js")
+    assert url == "/assets/" + fingerprinted_name("js/a.js", b"var a = 1;\n")
+    assert url != "/assets/" + fingerprinted_name("js/a.js", b"var a = 2;\n")
+    assert assets.url("js/unknown.js") == "/static/js/unknown.js"
+
+    content_type, variants = assets.get(url[len("/assets/"):])
+    assert content_type.endswith("javascript; charset=utf-8")
+    assert gzip.decompress(variants["gzip"][0]) == variants["identity"][0] == b"var a = 1;\n"
+
+    # Binary files are not compressed
+    content_type, variants = assets.get(assets.url("logo.png")[len("/assets/"):])
+    assert content_type == "image/png"
+    assert list(variants) == ["identity"]
+    assert assets.get("js/a.js") is None
@@ -0,0 +1,145 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+import wave
+
+import numpy as np
+import pytest
+from audio import SAMPLE_RATE, Audio_Busy, Audio_Renderer, arpeggio_events, midi_file, scale_events, synthesize, wav_file
+
+
+def test_events():
+    assert scale_events([60, 62]) == [(0, 1, (60,)), (1, 1, (62,))]
+    assert arpeggio_events([60, 64, 67]) == [(0, 1, (60,)), (1, 1, (64,)), (2, 1, (67,)), (3, 4, (60, 64, 67))]
+
+
+def test_wav():
+    # An eighth note at 60 bpm lasts half a second, and one more step is added at the end
+    data = wav_file(scale_events([57, 69]), 60, "sine")
+    with wave.open(io.BytesIO(data)) as f:
+        assert (f.getnchannels(), f.getsampwidth(), f.getframerate()) == (1, 2, SAMPLE_RATE)
+        assert f.getnframes() == int(1.5 * SAMPLE_RATE) + 1
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+
+    # The frequency of each note is where the spectrum peaks: 220 and 440 Hz
+    half = SAMPLE_RATE // 2
+    for start, frequency in [(0, 220), (half, 440)]:
+        spectrum = np.abs(np.fft.rfft(samples[start:start + half]))
+        assert abs(np.argmax(spectrum) * SAMPLE_RATE / half - frequency) < 3
+    assert np.abs(samples).max() == round(0.8 * 32767)
+
+    # Every instrument, and chords
+    for instrument in ["piano", "organ", "sine"]:
+        assert len(synthesize(arpeggio_events([48, 52, 55, 60]), 80, instrument)) > 0
+
+
+def test_midi():
+    data = midi_file([(0, 1, (60,)), (1, 2, (60, 64))], 120, "organ")
+    assert data[:14] == b"MThd" + struct.pack(">IHHH", 6, 0, 1, 480)
+    assert data[14:18] == b"MTrk"
+    track = data[22:]
+    assert struct.unpack(">I", data[18:22])[0] == len(track)
+    assert track == bytes.fromhex(
+        "00ff5103 07a120"   # tempo: 500000 µs per quarter note
+        "00c013"            # church organ
+        "00903c50"          # C on
+        "8170803c00"        # C off after 240 ticks (an eighth note)...
+        "00903c50 0090 4050"  # ...and played again, with E
+        "8360803c00 00804000"  # both off after 480 ticks
+        "00ff2f00"
+    )
+
+
+def test_cache(tmp_path):
+    renderer = Audio_Renderer(str(tmp_path), workers=0)
+    events = scale_events([60, 62, 64])
+    path = renderer.render("wav", events, 80, "piano")
+    assert path.startswith(str(tmp_path)) and path.endswith(".wav")
+    assert os.path.getsize(path) > 44
+
+    # The same inputs give the same file, any other input another one
+    assert renderer.render("wav", events, 80, "piano") == path
+    assert renderer.stats() == {"renders": 1, "hits": 1, "rejected": 0, "timeouts": 0, "failures": 0, "pending": 0}
+    assert len({path, renderer.path("wav", events, 90, "piano"), renderer.path("wav", events, 80, "sine"),
+                renderer.path("mid", events, 80, "piano"), renderer.path("wav", events[:2], 80, "piano")}) == 5
+
+    with pytest.raises(ValueError):
+        renderer.render("mp3", events, 80, "piano")
+    with pytest.raises(ValueError):
+        renderer.render("wav", events, 80, "kazoo")
+
+    # The least recently used files are deleted beyond max_bytes
+    midi = renderer.render("mid", events, 80, "piano")
+    renderer.max_bytes = os.path.getsize(path) + os.path.getsize(midi)
+    renderer.render("wav", events, 80, "piano")
+    renderer.render("mid", events, 90, "piano")
+    assert os.path.exists(path) and os.path.exists(renderer.path("mid", events, 90, "piano"))
+    assert not os.path.exists(midi)
+
+
+def test_cache_scans(tmp_path, monkeypatch):
+    # The directory is scanned on the first render, then only when the running total goes over max_bytes
+    scans = []
+    walk = os.walk
+    monkeypatch.setattr(os, "walk", lambda directory: scans.append(directory) or walk(directory))
+
+    renderer = Audio_Renderer(str(tmp_path), workers=0)
+    for tempo in range(60, 70):
+        renderer.render("mid", scale_events([60, 62]), tempo, "piano")
+    assert len(scans) == 1
+
+    size = os.path.getsize(renderer.path("mid", scale_events([60, 62]), 60, "piano"))
+    renderer.max_bytes = 11 * size
+    renderer.render("mid", scale_events([60, 62]), 70, "piano")
+    assert len(scans) == 1
+    renderer.render("mid", scale_events([60, 62]), 71, "piano")
+    assert len(scans) == 2
+    assert sum(len(names) for _, _, names in walk(str(tmp_path))) == 11
+
+
+def test_pool(tmp_path):
+    # The files are rendered by the worker processes, beyond max_pending the renders are refused
+    renderer = Audio_Renderer(str(tmp_path), workers=1, max_pending=1)
+    try:
+        path = renderer.render("wav", scale_events([60, 64]), 80, "piano")
+        with open(path, "rb") as f:
+            assert f.read() == wav_file(scale_events([60, 64]), 80, "piano")
+        assert renderer.stats()["renders"] == 1
+
+        renderer._pending["busy"] = None
+        with pytest.raises(Audio_Busy):
+            renderer.render("wav", scale_events([60, 65]), 80, "piano")
+        assert renderer.render("wav", scale_events([60, 64]), 80, "piano") == path
+        assert renderer.stats()["rejected"] == 1
+    finally:
+        renderer.close()
+
+
+def test_pool_failures(tmp_path):
+    renderer = Audio_Renderer(str(tmp_path), workers=1)
+    try:
+        renderer.render("mid", scale_events([60]), 80, "piano")
+
+        # A render taking too long is refused, but it goes on, and the next request finds the file
+        renderer.timeout = 0
+        with pytest.raises(Audio_Busy):
+            renderer.render("wav", scale_events([60, 64]), 80, "piano")
+        assert renderer.stats()["timeouts"] == 1
+        renderer.timeout = 30
+        path = renderer.render("wav", scale_events([60, 64]), 80, "piano")
+        assert os.path.exists(path)
+
+        # When a worker process dies, the broken pool is dropped, and the next render starts a new one
+        for process in list(renderer._executor._processes.values()):
+            process.kill()
+            process.join()
+        with pytest.raises(Audio_Busy):
+            renderer.render("wav", scale_events([62]), 80, "piano")
+        assert renderer.stats()["failures"] == 1
+        assert os.path.exists(renderer.render("wav", scale_events([61, 65]), 80, "piano"))
+        assert renderer.stats()["pending"] == 0
+    finally:
+        renderer.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+from metrics import Metrics, retire_process
+import metrics as metrics_module
+import os
+import threading
+
+
+class Counted:
+    @classmethod
+    def double(cls, value):
+        return value * 2
+
+
+def test_record_and_render():
+    metrics = Metrics()
+    metrics.record_request("/scale/<s>/<t>", "GET", 200, 0.0003)
+    metrics.record_request("/scale/<s>/<t>", "GET", 200, 0.02)
+    metrics.record_request("/scale/<s>/<t>", "GET", 404, 5.0)
+    metrics.add_gauges(lambda: {"response_cache_hits": 7})
+
+    text = metrics.render()
+    assert 'http_requests_total{route="/scale/<s>/<t>",method="GET",status="200"} 2' in text
+    assert 'http_requests_total{route="/scale/<s>/<t>",method="GET",status="404"} 1' in text
+    # The histogram buckets are cumulative
+    assert 'http_request_duration_seconds_bucket{route="/scale/<s>/<t>",le="0.0005"} 1' in text
+    assert 'http_request_duration_seconds_bucket{route="/scale/<s>/<t>",le="0.025"} 2' in text
+    assert 'http_request_duration_seconds_bucket{route="/scale/<s>/<t>",le="2.5"} 2' in text
+    assert 'http_request_duration_seconds_bucket{route="/scale/<s>/<t>",le="+Inf"} 3' in text
+    assert 'http_request_duration_seconds_count{route="/scale/<s>/<t>"} 3' in text
+    assert "response_cache_hits 7" in text
+
+
+def test_instrument():
+    metrics = Metrics()
+    metrics.instrument(Counted, ["double"])
+    assert Counted.double(21) == 42
+    assert Counted.double(1) == 2
+    assert metrics.snapshot()["calls"]["double"][0] == 2
+    assert 'music_theory_calls_total{method="double"} 2' in metrics.render()
+
+
+def test_workers_are_added_up(tmp_path, monkeypatch):
+    # Two workers sharing the same directory, simulated with two instances and two process ids
+    first = Metrics(directory=str(tmp_path), flush_interval=3600)
+    second = Metrics(directory=str(tmp_path), flush_interval=3600)
+    first.record_request("/chord/<path:chord>", "GET", 200, 0.001)
+    second.record_request("/chord/<path:chord>", "GET", 200, 0.001)
+    second.record_call("get_chord_notes", 0.5)
+    first.add_gauges(lambda: {"response_cache_entries": 3})
+    second.add_gauges(lambda: {"response_cache_entries": 4})
+
+    monkeypatch.setattr(metrics_module, "_alive", lambda pid: True)
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    first.flush()
+    monkeypatch.setattr(os, "getpid", lambda: 2)
+
+    text = second.render()
+    assert 'http_requests_total{route="/chord/<path:chord>",method="GET",status="200"} 2' in text
+    assert 'music_theory_call_seconds_total{method="get_chord_notes"} 0.5' in text
+    assert "response_cache_entries 7" in text
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["metrics-1.json", "metrics-2.json"]
+
+
+def test_exited_workers(tmp_path, monkeypatch):
+    # The counters of an exited worker are kept, its gauges are dropped
+    alive = {1, 2}
+    monkeypatch.setattr(metrics_module, "_alive", lambda pid: pid in alive)
+    first = Metrics(directory=str(tmp_path), flush_interval=3600)
+    second = Metrics(directory=str(tmp_path), flush_interval=3600)
+    for metrics in [first, second]:
+        metrics.record_request("/key/<tonic:s>/<scale_type:t>", "GET", 200, 0.001)
+        metrics.add_gauges(lambda: {"audio_pending": 2})
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    first.flush()
+    monkeypatch.setattr(os, "getpid", lambda: 2)
+    assert "audio_pending 4" in second.render()
+
+    # Until the master process retires it, the snapshot of a dead worker only counts for its counters
+    alive.remove(1)
+    text = second.render()
+    assert 'http_requests_total{route="/key/<tonic:s>/<scale_type:t>",method="GET",status="200"} 2' in text
+    assert "audio_pending 2" in text
+
+    retire_process(str(tmp_path), 1)
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["exited.json", "metrics-2.json"]
+    assert second.render() == text
+
+    # A new process reusing the pid of an exited one retires its snapshot first, so the counters never go backwards
+    second.record_request("/key/<tonic:s>/<scale_type:t>", "GET", 200, 0.001)
+    second.flush()
+    third = Metrics(directory=str(tmp_path), flush_interval=3600)
+    third.flush()
+    assert 'method="GET",status="200"} 3' in third.render()
+    retire_process(str(tmp_path), 42)
+
+
+def test_flush_errors(tmp_path):
+    # Threads flushing at the same time never get in each other's way
+    metrics = Metrics(directory=str(tmp_path), flush_interval=0)
+    errors = []
+
+    def record():
+        try:
+            for _ in range(50):
+                metrics.flush()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    # A directory that can't be written never fails the recording of a request
+    metrics.directory = str(tmp_path / "missing")
+    metrics.record_request("/", "GET", 200, 0.001)
+    assert metrics.snapshot()["requests"]
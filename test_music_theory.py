@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from music_theory import Music_Theory
+import itertools
+import marshal
 import pytest
 
 
@@ -325,18 +327,6 @@ def test_get_enharmonic_note():
     assert Music_Theory._get_enharmonic_note("A", "G") == "G##"
 
 
-def test_get_next_expected_note():
-    # This method is used to find the name of the next note, without accidentals
-    assert Music_Theory._get_next_expected_note("C") == "D"
-    assert Music_Theory._get_next_expected_note("C#") == "D"
-    assert Music_Theory._get_next_expected_note("Cb") == "D"
-    assert Music_Theory._get_next_expected_note("G") == "A"
-    assert Music_Theory._get_next_expected_note("Gb") == "A"
-    assert Music_Theory._get_next_expected_note("G#") == "A"
-    with pytest.raises(ValueError):
-        Music_Theory._get_next_expected_note("H")
-
-
 def test_get_intervals():
     assert Music_Theory._get_intervals("major") == [2, 2, 1, 2, 2, 2, 1]
     assert Music_Theory._get_intervals("minor") == [2, 1, 2, 2, 1, 2, 2]
@@ -347,12 +337,6 @@ def test_get_intervals():
         Music_Theory._get_intervals("invalid")
 
 
-def test_get_note_position():
-    assert Music_Theory._get_note_position("C", ["C", "D", "E", "F", "G", "A", "B", "C"]) == 0
-    assert Music_Theory._get_note_position("G", ["C", "D", "E", "F", "G", "A", "B", "C"]) == 4
-    assert Music_Theory._get_note_position("G#", ["C", "D", "E", "F", "G", "A", "B", "C"]) == -1
-
-
 def test_sharpen():
     assert Music_Theory._sharpen("C") == "C#"
     assert Music_Theory._sharpen("C#") == "C##"
@@ -369,3 +353,428 @@ def test_flatten():
     assert Music_Theory._flatten("C##") == "C#"
     assert Music_Theory._flatten(Music_Theory._flatten("C##")) == "C"
     assert Music_Theory._flatten(Music_Theory._flatten(Music_Theory._flatten("C##"))) == "Cb"
+
+
+def test_build_tables():
+    # Compute everything from scratch first, then make sure the precomputed tables return the
+    # exact same answers, and that invalid inputs still raise a ValueError.
+    Music_Theory.clear_tables()
+    tonics = [letter + accidental for letter in "CDEFGAB" for accidental in Music_Theory.TABLE_ACCIDENTALS]
+    expected = {}
+    for tonic in tonics:
+        for scale in Music_Theory.SUPPORTED_SCALES:
+            try:
+                expected[("scale", tonic, scale)] = Music_Theory.get_scale(tonic, scale)
+                expected[("diatonic", tonic, scale)] = Music_Theory.get_diatonic_chords(tonic, scale)
+            except ValueError:
+                pass
+        for suffix in Music_Theory.TABLE_CHORD_SUFFIXES:
+            try:
+                expected[("chord", tonic + suffix)] = Music_Theory.get_chord_notes(tonic + suffix)
+            except ValueError:
+                pass
+
+    Music_Theory.build_tables()
+    try:
+        for key, notes in expected.items():
+            if key[0] == "scale":
+                assert Music_Theory.get_scale(key[1], key[2]) == notes
+            elif key[0] == "diatonic":
+                assert Music_Theory.get_diatonic_chords(key[1], key[2]) == notes
+            else:
+                assert Music_Theory.get_chord_notes(key[1]) == notes
+
+        # Callers get their own copy, the tables can't be modified by accident
+        Music_Theory.get_scale("C").append("D")
+        assert Music_Theory.get_scale("C") == ["C", "D", "E", "F", "G", "A", "B", "C"]
+
+        with pytest.raises(ValueError):
+            Music_Theory.get_scale("H", "major")
+        with pytest.raises(ValueError):
+            Music_Theory.get_scale("C", "invalid")
+        with pytest.raises(ValueError):
+            Music_Theory.get_diatonic_chords("C", "invalid")
+        with pytest.raises(ValueError):
+            Music_Theory.get_chord_notes("Hm")
+    finally:
+        Music_Theory.clear_tables()
+
+
+def test_build_tables_snapshot(tmp_path):
+    # The first call computes the tables and saves them, the second one loads them
+    path = str(tmp_path / "music_theory.snapshot")
+    try:
+        assert Music_Theory.build_tables(snapshot=path) is False
+        computed = dict(Music_Theory._tables["chord_notes"])
+        scales_index = Music_Theory._scales_index
+
+        Music_Theory.clear_tables()
+        assert Music_Theory.build_tables(snapshot=path) is True
+        assert dict(Music_Theory._tables["chord_notes"]) == computed
+        assert Music_Theory._scales_index == scales_index
+        assert Music_Theory.get_scale("Eb", "harmonic minor") == ["Eb", "F", "Gb", "Ab", "Bb", "Cb", "D", "Eb"]
+        assert Music_Theory.identify_chord(["E", "G", "C"]) == ("C/E", 1)
+
+        # A snapshot saved by another version of the code is ignored, and replaced
+        with open(path, "wb") as f:
+            marshal.dump((("0.0", "", (0, 0)), {}), f)
+        assert Music_Theory.build_tables(snapshot=path) is False
+        assert Music_Theory.build_tables(snapshot=path) is True
+
+        # So is a corrupted snapshot
+        with open(path, "wb") as f:
+            f.write(b"garbage")
+        assert Music_Theory.build_tables(snapshot=path) is False
+    finally:
+        Music_Theory.clear_tables()
+
+
+def test_get_roman_numerals():
+    assert Music_Theory.get_roman_numerals() == ["I", "ii", "iii", "IV", "V", "vi", "viio"]
+    assert Music_Theory.get_roman_numerals("minor") == ["i", "iio", "III", "iv", "v", "VI", "VII"]
+    assert Music_Theory.get_roman_numerals("harmonic minor") == ["i", "iio", "III+", "iv", "V", "VI", "viio"]
+    with pytest.raises(ValueError):
+        Music_Theory.get_roman_numerals("invalid")
+
+
+def test_scale_definitions():
+    # Modes, pentatonic, blues, whole tone and diminished scales, derived from their definitions
+    assert Music_Theory.get_scale("D", "dorian") == ["D", "E", "F", "G", "A", "B", "C", "D"]
+    assert Music_Theory.get_scale("F#", "lydian") == ["F#", "G#", "A#", "B#", "C#", "D#", "E#", "F#"]
+    assert Music_Theory.get_scale("C", "ionian") == Music_Theory.get_scale("C", "major")
+    assert Music_Theory.get_diatonic_chords("G", "mixolydian") == ["G", "Am", "Bo", "C", "Dm", "Em", "F"]
+    assert Music_Theory.get_roman_numerals("locrian") == ["io", "II", "iii", "iv", "V", "VI", "vii"]
+
+    # Degrees without any diatonic triad are skipped, the numerals stay parallel to the chords
+    assert Music_Theory.get_scale("A", "minor pentatonic") == ["A", "C", "D", "E", "G", "A"]
+    assert Music_Theory.get_diatonic_chords("A", "minor pentatonic") == ["Am", "C"]
+    assert Music_Theory.get_roman_numerals("minor pentatonic") == ["i", "III"]
+    assert Music_Theory.get_scale("E", "blues") == ["E", "G", "A", "Bb", "B", "D", "E"]
+    assert Music_Theory._get_intervals("blues") == [3, 2, 1, 1, 3, 2]
+
+    assert Music_Theory.get_scale("Bb", "whole tone") == ["Bb", "C", "D", "E", "F#", "G#", "Bb"]
+    assert Music_Theory.get_diatonic_chords("C", "whole tone") == ["C+", "D+", "E+", "F#+", "G#+", "A#+"]
+
+    # Scales with eight notes use one letter twice, the numerals of that letter keep their accidentals
+    assert Music_Theory.get_scale("C", "diminished") == ["C", "D", "Eb", "F", "Gb", "Ab", "A", "B", "C"]
+    assert Music_Theory.get_diatonic_chords("C", "diminished") == ["Co", "D", "Ebo", "F", "Gbo", "Ab", "Ao", "B"]
+    assert Music_Theory.get_roman_numerals("diminished") == ["io", "II", "iiio", "IV", "vo", "bVI", "vio", "VII"]
+    assert list(Music_Theory.get_progression("C", "diminished", ["bVI", "vio"])) == [
+        ("bVI", "Ab", ["Ab", "C", "Eb"]),
+        ("vio", "Ao", ["A", "C", "Eb"]),
+    ]
+
+    # Every definition is derived once, then cached
+    assert Music_Theory._get_scale_type("dorian") is Music_Theory._get_scale_type("dorian")
+    with pytest.raises(ValueError):
+        Music_Theory._get_scale_type("hungarian")
+
+
+def test_encode_decode_note():
+    # Notes are packed as letter index + 8 * accidental offset
+    assert Music_Theory._encode_note("C") == 0
+    assert Music_Theory._encode_note("B") == 6
+    assert Music_Theory._encode_note("C#") == 8
+    assert Music_Theory._encode_note("Dbb") == -15
+    for note in ["C", "F#", "Bb", "E##", "Abb", "G###", "Cbbb"]:
+        assert Music_Theory._decode_note(Music_Theory._encode_note(note)) == note
+    for note in ["H", "c", "C#b", "", "Cm", "#"]:
+        with pytest.raises(ValueError):
+            Music_Theory._encode_note(note)
+
+
+def test_pitch_class_and_spell():
+    assert Music_Theory._pitch_class(Music_Theory._encode_note("C")) == 0
+    assert Music_Theory._pitch_class(Music_Theory._encode_note("B#")) == 0
+    assert Music_Theory._pitch_class(Music_Theory._encode_note("Cb")) == 11
+    assert Music_Theory._pitch_class(Music_Theory._encode_note("F###")) == 8
+    # Spell pitch class 8 (G#/Ab) on various letters
+    assert Music_Theory._decode_note(Music_Theory._spell(4, 8)) == "G#"
+    assert Music_Theory._decode_note(Music_Theory._spell(5, 8)) == "Ab"
+    assert Music_Theory._decode_note(Music_Theory._spell(3, 8)) == "F###"
+    assert Music_Theory._decode_note(Music_Theory._spell(6, 8)) == "Bbbb"
+
+
+def test_get_scale_any_accidentals():
+    # Spelling stays correct with any number of accidentals, without any lookup table
+    assert Music_Theory.get_scale("Fb", "minor") == ["Fb", "Gb", "Abb", "Bbb", "Cb", "Dbb", "Ebb", "Fb"]
+    assert Music_Theory.get_scale("B##", "major") == ["B##", "C###", "D###", "E##", "F###", "G###", "A###", "B##"]
+    assert Music_Theory.get_chord_notes("Fbo") == ["Fb", "Abb", "Cbb"]
+
+    # Even beyond five sharps or flats, where the accidentals of a pitch class would wrap around
+    assert Music_Theory.get_scale("B#####") == ["B#####", "C######", "D######", "E#####", "F######", "G######", "A######", "B#####"]
+    assert Music_Theory.get_scale("Fbbbbbb", "minor") == [
+        "Fbbbbbb", "Gbbbbbb", "Abbbbbbb", "Bbbbbbbb", "Cbbbbbb", "Dbbbbbbb", "Ebbbbbbb", "Fbbbbbb"]
+    assert Music_Theory.get_chord_notes("B####+") == ["B####", "D#####", "F######"]
+    assert Music_Theory.get_chord_notes("Cbbbbbbo") == ["Cbbbbbb", "Ebbbbbbb", "Gbbbbbbb"]
+
+
+def test_get_scales_bulk():
+    # The bulk results must match the scalar method exactly, for every tonic and scale type
+    tonics = [letter + accidental for letter in "CDEFGAB" for accidental in ["", "#", "b", "##", "bb"]]
+    all_tonics = [tonic for tonic in tonics for _ in Music_Theory.SUPPORTED_SCALES]
+    all_types = [scale for _ in tonics for scale in Music_Theory.SUPPORTED_SCALES]
+    results = Music_Theory.get_scales_bulk(all_tonics, all_types)
+    for tonic, scale, notes in zip(all_tonics, all_types, results):
+        assert notes == Music_Theory.get_scale(tonic, scale)
+
+    assert Music_Theory.get_scales_bulk(["C", "A"], "minor") == [
+        ["C", "D", "Eb", "F", "G", "Ab", "Bb", "C"],
+        ["A", "B", "C", "D", "E", "F", "G", "A"],
+    ]
+    assert Music_Theory.get_scales_bulk([]) == []
+
+    # Encoded notes use the internal integer representation
+    encoded = Music_Theory.get_scales_bulk(["D"], encoded=True)[0]
+    assert [Music_Theory._decode_note(int(n)) for n in encoded] == Music_Theory.get_scale("D")
+
+    with pytest.raises(ValueError):
+        Music_Theory.get_scales_bulk(["C", "H"])
+    with pytest.raises(ValueError):
+        Music_Theory.get_scales_bulk(["C"], ["invalid"])
+    with pytest.raises(ValueError):
+        Music_Theory.get_scales_bulk(["C", "D"], ["major"])
+
+    # Beyond five sharps or flats, the results are still the same as get_scale()
+    tonics = ["B#####", "Fbbbbbb", "E#######", "Abbbbbbbb"]
+    for scale in ["major", "natural minor", "blues"]:
+        assert Music_Theory.get_scales_bulk(tonics, scale) == [Music_Theory.get_scale(tonic, scale) for tonic in tonics]
+
+
+def test_get_chords_bulk():
+    chords = [letter + accidental + suffix
+              for letter in "CDEFGAB" for accidental in ["", "#", "b", "##", "bb"] for suffix in ["", "m", "o", "-", "+"]]
+    for chord, notes in zip(chords, Music_Theory.get_chords_bulk(chords)):
+        assert notes == Music_Theory.get_chord_notes(chord)
+
+    encoded = Music_Theory.get_chords_bulk(["F#o"], encoded=True)[0]
+    assert [Music_Theory._decode_note(int(n)) for n in encoded] == ["F#", "A", "C"]
+
+    # Beyond five sharps or flats too
+    chords = ["B####+", "Cbbbbbbo", "F#######m", "Gbbbbbb"]
+    assert Music_Theory.get_chords_bulk(chords) == [Music_Theory.get_chord_notes(chord) for chord in chords]
+
+    with pytest.raises(ValueError):
+        Music_Theory.get_chords_bulk(["C", "Hm"])
+
+
+def test_get_chord_notes_sevenths_and_inversions():
+    # Seventh chords
+    assert Music_Theory.get_chord_notes("G7") == ["G", "B", "D", "F"]
+    assert Music_Theory.get_chord_notes("Cmaj7") == ["C", "E", "G", "B"]
+    assert Music_Theory.get_chord_notes("CM7") == ["C", "E", "G", "B"]
+    assert Music_Theory.get_chord_notes("Dm7") == ["D", "F", "A", "C"]
+    assert Music_Theory.get_chord_notes("Bø7") == ["B", "D", "F", "A"]
+    assert Music_Theory.get_chord_notes("Bm7b5") == ["B", "D", "F", "A"]
+    assert Music_Theory.get_chord_notes("G#dim7") == ["G#", "B", "D", "F"]
+    assert Music_Theory.get_chord_notes("Ebo7") == ["Eb", "Gb", "Bbb", "Dbb"]
+
+    # Slash chords: inversions start with the bass note, other bass notes are added below
+    assert Music_Theory.get_chord_notes("C/E") == ["E", "G", "C"]
+    assert Music_Theory.get_chord_notes("C/G") == ["G", "C", "E"]
+    assert Music_Theory.get_chord_notes("F#m/C#") == ["C#", "F#", "A"]
+    assert Music_Theory.get_chord_notes("G7/F") == ["F", "G", "B", "D"]
+    assert Music_Theory.get_chord_notes("C/Bb") == ["Bb", "C", "E", "G"]
+
+    # Unknown suffixes are rejected, instead of silently becoming a major chord
+    for chord in ["Cx", "C9", "Cmaj", "C/", "C/H", "/C", "Cm+", "cm"]:
+        with pytest.raises(ValueError):
+            Music_Theory.get_chord_notes(chord)
+
+    # The bulk method understands the same symbols
+    assert Music_Theory.get_chords_bulk(["G7", "C/E", "Am"]) == [["G", "B", "D", "F"], ["E", "G", "C"], ["A", "C", "E"]]
+
+
+def test_get_scales_containing():
+    # Exact spelling matches come first, with the fewest accidentals first
+    assert Music_Theory.get_scales_containing(["C", "D", "E", "F", "G", "A", "B"]) == [
+        ("C", "major", True),
+        ("A", "natural minor", True),
+        ("D", "dorian", True),
+        ("E", "phrygian", True),
+        ("F", "lydian", True),
+        ("G", "mixolydian", True),
+        ("B", "locrian", True),
+        ("B#", "major", False),
+        ("Fb", "phrygian", False),
+        ("E#", "lydian", False),
+        ("Cb", "locrian", False),
+    ]
+    results = Music_Theory.get_scales_containing(["C", "E", "G#"])
+    assert results[:2] == [("A", "harmonic minor", True), ("A", "melodic minor", True)]
+    # Ab is only an enharmonic match for G#
+    assert ("F", "harmonic minor", False) in results
+    assert results[2:4] == [("C", "whole tone", True), ("Bb", "whole tone", True)]
+    assert not any(exact for _, _, exact in results[4:])
+
+    # Every result really contains the notes, and no scale is missing from the results
+    notes = ["D", "F#", "C"]
+    results = Music_Theory.get_scales_containing(notes)
+    assert ("G", "major", True) in results
+    assert ("D", "melodic minor", False) not in results
+    for tonic, scale, exact in results:
+        scale_notes = Music_Theory.get_scale(tonic, scale)
+        assert exact == all(note in scale_notes for note in notes)
+    expected = [
+        (letter + accidental, scale)
+        for letter in "CDEFGAB" for accidental in ["", "#", "b"]
+        for scale in Music_Theory.SCALE_DEFINITIONS
+        if {Music_Theory._pitch_class(Music_Theory._encode_note(n)) for n in notes}
+        <= {Music_Theory._pitch_class(Music_Theory._encode_note(n)) for n in Music_Theory.get_scale(letter + accidental, scale)}
+    ]
+    assert sorted(expected) == sorted((tonic, scale) for tonic, scale, _ in results)
+
+    with pytest.raises(ValueError):
+        Music_Theory.get_scales_containing([])
+    with pytest.raises(ValueError):
+        Music_Theory.get_scales_containing(["C", "H"])
+
+
+def test_identify_chord():
+    assert Music_Theory.identify_chord(["C", "E", "G"]) == ("C", 0)
+    assert Music_Theory.identify_chord(["E", "C", "G"]) == ("C/E", 1)
+    assert Music_Theory.identify_chord(["G", "E", "C", "C"]) == ("C/G", 2)
+    assert Music_Theory.identify_chord(["A", "E", "C", "G"]) == ("Am7", 0)
+    assert Music_Theory.identify_chord(["Bb", "C", "E", "G"]) == ("C7/Bb", 3)
+    # Symmetric chords use the spelling of the notes to find the root
+    assert Music_Theory.identify_chord(["C", "E", "Ab"]) == ("Ab+/C", 1)
+    assert Music_Theory.identify_chord(["F", "D", "B", "Ab"]) == ("Bdim7/F", 2)
+
+    # Every chord and every inversion is identified, and the name gives back the same notes
+    for root in [letter + accidental for letter in "CDEFGAB" for accidental in ["", "#", "b"]]:
+        for suffix in ["", "m", "o", "+", "7", "maj7", "m7", "ø7", "dim7"]:
+            notes = Music_Theory.get_chord_notes(root + suffix)
+            for inversion in range(len(notes)):
+                rotated = notes[inversion:] + notes[:inversion]
+                chord, found_inversion = Music_Theory.identify_chord(rotated)
+                assert found_inversion == inversion
+                assert Music_Theory.get_chord_notes(chord) == rotated
+
+    for notes in [[], ["C"], ["C", "D", "E"], ["C", "E", "G", "B", "D"], ["C", "H", "G"]]:
+        with pytest.raises(ValueError):
+            Music_Theory.identify_chord(notes)
+
+
+def test_get_progression():
+    progression = Music_Theory.get_progression("D", "harmonic minor", iter(["i", "iio", "III", "V", "v"]))
+    assert next(progression) == ("i", "Dm", ["D", "F", "A"])
+    assert list(progression) == [
+        ("iio", "Eo", ["E", "G", "Bb"]),
+        ("III", "F+", ["F", "A", "C#"]),
+        ("V", "A", ["A", "C#", "E"]),
+        ("v", "A", ["A", "C#", "E"]),
+    ]
+    with pytest.raises(ValueError):
+        list(Music_Theory.get_progression("D", "major", ["I", "VIII"]))
+    with pytest.raises(ValueError):
+        list(Music_Theory.get_progression("D", "invalid", ["I"]))
+
+
+def test_get_voiced_notes():
+    voiced = Music_Theory.get_voiced_notes(["A", "B", "C#", "D"])
+    assert [n["key"] for n in voiced] == ["A/4", "B/4", "C#/5", "D/5"]
+    assert [n["midi"] for n in voiced] == [69, 71, 73, 74]
+    assert voiced[2] == {"note": "C#", "letter": "C", "accidental": "#", "octave": 5, "key": "C#/5", "midi": 73}
+
+    # MIDI numbers follow the accidentals, even across octave boundaries
+    assert [n["midi"] for n in Music_Theory.get_voiced_notes(["B#", "Cb", "Fbb"], 3)] == [60, 59, 63]
+    assert [n["octave"] for n in Music_Theory.get_voiced_notes(["G", "C", "E", "C"])] == [4, 5, 5, 6]
+
+    # Callers get their own copy
+    Music_Theory.get_voiced_notes(["C"])[0]["octave"] = 0
+    assert Music_Theory.get_voiced_notes(["C"])[0]["octave"] == 4
+
+    with pytest.raises(ValueError):
+        Music_Theory.get_voiced_notes(["C", "H"])
+
+
+def test_get_voiced_chords():
+    voiced = Music_Theory.get_voiced_chords(["A", "Bm", "C#m", "D", "E", "F#m", "G#o", "A"])
+    assert [[n["key"] for n in chord] for chord in voiced[:3]] == [
+        ["A/4", "C#/5", "E/5"],
+        ["B/4", "D/5", "F#/5"],
+        ["C#/5", "E/5", "G#/5"],
+    ]
+    assert [n["key"] for n in voiced[-1]] == ["A/5", "C#/6", "E/6"]
+
+
+def test_transpose():
+    # The spelling follows the interval, with double accidentals when needed
+    assert Music_Theory.transpose(["C", "E#", "Db", "F#o", "Bbm7/Ab"], "M3") == ["E", "G##", "F", "A#o", "Dm7/C"]
+    assert Music_Theory.transpose(["C", "E#", "Db", "Bbm7/Ab"], "-P4") == ["G", "B#", "Ab", "Fm7/Eb"]
+    assert Music_Theory.transpose(["C"] * 8, "P1") == ["C"] * 8
+    assert Music_Theory.transpose(["C", "C", "C", "C"], "A4") == ["F#"] * 4
+    assert Music_Theory.transpose(["D", "Cb"], "dd5") == ["Abb", "Gbbb"]
+    # Triply augmented or diminished intervals never wrap around to the other accidental
+    assert Music_Theory.transpose(["C##"], "AA4") == ["F####"]
+    assert Music_Theory.transpose(["C", "F#m/C#"], "ddd5") == ["Gbbb", "Cbbm/Gbb"]
+    assert Music_Theory.transpose(["C"], "-AAA8") == ["Cbbb"]
+    # Beyond that, and beyond MAX_ACCIDENTALS on a note, the input is refused, so it can't add accidentals
+    # to every note of a large response
+    for items, interval in [(["C"], "AAAA4"), (["C"], "dddd5"), (["C###"], "AA4"), (["C#####"], "P1"),
+                            (["Am/E#####"], "M2"), (["Fbbbb"], "m2")]:
+        with pytest.raises(ValueError):
+            Music_Theory.transpose(items, interval)
+    # Nor are the notes with more accidentals than the tables kept in the caches of the conversions
+    assert Music_Theory.get_chord_notes("Cbbbbbbo") == ["Cbbbbbb", "Ebbbbbbb", "Gbbbbbbb"]
+    assert "Cbbbbbb" not in Music_Theory._encoded_notes
+    assert all(abs(note >> 3) <= Music_Theory.MAX_ACCIDENTALS for note in Music_Theory._decoded_notes)
+    # Suffixes are kept as written
+    assert Music_Theory.transpose(["Dm7b5", "GM7", "A-"], "m2") == ["Ebm7b5", "AbM7", "Bb-"]
+
+    # Lists (eg: progressions) keep their shape, and every transposed chord matches the transposed notes
+    assert Music_Theory.transpose([["C", "Am", "F", "G7"], "E", []], "M2") == [["D", "Bm", "G", "A7"], "F#", []]
+    for chord in Music_Theory.get_table_chords()[:300]:
+        transposed = Music_Theory.transpose([chord], "m6")[0]
+        assert Music_Theory.get_chord_notes(transposed) == Music_Theory.transpose(Music_Theory.get_chord_notes(chord), "m6")
+
+    # Intervals, including compound and descending intervals
+    assert Music_Theory._parse_interval("M3") == (2, 4)
+    assert Music_Theory._parse_interval("-P4") == (-3, -5)
+    assert Music_Theory._parse_interval("d7") == (6, 9)
+    assert Music_Theory._parse_interval("m10") == (9, 15)
+    for interval in ["M4", "P3", "m5", "X3", "M0", "3", "", "+-M3"]:
+        with pytest.raises(ValueError):
+            Music_Theory._parse_interval(interval)
+
+    for items in [["H"], ["Cm9"], [1], [{"C": "D"}], [["C", ["D"]]]]:
+        with pytest.raises(ValueError):
+            Music_Theory.transpose(items, "M3")
+
+
+def test_voice_progression():
+    voiced = Music_Theory.voice_progression(["C", "F", "G7", "C"])
+    assert [[n["key"] for n in chord] for chord in voiced] == [
+        ["E/4", "G/4", "C/5"], ["F/4", "A/4", "C/5"], ["F/4", "G/4", "B/4", "D/5"], ["E/4", "G/4", "C/5"],
+    ]
+    assert voiced[0][0] == {"note": "E", "letter": "E", "accidental": "", "octave": 4, "key": "E/4", "midi": 64}
+    # The octave follows the letter
+    assert [n["key"] for n in Music_Theory.voice_progression(["B#o"], low=55, high=67)[0]] == ["B#/3", "D#/4", "F#/4"]
+
+    # No other sequence of candidate voicings moves less
+    for chords in [["C", "Am", "F", "G"], ["Dm7", "G7", "Cmaj7", "A7"], ["Eb", "Cm/G", "Ab", "Bb7"]]:
+        voiced = Music_Theory.voice_progression(chords)
+        best = min(
+            sum(Music_Theory._movement(a[0], b[0]) for a, b in zip(path, path[1:]))
+            for path in itertools.product(*[Music_Theory._candidate_voicings(chord, 55, 79) for chord in chords])
+        )
+        midi = [tuple(n["midi"] for n in chord) for chord in voiced]
+        assert sum(Music_Theory._movement(a, b) for a, b in zip(midi, midi[1:])) == best
+        # Every voicing has the notes of its chord, within the range
+        for chord, notes in zip(chords, voiced):
+            assert sorted(n["note"] for n in notes) == sorted(Music_Theory.get_chord_notes(chord))
+            assert all(55 <= n["midi"] <= 79 for n in notes)
+
+    # Slash chords keep their bass note at the bottom
+    voiced = Music_Theory.voice_progression(["C/E", "F", "C/E"])
+    assert voiced[0][0]["note"] == voiced[2][0]["note"] == "E"
+
+    # Long progressions
+    chords = Music_Theory.get_diatonic_chords("A", "harmonic minor") + ["Dm7", "E7"]
+    assert len(Music_Theory.voice_progression((chords * 8)[:64])) == 64
+
+    assert Music_Theory.voice_progression([]) == []
+    with pytest.raises(ValueError):
+        Music_Theory.voice_progression(["C", "Hm"])
+    with pytest.raises(ValueError):
+        Music_Theory.voice_progression(["C"], low=60, high=62)
@@ -0,0 +1,37 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+import gzip
+from page_cache import Page_Cache
+
+
+def test_render_once():
+    calls = []
+
+    def render():
+        calls.append(1)
+        return "<p>Ré</p>"
+
+    cache = Page_Cache()
+    variants = cache.get("/", render)
+    assert cache.get("/", render) is variants
+    assert len(calls) == 1
+
+    body, etag = variants["identity"]
+    assert body == "<p>Ré</p>".encode("utf-8")
+    assert gzip.decompress(variants["gzip"][0]) == body
+    # Every variant has its own strong ETag, derived from the content
+    assert variants["gzip"][1] == etag + "-gzip"
+    assert len({etag for _, etag in variants.values()}) == len(variants)
+
+    cache.clear()
+    cache.get("/", render)
+    assert len(calls) == 2
+
+
+def test_disabled():
+    calls = []
+    cache = Page_Cache(enabled=False)
+    for _ in range(2):
+        cache.get("/", lambda: calls.append(1) or "page")
+    assert len(calls) == 2
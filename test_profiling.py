@@ -0,0 +1,54 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+import os
+from werkzeug.test import Client
+
+from app import app, page_cache, response_cache
+from profiling import Sampling_Profiler, profile_files, report
+
+
+def get(client, url):
+    # Like a WSGI server, close the response once sent: this is when the profile is written
+    response = client.get(url)
+    response.get_data()
+    response.close()
+    return response
+
+
+def test_profile_requests(tmp_path):
+    response_cache.clear()
+    page_cache.clear()
+    client = Client(Sampling_Profiler(app, str(tmp_path), rate=1.0))
+    assert get(client, "/").status_code == 200
+    assert get(client, "/chord/Cmaj7").status_code == 200
+    assert get(client, "/does/not/exist").status_code == 404
+    # Streamed responses are profiled until the end of the body
+    response = get(client, "/progression/C/major/I-IV-V")
+    assert len(response.get_data().splitlines()) == 3
+
+    names = [os.path.basename(path).split("-")[0] for path in profile_files(str(tmp_path))]
+    assert sorted(names) == ["chord", "index", "progression", "unmatched"]
+
+    # The merged report includes the template rendering and the Music_Theory calls
+    text = report(str(tmp_path), top=1000)
+    assert text.startswith("4 profiles merged")
+    assert "render_template" in text
+    assert "get_progression" in text
+    text = report(str(tmp_path), top=1000, endpoint="chord")
+    assert text.startswith("1 profiles merged")
+    assert "get_chord_notes" in text
+
+
+def test_sampling_and_size_limit(tmp_path):
+    # Nothing is profiled with a rate of 0
+    client = Client(Sampling_Profiler(app, str(tmp_path), rate=0.0))
+    assert get(client, "/chord/C").status_code == 200
+    assert profile_files(str(tmp_path)) == []
+    assert report(str(tmp_path)).startswith("No profiles found")
+
+    # The oldest profiles are deleted beyond the size limit
+    client = Client(Sampling_Profiler(app, str(tmp_path), rate=1.0, max_bytes=1))
+    for _ in range(3):
+        get(client, "/chord/C")
+    assert profile_files(str(tmp_path)) == []
@@ -0,0 +1,55 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+from response_cache import Response_Cache
+
+
+def test_get_put():
+    cache = Response_Cache()
+    assert cache.get("a") == (False, None)
+    cache.put("a", b"[1]")
+    cache.put("b", None)
+    assert cache.get("a") == (True, b"[1]")
+    # None is a cached 404, not a miss
+    assert cache.get("b") == (True, None)
+    assert cache.stats() == {"enabled": 1, "hits": 2, "misses": 1, "entries": 2, "bytes": 3}
+
+
+def test_eviction():
+    # The least recently used entry goes first, when the number of entries is exceeded
+    cache = Response_Cache(max_entries=2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    cache.get("a")
+    cache.put("c", b"3")
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, b"1")
+    assert cache.get("c") == (True, b"3")
+
+    # Same thing when the total size is exceeded. Bodies bigger than the cache are never stored.
+    cache = Response_Cache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.put("c", b"123")
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["bytes"] == 8
+    cache.put("d", b"12345678901")
+    assert cache.get("d") == (False, None)
+    assert cache.stats()["entries"] == 2
+
+    # Replacing an entry does not count its size twice
+    cache.put("c", b"1")
+    assert cache.stats()["bytes"] == 6
+
+
+def test_disabled():
+    cache = Response_Cache(enabled=False)
+    cache.put("a", b"1")
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["misses"] == 0
+
+    cache.enabled = True
+    cache.put("a", b"1")
+    cache.clear()
+    assert cache.stats() == {"enabled": 1, "hits": 0, "misses": 0, "entries": 0, "bytes": 0}
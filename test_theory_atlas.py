@@ -0,0 +1,84 @@
+#!/usr/bin/env pytest-3.11
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from music_theory import Music_Theory
+from theory_atlas import HEADER, Theory_Atlas, build_atlas
+
+
+def test_same_answers(tmp_path):
+    # Every lookup of the atlas gives the exact same answer as the regular code, or None for invalid inputs
+    path = str(tmp_path / "theory.atlas")
+    Music_Theory.clear_tables()
+    assert build_atlas(path) == os.path.getsize(path)
+
+    atlas = Theory_Atlas.open(path)
+    try:
+        for tonic in Music_Theory.get_table_tonics():
+            for scale in Music_Theory.SUPPORTED_SCALES:
+                try:
+                    notes = Music_Theory.get_scale(tonic, scale)
+                    chords = Music_Theory.get_diatonic_chords(tonic, scale)
+                except ValueError:
+                    notes = chords = None
+                assert atlas.lookup("scales", (tonic, scale)) == notes
+                assert atlas.lookup("diatonic_chords", (tonic, scale)) == chords
+        for chord in Music_Theory.get_table_chords():
+            try:
+                notes = Music_Theory.get_chord_notes(chord)
+            except ValueError:
+                notes = None
+            assert atlas.lookup("chord_notes", chord) == notes
+
+        # Keys outside the atlas are not found
+        assert atlas.lookup("scales", ("C###", "major")) is None
+        assert atlas.lookup("scales", ("C", "invalid")) is None
+        assert atlas.lookup("chord_notes", "C/E") is None
+    finally:
+        atlas.close()
+
+
+def test_stale_or_corrupted(tmp_path):
+    path = str(tmp_path / "theory.atlas")
+    assert Theory_Atlas.open(path) is None
+
+    build_atlas(path)
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+
+    # An atlas written by another version of the code is ignored
+    stale = bytearray(data)
+    stale[6:38] = bytes(32)
+    with open(path, "wb") as f:
+        f.write(stale)
+    assert Theory_Atlas.open(path) is None
+
+    for garbage in [b"", b"garbage", b"MTAT" + bytes(HEADER.size), data[:HEADER.size + 10]]:
+        with open(path, "wb") as f:
+            f.write(garbage)
+        assert Theory_Atlas.open(path) is None
+
+
+def test_use_atlas(tmp_path):
+    # The first call builds the atlas, the following ones map the existing file
+    path = str(tmp_path / "theory.atlas")
+    try:
+        assert Music_Theory.use_atlas(path) is False
+        assert Music_Theory.use_atlas(path) is True
+        assert Music_Theory._tables is None
+        assert Music_Theory.get_scale("Eb", "dorian") == ["Eb", "F", "Gb", "Ab", "Bb", "C", "Db", "Eb"]
+        assert Music_Theory.get_diatonic_chords("A", "minor pentatonic") == ["Am", "C"]
+        assert Music_Theory.get_chord_notes("F#ø7") == ["F#", "A", "C", "E"]
+
+        # Callers get their own copy, and inputs outside the atlas still go through the regular code
+        Music_Theory.get_scale("C").append("D")
+        assert Music_Theory.get_scale("C") == ["C", "D", "E", "F", "G", "A", "B", "C"]
+        assert Music_Theory.get_chord_notes("C/E") == ["E", "G", "C"]
+        with pytest.raises(ValueError):
+            Music_Theory.get_scale("C", "invalid")
+        with pytest.raises(ValueError):
+            Music_Theory.get_chord_notes("Hm")
+    finally:
+        Music_Theory.clear_tables()
+    assert Music_Theory._atlas is None
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from typing import Dict, List
+
+from music_theory import Music_Theory
+
+# Header of the atlas file: magic, format version, digest of the Music_Theory version and source code,
+# number of tonics, scale types and chord suffixes, size of the names, then the offsets of the index
+# of each table. Every index is an array of uint32 offsets (one per key, in key order) pointing to
+# fixed-width records.
+MAGIC = b"MTAT"
+FORMAT = 1
+HEADER = struct.Struct("<4sH32sHHHIIII")
+
+# Width of the records, in bytes. Every record starts with its number of items (0 when there is no
+# valid answer for that key), followed by the items. Notes use the integer representation of the
+# Music_Theory class, stored as signed bytes. Diatonic chords are stored as pairs (root note, index
+# of the suffix), chords as their notes.
+SCALE_WIDTH = 16
+DIATONIC_WIDTH = 24
+CHORD_WIDTH = 8
+
+# Tables of the atlas, with the width of their records
+TABLES = [("scales", SCALE_WIDTH), ("diatonic_chords", DIATONIC_WIDTH), ("chord_notes", CHORD_WIDTH)]
+
+
+def atlas_key() -> bytes:
+    # An atlas is only valid for the exact source code that computed it
+    return hashlib.sha256(repr(Music_Theory._snapshot_key()[:2]).encode("utf-8")).digest()
+
+
+def _record(width: int, count: int, items: List[int]) -> bytes:
+    if 1 + len(items) > width:
+        raise ValueError(f"{len(items)} items don't fit in a record of {width} bytes")
+    return struct.pack(f"<B{len(items)}b", count, *items).ljust(width, b"\0")
+
+
+def _pad(data: bytearray) -> None:
+    # Keep the indexes aligned on 4 bytes
+    data.extend(b"\0" * (-len(data) % 4))
+
+
+def build_atlas(path: str) -> int:
+    """ Write the theory atlas to path, and return its size in bytes.
+
+    The atlas covers every tonic of the precomputed tables (see Music_Theory.get_table_tonics()), every
+    scale type (aliases included), the diatonic chords of every scale, and every chord suffix. The file
+    is written atomically, since several processes may start at the same time. """
+    tonics = Music_Theory.get_table_tonics()
+    scales = Music_Theory.SUPPORTED_SCALES
+    suffixes = Music_Theory.TABLE_CHORD_SUFFIXES
+    suffix_indexes = {suffix: index for index, suffix in enumerate(suffixes)}
+
+    records: Dict[str, List[bytes]] = {"scales": [], "diatonic_chords": [], "chord_notes": []}
+    for tonic in tonics:
+        for scale in scales:
+            try:
+                notes = [Music_Theory._encode_note(n) for n in Music_Theory.get_scale(tonic, scale)]
+                chords = []
+                for chord in Music_Theory.get_diatonic_chords(tonic, scale):
+                    root_note, quality, _ = Music_Theory._parse_chord(chord)
+                    chords += [root_note, suffix_indexes["" if quality == "M" else quality]]
+            except ValueError:
+                notes = chords = []
+            records["scales"].append(_record(SCALE_WIDTH, len(notes), notes))
+            records["diatonic_chords"].append(_record(DIATONIC_WIDTH, len(chords) // 2, chords))
+        for suffix in suffixes:
+            try:
+                notes = [Music_Theory._encode_note(n) for n in Music_Theory.get_chord_notes(tonic + suffix)]
+            except ValueError:
+                notes = []
+            records["chord_notes"].append(_record(CHORD_WIDTH, len(notes), notes))
+
+    names = "\0".join(tonics + scales + suffixes).encode("utf-8")
+    data = bytearray(HEADER.size)
+    data += names
+    _pad(data)
+
+    index_offsets = []
+    for table, width in TABLES:
+        index_offsets.append(len(data))
+        first_record = len(data) + 4 * len(records[table])
+        data += array("I", [first_record + width * i for i in range(len(records[table]))]).tobytes()
+        for record in records[table]:
+            data += record
+        _pad(data)
+
+    HEADER.pack_into(data, 0, MAGIC, FORMAT, atlas_key(), len(tonics), len(scales), len(suffixes),
+                     len(names), *index_offsets)
+
+    with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return len(data)
+
+
+class Theory_Atlas:
+    """
+    Read-only view of an atlas file written by build_atlas(), mapped in memory.
+
+    The file is mapped with mmap, so its pages are shared by every process mapping it (eg: all the
+    gunicorn workers), and only the pages actually used are ever read. A lookup reads one offset
+    from an index and decodes one fixed-width record: nothing is deserialized when opening the
+    file, and the memory used by each process stays the same whatever the number of scale types.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER.size:
+            raise ValueError("Not a theory atlas")
+        magic, version, key, n_tonics, n_scales, n_suffixes, names_size, *index_offsets = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("Not a theory atlas")
+        self.key = key
+
+        names = self._map[HEADER.size:HEADER.size + names_size].decode("utf-8").split("\0")
+        self._tonics = {tonic: i for i, tonic in enumerate(names[:n_tonics])}
+        self._scales = {scale: i for i, scale in enumerate(names[n_tonics:n_tonics + n_scales])}
+        self._suffixes = names[n_tonics + n_scales:]
+        suffix_indexes = {suffix: i for i, suffix in enumerate(self._suffixes)}
+        self._chords = {
+            tonic + suffix: t * n_suffixes + s
+            for tonic, t in self._tonics.items() for suffix, s in suffix_indexes.items()
+        }
+
+        # Signed bytes for the records, and uint32 offsets for the indexes
+        self._view = memoryview(self._map)
+        self._bytes = self._view.cast("b")
+        counts = [n_tonics * n_scales, n_tonics * n_scales, n_tonics * n_suffixes]
+        for (_, width), offset, count in zip(TABLES, index_offsets, counts):
+            if offset + (4 + width) * count > len(self._map):
+                raise ValueError("Truncated theory atlas")
+        self._indexes = {
+            table: self._view[offset:offset + 4 * count].cast("I")
+            for (table, _), offset, count in zip(TABLES, index_offsets, counts)
+        }
+
+    @classmethod
+    def open(cls, path: str) -> "Theory_Atlas | None":
+        # Return None if the atlas is missing, unreadable or stale
+        try:
+            atlas = cls(path)
+        except (OSError, ValueError, TypeError):
+            return None
+        if atlas.key != atlas_key():
+            atlas.close()
+            return None
+        return atlas
+
+    def close(self) -> None:
+        # The views must be released before the file can be unmapped
+        for index in self._indexes.values():
+            index.release()
+        self._indexes = {}
+        self._bytes.release()
+        self._view.release()
+        self._map.close()
+
+    def _position(self, table: str, key) -> int | None:
+        if table == "chord_notes":
+            return self._chords.get(key)
+        tonic, scale = key
+        t = self._tonics.get(tonic)
+        s = self._scales.get(scale)
+        if t is None or s is None:
+            return None
+        return t * len(self._scales) + s
+
+    def lookup(self, table: str, key) -> List[str] | None:
+        # Return the answer for a key of Music_Theory._lookup(), or None if the atlas doesn't have it
+        position = self._position(table, key)
+        if position is None:
+            return None
+
+        offset = self._indexes[table][position]
+        count = self._bytes[offset]
+        if count == 0:
+            return None
+
+        decode = Music_Theory._decode_note
+        if table == "diatonic_chords":
+            items = self._bytes[offset + 1:offset + 1 + 2 * count].tolist()
+            return [decode(items[i]) + self._suffixes[items[i + 1]] for i in range(0, len(items), 2)]
+        return [decode(n) for n in self._bytes[offset + 1:offset + 1 + count].tolist()]